@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the parts of nomia that have to scale with the size of the
+library. Everything runs on a synthetic library, so no real data is needed.
+
+Run with the name of a benchmark (or nothing to list them).
+"""
+from datetime import date
+import gc
+import random
+import sys
+import time
+import tracemalloc
+
+
+def generate_library(size, seed=0):
+    """
+    Return a dict with size entries in the same format as the entries in
+    NomiaEntryList (dates as date objects and tags as sets).
+    """
+    rnd = random.Random(seed)
+    tags = ['mecha', 'sci-fi', 'romance', 'comedy', 'drama', 'rewatch',
+            'slice of life', 'horror', 'sports', 'music'] \
+        + ['tag{}'.format(n) for n in range(300)]
+    words = ['sky', 'girl', 'robot', 'summer', 'sword', 'school', 'star',
+             'love', 'war', 'ghost', 'island', 'dragon', 'night', 'train']
+    studios = ['Sunrise', 'Gainax', 'Kyoto Animation', 'Madhouse', 'Bones',
+               'Production I.G', 'Shaft', 'Trigger', '']
+    def random_date():
+        if rnd.random() < 0.2:
+            return None
+        return date(rnd.randint(1980, 2016), rnd.randint(1, 12), rnd.randint(1, 28))
+    def text(n):
+        return ' '.join(rnd.choice(words) for _ in range(n))
+    entries = {}
+    for n in range(size):
+        # Build strings from scratch like the JSON parser does
+        entries[str(n)] = {
+            'title': text(rnd.randint(1, 4)).title() + ' {}'.format(n),
+            'episodes_progress': rnd.randint(0, 26),
+            'episodes_total': rnd.randint(1, 26),
+            'status': ''.join(rnd.choice(['watching', 'completed', 'on hold',
+                                          'dropped', 'plan to watch'])),
+            'rating': ''.join(rnd.choice(['G', 'PG', 'PG-13', 'R', 'R+'])),
+            'score_overall': rnd.randint(0, 10),
+            'score_characters': rnd.randint(0, 10),
+            'score_story': rnd.randint(0, 10),
+            'score_sound': rnd.randint(0, 10),
+            'score_art': rnd.randint(0, 10),
+            'score_enjoyment': rnd.randint(0, 10),
+            'type': ''.join(rnd.choice(['TV', 'OVA', 'movie', 'special', 'ONA'])),
+            'tags': {''.join(t) for t in rnd.sample(tags, rnd.randint(0, 6))},
+            'space': rnd.randint(0, 2**36),
+            'space_per_episode': rnd.randint(0, 2**30),
+            'episode_length': rnd.choice([0, 300, 1440, 1500, 6000]),
+            'airing_started': random_date(),
+            'airing_finished': random_date(),
+            'watching_started': random_date(),
+            'watching_finished': random_date(),
+            'description': text(rnd.randint(0, 40)),
+            'comment': text(rnd.randint(0, 5)),
+            'studio': ''.join(rnd.choice(studios)),
+            'mal_id': 100000 + n,
+        }
+    return entries
+
+
+def measure_memory(func):
+    """
+    Return the result of func() and the number of bytes it allocated.
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def timeit(func, repeat=3):
+    """
+    Return the best time in seconds out of repeat calls to func().
+    """
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def filter_functions(prefix):
+    """
+    Return the match_ or prepare_ functions (depending on prefix) for all
+    attributes, like in IndexFrame.
+    """
+    import entryfunctions
+    from entryfunctions import attribute_types
+    import filtersystem
+    funcs = {k: getattr(entryfunctions, prefix + v) for k, v in attribute_types.items()}
+    funcs['tags'] = getattr(filtersystem, prefix + 'tags')
+    return funcs
+
+
+sample_filters = [
+    '#mecha',
+    'watching_finished:>2015',
+    '#mecha, -#comedy, score_overall:>5',
+    '(#sci-fi | #tag1*), status:completed',
+    'title:robot, -type:movie, (#drama | #romance | episodes_total:>12)',
+    'space:>1gib, episode_length:<30m, -#rewatch',
+]
+
+
+# == Benchmarks ==
+
+def bench_entry_memory(size=50000):
+    """
+    Memory used by plain dict entries compared to Entry records.
+    """
+    from entryrecord import Entry
+    def as_dicts():
+        return generate_library(size)
+    def as_records():
+        return {k: Entry.from_dict(v) for k, v in generate_library(size).items()}
+    _, dictsize = measure_memory(as_dicts)
+    _, recordsize = measure_memory(as_records)
+    print('{} entries'.format(size))
+    print('  dict:  {:8.1f} MiB ({:5.0f} bytes/entry)'.format(dictsize / 2**20, dictsize / size))
+    print('  Entry: {:8.1f} MiB ({:5.0f} bytes/entry)'.format(recordsize / 2**20, recordsize / size))
+    print('  saved: {:.0%}'.format(1 - recordsize / dictsize))
+
+
+def bench_filter_compile(size=50000):
+    """
+    Filtering with compiled filters compared to the old interpreter.
+    """
+    from entryrecord import Entry
+    from filtersystem import compile_filter, interpret_filter, run_filter
+    from libsyntyche.tagsystem import compile_tag_filter
+    entries = {k: Entry.from_dict(v) for k, v in generate_library(size).items()}
+    matchfuncs = filter_functions('match_')
+    preparefuncs = filter_functions('prepare_')
+    print('{} entries'.format(size))
+    for rawfilter in sample_filters:
+        exp = compile_tag_filter(rawfilter, {})
+        def interpreted():
+            return {k for k, e in entries.items() if interpret_filter(exp, e, matchfuncs)}
+        def compiled():
+            compiledfilter = compile_filter(exp, preparefuncs)
+            return {k for k, e in entries.items() if run_filter(compiledfilter, e)}
+        assert interpreted() == compiled()
+        oldtime = timeit(interpreted)
+        newtime = timeit(compiled)
+        print('  {}'.format(rawfilter))
+        print('    interpreted: {:7.1f} ms'.format(oldtime * 1000))
+        print('    compiled:    {:7.1f} ms ({:.1f}x)'.format(newtime * 1000, oldtime / newtime))
+
+
+def filter_indexes(entries):
+    """
+    Return the indexes IndexFrame uses for filtering, built for the entries.
+    """
+    import entryfunctions
+    from entryfunctions import attribute_types
+    from entryindexes import SortedIndex, TagIndex
+    indexes = {'tags': TagIndex()}
+    for attribute, matchtype in attribute_types.items():
+        if matchtype != 'string':
+            indexes[attribute] = SortedIndex(attribute,
+                                             getattr(entryfunctions, 'range_' + matchtype))
+    for index in indexes.values():
+        index.rebuild(entries)
+    return indexes
+
+
+def bench_filter_index(size=50000):
+    """
+    Filtering with indexes compared to matching every entry.
+    """
+    from entryrecord import Entry
+    from filtersystem import compile_filter, evaluate_filter, run_filter
+    from libsyntyche.tagsystem import compile_tag_filter
+    entries = {k: Entry.from_dict(v) for k, v in generate_library(size).items()}
+    preparefuncs = filter_functions('prepare_')
+    indexes = filter_indexes(entries)
+    print('{} entries'.format(size))
+    extrafilters = ['-#mecha, -#comedy', '#tag1*, #drama', 'score_overall:>=8',
+                    'space:>10gib', 'episode_length:<25m', 'airing_started:>jan 2010',
+                    'score_story:, -score_art:<5']
+    for rawfilter in sample_filters + extrafilters:
+        compiledfilter = compile_filter(compile_tag_filter(rawfilter, {}), preparefuncs)
+        def scan():
+            return {k for k, e in entries.items() if run_filter(compiledfilter, e)}
+        def indexed():
+            return evaluate_filter(compiledfilter, entries, indexes)
+        assert scan() == indexed()
+        scantime = timeit(scan)
+        indextime = timeit(indexed)
+        print('  {}'.format(rawfilter))
+        print('    scan:    {:7.1f} ms'.format(scantime * 1000))
+        print('    indexed: {:7.1f} ms ({:.1f}x)'.format(indextime * 1000, scantime / indextime))
+
+
+def bench_filter_plan(size=50000):
+    """
+    Matching every entry with the subexpressions in the order they were
+    typed compared to the order chosen by the planner.
+    """
+    from entryrecord import Entry
+    from filtersystem import compile_filter, run_filter, FilterPlanner
+    from libsyntyche.tagsystem import compile_tag_filter
+    entries = {k: Entry.from_dict(v) for k, v in generate_library(size).items()}
+    preparefuncs = filter_functions('prepare_')
+    planner = FilterPlanner(entries, filter_indexes(entries))
+    print('{} entries'.format(size))
+    extrafilters = ['description:foo, #rewatch', 'title:robot | -#',
+                    'title:robot, score_overall:>8, #drama']
+    for rawfilter in sample_filters + extrafilters:
+        compiledfilter = compile_filter(compile_tag_filter(rawfilter, {}), preparefuncs)
+        plannedfilter = planner.plan(compiledfilter)
+        def typed():
+            return {k for k, e in entries.items() if run_filter(compiledfilter, e)}
+        def planned():
+            return {k for k, e in entries.items() if run_filter(plannedfilter, e)}
+        assert typed() == planned()
+        typedtime = timeit(typed)
+        plannedtime = timeit(planned)
+        print('  {}'.format(planner.explain(plannedfilter)))
+        print('    typed:   {:7.1f} ms'.format(typedtime * 1000))
+        print('    planned: {:7.1f} ms ({:.1f}x)'.format(plannedtime * 1000,
+                                                      typedtime / plannedtime))
+
+
+def bench_parallel_filter(size=100000):
+    """
+    Matching every entry in one process compared to the worker processes,
+    at growing library sizes, to find where the workers start to pay off.
+    """
+    from entryrecord import Entry
+    from filtersystem import compile_filter, run_filter
+    from libsyntyche.tagsystem import compile_tag_filter
+    from parallelfilter import ParallelFilter
+    preparefuncs = filter_functions('prepare_')
+    rawfilter = '(description:train star | comment:sword war), -title:robot'
+    filterexpression = compile_tag_filter(rawfilter, {})
+    compiledfilter = compile_filter(filterexpression, preparefuncs)
+    pool = ParallelFilter(preparefuncs)
+    print('{}, {} processes'.format(rawfilter, pool.processcount))
+    crossover = None
+    try:
+        for n in [1000, 2000, 5000, 10000, 20000, 50000, size]:
+            entries = {k: Entry.from_dict(v) for k, v in generate_library(n).items()}
+            pool.rebuild(entries)
+            loadtime = timeit(lambda: pool.filter_ids(filterexpression), repeat=1)
+            def serial():
+                return {k for k, e in entries.items() if run_filter(compiledfilter, e)}
+            def parallel():
+                return pool.filter_ids(filterexpression)
+            assert serial() == parallel()
+            serialtime = timeit(serial)
+            paralleltime = timeit(parallel)
+            if crossover is None and paralleltime < serialtime:
+                crossover = n
+            print('  {:6} entries: serial {:7.1f} ms, parallel {:7.1f} ms ({:.1f}x), '
+                  'first run with loading {:7.1f} ms'.format(
+                      n, serialtime * 1000, paralleltime * 1000,
+                      serialtime / paralleltime, loadtime * 1000))
+    finally:
+        pool.close()
+    print('Crossover: {}'.format('{} entries'.format(crossover) if crossover
+                                 else 'not reached'))
+
+
+def bench_columnar(size=50000):
+    """
+    Filtering and sorting with NumPy columns compared to Python.
+    """
+    import columnarindex
+    import entryfunctions
+    from entryfunctions import attribute_types
+    from entryrecord import Entry
+    from filtersystem import compile_filter, evaluate_filter
+    from libsyntyche.tagsystem import compile_tag_filter
+    if not columnarindex.available:
+        print('NumPy is not installed')
+        return
+    entries = {k: Entry.from_dict(v) for k, v in generate_library(size).items()}
+    preparefuncs = filter_functions('prepare_')
+    indexes = filter_indexes(entries)
+    rangefuncs = {k: getattr(entryfunctions, 'range_' + v) for k, v in attribute_types.items()
+                  if v in ('int', 'score', 'space', 'duration', 'date')}
+    columns = columnarindex.ColumnarIndex(
+        {k: v for k, v in rangefuncs.items() if attribute_types[k] != 'date'},
+        {k: v for k, v in rangefuncs.items() if attribute_types[k] == 'date'},
+        ['rating', 'status', 'studio', 'type'])
+    buildtime = timeit(lambda: columns.rebuild(entries), repeat=1)
+    print('{} entries, columns built in {:.0f} ms'.format(size, buildtime * 1000))
+    for rawfilter in sample_filters + ['status:completed, type:tv, score_overall:>=7']:
+        compiledfilter = compile_filter(compile_tag_filter(rawfilter, {}), preparefuncs)
+        def indexed():
+            return evaluate_filter(compiledfilter, entries, indexes)
+        def vectorized():
+            return columns.filter_ids(compiledfilter)
+        assert indexed() == vectorized()
+        indextime = timeit(indexed)
+        columntime = timeit(vectorized)
+        print('  {}'.format(rawfilter))
+        print('    indexes: {:7.1f} ms'.format(indextime * 1000))
+        print('    columns: {:7.1f} ms ({:.1f}x)'.format(columntime * 1000, indextime / columntime))
+    for attribute in ['score_overall', 'status', 'space']:
+        def pythonsort():
+            return sorted(entries.items(), key=lambda x: x[1][attribute])
+        pythontime = timeit(pythonsort)
+        columntime = timeit(lambda: columns.sorted_ids(attribute, False))
+        print('  sort by {}'.format(attribute))
+        print('    python:  {:7.1f} ms'.format(pythontime * 1000))
+        print('    columns: {:7.1f} ms ({:.1f}x)'.format(columntime * 1000, pythontime / columntime))
+
+
+def bench_sort_orders(size=50000):
+    """
+    Sorting everything again after an edit compared to moving the edited
+    entry into place in a cached order, and sorting by several attributes.
+    """
+    from entryindexes import SortOrders
+    from entryrecord import Entry
+    entries = {k: Entry.from_dict(v) for k, v in generate_library(size).items()}
+    orders = SortOrders()
+    orders.rebuild(entries)
+    rnd = random.Random(0)
+    ids = list(entries)
+    print('{} entries'.format(size))
+    for attribute in ['score_overall', 'title', 'space']:
+        orders.get(attribute, False)
+        def edit():
+            entryid = rnd.choice(ids)
+            oldvalue = entries[entryid][attribute]
+            entries[entryid][attribute] = entries[rnd.choice(ids)][attribute]
+            orders.value_changed(entryid, attribute, oldvalue, entries[entryid][attribute])
+        def fullsort():
+            edit()
+            return sorted(entries, key=lambda k: entries[k][attribute])
+        fulltime = timeit(fullsort)
+        incrementaltime = timeit(edit)
+        assert orders.get(attribute, False) == sorted(entries, key=lambda k: entries[k][attribute])
+        print('  sort by {}'.format(attribute))
+        print('    full sort:   {:7.2f} ms'.format(fulltime * 1000))
+        print('    incremental: {:7.2f} ms ({:.0f}x)'.format(incrementaltime * 1000,
+                                                          fulltime / incrementaltime))
+    sortkey = 'score_overall,-airing_started,title'
+    def firstsort():
+        orders.rebuild(entries)
+        return orders.get(sortkey, False)
+    def sortagain():
+        orders.orders.clear()
+        return orders.get(sortkey, False)
+    firsttime = timeit(firstsort)
+    againtime = timeit(sortagain)
+    print('  sort by {}'.format(sortkey))
+    print('    with new sort keys:    {:7.1f} ms'.format(firsttime * 1000))
+    print('    with cached sort keys: {:7.1f} ms'.format(againtime * 1000))
+
+
+benchmarks = {
+    'columnar': bench_columnar,
+    'entry-memory': bench_entry_memory,
+    'filter-compile': bench_filter_compile,
+    'filter-index': bench_filter_index,
+    'filter-plan': bench_filter_plan,
+    'parallel-filter': bench_parallel_filter,
+    'sort-orders': bench_sort_orders,
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print('Available benchmarks:')
+        for name, func in sorted(benchmarks.items()):
+            print('  {:20} {}'.format(name, func.__doc__.strip()))
+        return
+    benchmarks[sys.argv[1]](*[int(x) for x in sys.argv[2:]])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""
+An optional copy of the entries as NumPy columns, for filtering and
+sorting large libraries with vectorized operations.
+
+NumPy is not required: if it can't be imported, available is False and
+everything uses the normal pure Python code instead.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from entryindexes import EntryIndex, sort_key
+from tagvocabulary import TagVocabulary
+
+
+available = np is not None
+
+
+class ColumnarIndex(EntryIndex):
+    """
+    Mirror the entries as one NumPy array per attribute.
+
+    numeric and dates map attributes to the entryfunctions.range_*
+    function used to turn filter arguments into ranges. Numbers are stored
+    as they are and dates as ordinals, with 0 for unset dates. The
+    attributes in categorical are stored as codes into a list of all their
+    values, and tags as rows of bits, one per tag. Everything else (eg.
+    titles and descriptions) stays in Python and is matched entry by
+    entry, but only against the entries that can still match.
+
+    The arrays are kept larger than needed, so new entries don't have to
+    copy them every time.
+    """
+    def __init__(self, numeric, dates, categorical):
+        self.numeric = numeric
+        self.dates = dates
+        self.categorical = categorical
+        self.size = 0
+        self.ids = []
+        self.entries = []
+        self.rows = {}
+        self.columns = {}
+        self.categories = {}
+        self.codes = {}
+        self.tagbits = {}
+        self.tagwords = None
+        self.vocabulary = TagVocabulary()
+
+    # == Building and updating ==
+
+    def rebuild(self, entries):
+        items = list(entries.items())
+        self.size = len(items)
+        capacity = max(self.size, 16)
+        self.ids = [entryid for entryid, _ in items]
+        self.entries = [entry for _, entry in items]
+        self.rows = {entryid: row for row, entryid in enumerate(self.ids)}
+        self.columns = {}
+        for attribute in self.numeric:
+            self.columns[attribute] = np.zeros(capacity, np.int64)
+            self.columns[attribute][:self.size] = [e[attribute] for e in self.entries]
+        for attribute in self.dates:
+            self.columns[attribute] = np.zeros(capacity, np.int64)
+            self.columns[attribute][:self.size] = [self._date_value(e[attribute])
+                                                   for e in self.entries]
+        for attribute in self.categorical:
+            self.categories[attribute] = []
+            self.codes[attribute] = {}
+            self.columns[attribute] = np.zeros(capacity, np.int32)
+            self.columns[attribute][:self.size] = [self._code(attribute, e[attribute])
+                                                   for e in self.entries]
+        alltags = set().union(*(e['tags'] for e in self.entries))
+        self.vocabulary = TagVocabulary(alltags)
+        self.tagbits = {tag: n for n, tag in enumerate(self.vocabulary.tags)}
+        self.tagwords = np.zeros((capacity, max(1, (len(alltags) + 63) // 64)), np.uint64)
+        rows = []
+        bits = []
+        for row, entry in enumerate(self.entries):
+            for tag in entry['tags']:
+                rows.append(row)
+                bits.append(self.tagbits[tag])
+        bits = np.array(bits, np.uint64)
+        np.bitwise_or.at(self.tagwords, (rows, (bits // 64).astype(np.intp)),
+                         np.left_shift(np.uint64(1), bits % 64))
+
+    def _date_value(self, value):
+        return 0 if value is None else value.toordinal()
+
+    def _code(self, attribute, value):
+        codes = self.codes[attribute]
+        if value not in codes:
+            codes[value] = len(self.categories[attribute])
+            self.categories[attribute].append(value)
+        return codes[value]
+
+    def _set_tags(self, row, tags):
+        words = self.tagwords[row]
+        words[:] = 0
+        for tag in tags:
+            if tag not in self.tagbits:
+                self._add_tag(tag)
+                words = self.tagwords[row]
+            word, bit = divmod(self.tagbits[tag], 64)
+            words[word] |= np.uint64(1 << bit)
+
+    def _add_tag(self, tag):
+        self.tagbits[tag] = len(self.tagbits)
+        self.vocabulary.add(tag)
+        neededwords = (len(self.tagbits) + 63) // 64
+        if neededwords > self.tagwords.shape[1]:
+            extra = np.zeros((self.tagwords.shape[0], neededwords - self.tagwords.shape[1]),
+                             np.uint64)
+            self.tagwords = np.hstack([self.tagwords, extra])
+
+    def _set_value(self, row, attribute, value):
+        if attribute in self.numeric:
+            self.columns[attribute][row] = value
+        elif attribute in self.dates:
+            self.columns[attribute][row] = self._date_value(value)
+        elif attribute in self.categorical:
+            self.columns[attribute][row] = self._code(attribute, value)
+        elif attribute == 'tags':
+            self._set_tags(row, value)
+
+    def entry_added(self, entryid, entry):
+        row = self.size
+        if row == len(self.tagwords):
+            # Double the capacity
+            for attribute, column in self.columns.items():
+                self.columns[attribute] = np.concatenate([column, np.zeros_like(column)])
+            self.tagwords = np.vstack([self.tagwords, np.zeros_like(self.tagwords)])
+        self.size += 1
+        self.ids.append(entryid)
+        self.entries.append(entry)
+        self.rows[entryid] = row
+        for attribute in self.entries[row]:
+            self._set_value(row, attribute, entry[attribute])
+
+    def value_changed(self, entryid, attribute, oldvalue, newvalue):
+        self._set_value(self.rows[entryid], attribute, newvalue)
+
+    # == Filtering ==
+
+    def vectorized(self, node):
+        """
+        Return True if no entries have to be matched one by one in Python
+        to filter with a compiled filter.
+        """
+        if node.op == 'CHUNK' and node.attribute != '@':
+            return node.attribute == 'tags' or node.attribute in self.columns
+        return all(self.vectorized(c) for c in node.children)
+
+    def _range_mask(self, column, start, end):
+        mask = np.ones(self.size, bool)
+        if start is not None:
+            mask &= column >= start
+        if end is not None:
+            mask &= column < end
+        return mask
+
+    def _tag_mask(self, arg):
+        words = self.tagwords[:self.size]
+        tag = arg.strip()
+        if not tag:
+            return ~words.any(axis=1)
+        tags = self.vocabulary.expand(tag) if '*' in tag else [tag]
+        wanted = np.zeros(words.shape[1], np.uint64)
+        for t in tags:
+            if t in self.tagbits:
+                word, bit = divmod(self.tagbits[t], 64)
+                wanted[word] |= np.uint64(1 << bit)
+        return (words & wanted).any(axis=1)
+
+    def _chunk_mask(self, node):
+        """
+        Return a mask of the entries matching a chunk (ignoring negation),
+        or None if it can't be vectorized.
+        """
+        attribute = node.attribute
+        if attribute == 'tags':
+            return self._tag_mask(node.arg)
+        column = self.columns.get(attribute)
+        if column is None:
+            return None
+        column = column[:self.size]
+        if attribute in self.categorical:
+            matching = [code for code, value in enumerate(self.categories[attribute])
+                        if node.predicate(value)]
+            return np.isin(column, matching)
+        try:
+            start, end = (self.numeric.get(attribute) or self.dates[attribute])(node.arg)
+        except (ValueError, OverflowError):
+            return None
+        if attribute in self.dates:
+            # Unset dates never match
+            mask = self._range_mask(column, None if start is None else start.toordinal(),
+                                    None if end is None else end.toordinal())
+            return mask & (column > 0)
+        return self._range_mask(column, start, end)
+
+    def _scan_mask(self, match, within):
+        mask = np.zeros(self.size, bool)
+        rows = range(self.size) if within is None else np.flatnonzero(within).tolist()
+        entries = self.entries
+        mask[[row for row in rows if match(entries[row])]] = True
+        return mask
+
+    def _mask(self, node, within):
+        """
+        Return a mask of the entries matching a node. Only the entries in
+        the within mask (all if None) are guaranteed to be right.
+        """
+        if node.op == 'CHUNK' and node.attribute == '@':
+            # A filter macro
+            return self._mask(node.children[0], within)
+        if node.op == 'CHUNK':
+            mask = self._chunk_mask(node)
+            if mask is None:
+                return self._scan_mask(node.match, within)
+            return ~mask if node.negative else mask
+        # Vectorized subexpressions first, to narrow down the scanned ones
+        children = sorted(node.children, key=lambda c: not self.vectorized(c))
+        if node.op == 'AND':
+            mask = np.ones(self.size, bool) if within is None else within.copy()
+            for child in children:
+                mask &= self._mask(child, mask)
+            return mask
+        else:
+            mask = np.zeros(self.size, bool)
+            for child in children:
+                remaining = ~mask if within is None else within & ~mask
+                mask |= self._mask(child, remaining)
+            return mask
+
+    def filter_ids(self, compiledfilter):
+        """
+        Return a set with the ids of the entries matching a compiled filter.
+        """
+        ids = self.ids
+        return {ids[row] for row in np.flatnonzero(self._mask(compiledfilter, None)).tolist()}
+
+    # == Sorting ==
+
+    def sorted_ids(self, attribute, reverse):
+        """
+        Return a list with all ids sorted by an attribute (in the same order
+        as SortOrders), or None if the attribute isn't a column.
+        """
+        column = self.columns.get(attribute)
+        if column is None:
+            return None
+        keys = column[:self.size]
+        if attribute in self.categorical:
+            # Values that are the same ignoring case get the same rank
+            sortkeys = [sort_key(x) for x in self.categories[attribute]]
+            ranks = {x: n for n, x in enumerate(sorted(set(sortkeys)))}
+            keys = np.array([ranks[x] for x in sortkeys], np.int64)[keys]
+        order = np.argsort(-keys if reverse else keys, kind='stable')
+        if attribute in self.dates:
+            # Unset dates go last
+            order = np.concatenate([order[keys[order] > 0], order[keys[order] == 0]])
+        ids = self.ids
+        return [ids[row] for row in order.tolist()]
@@ -1,4 +1,5 @@
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
+from operator import lt, gt, le, ge, eq
 import re
 
 _multipliers = {
@@ -14,49 +15,108 @@ _multipliers = {
 }
 _monthabbrs = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
 
+# The type of every attribute, as in IndexFrame.init_attributes. The
+# prepare_, match_, range_ and parse_ functions of a type are named after it.
+attribute_types = {
+    'airing_finished': 'date',
+    'airing_started': 'date',
+    'comment': 'string',
+    'description': 'string',
+    'episode_length': 'duration',
+    'episodes_progress': 'int',
+    'episodes_total': 'int',
+    'mal_id': 'int',
+    'rating': 'string',
+    'score_art': 'score',
+    'score_characters': 'score',
+    'score_enjoyment': 'score',
+    'score_overall': 'score',
+    'score_sound': 'score',
+    'score_story': 'score',
+    'space': 'space',
+    'space_per_episode': 'space',
+    'status': 'string',
+    'studio': 'string',
+    'title': 'string',
+    'type': 'string',
+    'watching_finished': 'date',
+    'watching_started': 'date',
+}
 
-def match_string(arg, data):
-    if not arg:
-        return data == ''
-    return arg.lower() in data.lower()
+
+# MATCHING
+#
+# Every matcher comes in two parts: prepare_x(arg) parses the filter
+# argument once and returns a predicate that only has to be called with
+# the data of each entry. match_x(arg, data) does both in one go.
+
+_compfuncs = {'<': lt, '>': gt, '<=': le, '>=': ge, '=': eq, '': eq}
 
 def _get_comparison_function(arg, keepspaces=False):
-    from operator import lt,gt,le,ge,eq
     if not keepspaces:
         arg = arg.replace(' ', '')
     if not arg:
         raise SyntaxError('Invalid argument')
-    compfuncs = {'<':lt, '>':gt, '<=':le, '>=':ge, '=': eq, '': eq}
     opstr, rest = re.fullmatch(r'([<>]?=?)(.+)', arg).groups()
-    return compfuncs[opstr], rest
+    return _compfuncs[opstr], rest
 
-def match_int(arg, data):
+def prepare_string(arg):
+    if not arg:
+        def match(data):
+            return data == ''
+    else:
+        arg = arg.lower()
+        def match(data):
+            return arg in data.lower()
+    return match
+
+def _prepare_comparison(op, value):
+    def match(data):
+        return op(data, value)
+    return match
+
+def prepare_int(arg):
     op, rest = _get_comparison_function(arg)
     if not rest.isdecimal():
         raise SyntaxError('Invalid int match expression')
-    return op(data, int(rest))
+    return _prepare_comparison(op, int(rest))
 
-def match_score(arg, data):
+def prepare_score(arg):
     # Only show unscored entries when explicitly told to
     if not arg:
-        return data == 0
-    elif data == 0:
-        return False
+        def match(data):
+            return data == 0
+        return match
     op, rest = _get_comparison_function(arg)
     if not rest.isdecimal():
         raise SyntaxError('Invalid int match expression')
-    return op(data, int(rest))
+    value = int(rest)
+    def match(data):
+        return data != 0 and op(data, value)
+    return match
 
-def match_space(arg, data):
-    op, rest = _get_comparison_function(arg)
+def _parse_space_arg(rest):
+    """
+    Return the number of bytes in a space match argument, eg. "1.5gib".
+    """
     rx = re.fullmatch(r'(?i)(\d+|\d+\.\d+)\s*([kmgt]i?b?)?', rest)
     if rx is None:
         raise SyntaxError('Invalid space match expression')
     rawnum, rawunit = rx.groups('')
-    return op(data, int(float(rawnum) * _multipliers[rawunit]))
+    return int(float(rawnum) * _multipliers[rawunit.lower()])
 
-def match_date(arg, data):
-    op, rest = _get_comparison_function(arg.lower(), keepspaces=True)
+def prepare_space(arg):
+    op, rest = _get_comparison_function(arg)
+    return _prepare_comparison(op, _parse_space_arg(rest))
+
+def _parse_date_arg(rest):
+    """
+    Parse a date match argument.
+
+    Return a tuple with the precision of the argument ('year', 'month' or
+    'date') and the value to compare with. Years are ints, months are ints
+    in the form year*12+month and dates are date objects.
+    """
     yearrx = re.fullmatch(r'(19|20)?(\d\d)', rest.strip())
     monthyearrx = re.fullmatch(r'(\w+)\s*(\d{4})', rest.strip())
     currentyear = date.today().year
@@ -64,31 +124,129 @@ def match_date(arg, data):
         century, tens = yearrx.groups()
         if yearrx.group(1) is None:
             century = '19' if int('20'+tens) > currentyear else '20'
-        year = int(century + tens)
-        return op(data.year, year)
+        return 'year', int(century + tens)
     elif monthyearrx:
         monthname, year = monthyearrx.groups()
         try:
             month = _monthabbrs.index(monthname)+1
         except ValueError:
             raise SyntaxError('Invalid month')
-        return op(data.year*12+data.month, int(year)*12+month)
+        return 'month', int(year)*12+month
     else:
         try:
             fulldate = datetime.strptime(rest.strip(), '%Y-%m-%d').date()
         except ValueError:
             raise SyntaxError('Invalid date match expression')
         else:
-            return op(data, fulldate)
+            return 'date', fulldate
 
-def match_duration(arg, data):
-    op, rest = _get_comparison_function(arg)
+def prepare_date(arg):
+    """
+    Unset dates (None) never match.
+    """
+    op, rest = _get_comparison_function(arg.lower(), keepspaces=True)
+    precision, value = _parse_date_arg(rest)
+    if precision == 'year':
+        def match(data):
+            return data is not None and op(data.year, value)
+    elif precision == 'month':
+        def match(data):
+            return data is not None and op(data.year*12+data.month, value)
+    else:
+        def match(data):
+            return data is not None and op(data, value)
+    return match
+
+def _parse_duration_arg(rest):
+    """
+    Return the number of seconds in a duration match argument, eg. "1h30m".
+    """
     rx = re.fullmatch(r'((?P<h>\d+)h)?((?P<m>\d+)m(in)?)?((?P<s>\d+)s)?', rest)
     if rx is None:
         raise SyntaxError('Invalid duration match expression')
     d = rx.groupdict(0)
-    totalseconds = int(d['h'])*3600+int(d['m'])*60+int(d['s'])
-    return op(data, totalseconds)
+    return int(d['h'])*3600+int(d['m'])*60+int(d['s'])
+
+def prepare_duration(arg):
+    op, rest = _get_comparison_function(arg)
+    return _prepare_comparison(op, _parse_duration_arg(rest))
+
+# RANGES
+#
+# range_x(arg) returns the (start, end) range of values that match the
+# same argument as prepare_x, for looking them up in a sorted index.
+# start is inclusive, end is exclusive and None means unbounded. Values
+# that can't be ordered (unset dates) never match.
+
+def _comparison_range(op, start, end):
+    """
+    Return the range of values matching op compared with a value, where
+    start and end are the range of values equal to it.
+    """
+    if op is eq:
+        return start, end
+    elif op is gt:
+        return end, None
+    elif op is ge:
+        return start, None
+    elif op is lt:
+        return None, start
+    else:
+        return None, end
+
+def range_int(arg):
+    op, rest = _get_comparison_function(arg)
+    if not rest.isdecimal():
+        raise SyntaxError('Invalid int match expression')
+    return _comparison_range(op, int(rest), int(rest)+1)
+
+def range_score(arg):
+    # 0 means unscored and only matches an empty argument
+    if not arg:
+        return 0, 1
+    start, end = range_int(arg)
+    return max(start or 1, 1), end
+
+def range_space(arg):
+    op, rest = _get_comparison_function(arg)
+    value = _parse_space_arg(rest)
+    return _comparison_range(op, value, value+1)
+
+def range_date(arg):
+    op, rest = _get_comparison_function(arg.lower(), keepspaces=True)
+    precision, value = _parse_date_arg(rest)
+    if precision == 'year':
+        start, end = date(value, 1, 1), date(value+1, 1, 1)
+    elif precision == 'month':
+        year, month = divmod(value-1, 12)
+        nextyear, nextmonth = divmod(value, 12)
+        start, end = date(year, month+1, 1), date(nextyear, nextmonth+1, 1)
+    else:
+        start, end = value, value + timedelta(days=1)
+    return _comparison_range(op, start, end)
+
+def range_duration(arg):
+    op, rest = _get_comparison_function(arg)
+    value = _parse_duration_arg(rest)
+    return _comparison_range(op, value, value+1)
+
+def match_string(arg, data):
+    return prepare_string(arg)(data)
+
+def match_int(arg, data):
+    return prepare_int(arg)(data)
+
+def match_score(arg, data):
+    return prepare_score(arg)(data)
+
+def match_space(arg, data):
+    return prepare_space(arg)(data)
+
+def match_date(arg, data):
+    return prepare_date(arg)(data)
+
+def match_duration(arg, data):
+    return prepare_duration(arg)(data)
 
 
 
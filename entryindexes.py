@@ -0,0 +1,499 @@
+from bisect import bisect_left, bisect_right
+from datetime import date
+
+from tagvocabulary import TagVocabulary
+
+
+class EntryIndex():
+    """
+    Base class for the indexes an entry list keeps up to date.
+
+    The entry list calls rebuild() when all entries are (re)loaded, and
+    entry_added() and value_changed() on every change after that.
+    """
+    def rebuild(self, entries):
+        pass
+
+    def entry_added(self, entryid, entry):
+        pass
+
+    def value_changed(self, entryid, attribute, oldvalue, newvalue):
+        pass
+
+
+class IdAllocator(EntryIndex):
+    """
+    Hand out new entry ids without scanning all existing ones.
+
+    Entry ids are ints stored as strings, and new ids are always one more
+    than the highest one so far.
+    """
+    def __init__(self):
+        self.nextid = 0
+
+    def rebuild(self, entries):
+        self.nextid = max((int(x) for x in entries), default=-1) + 1
+
+    def entry_added(self, entryid, entry):
+        self.nextid = max(self.nextid, int(entryid) + 1)
+
+    def allocate(self):
+        return str(self.nextid)
+
+
+class ValueIndex(EntryIndex):
+    """
+    Map every value of an attribute to the ids of the entries with that value.
+    """
+    def __init__(self, attribute):
+        self.attribute = attribute
+        self.ids = {}
+
+    def rebuild(self, entries):
+        self.ids = {}
+        for entryid, entry in entries.items():
+            self.ids.setdefault(entry[self.attribute], set()).add(entryid)
+
+    def entry_added(self, entryid, entry):
+        self.ids.setdefault(entry[self.attribute], set()).add(entryid)
+
+    def value_changed(self, entryid, attribute, oldvalue, newvalue):
+        if attribute != self.attribute:
+            return
+        oldids = self.ids.get(oldvalue)
+        if oldids is not None:
+            oldids.discard(entryid)
+            if not oldids:
+                del self.ids[oldvalue]
+        self.ids.setdefault(newvalue, set()).add(entryid)
+
+    def lookup(self, value):
+        """
+        Return a set with the ids of all entries with the value. The set
+        belongs to the index and must not be changed.
+        """
+        return self.ids.get(value, frozenset())
+
+
+class TagIndex(EntryIndex):
+    """
+    Map every tag to the ids of the entries with that tag.
+
+    find() answers a tag filter chunk (the same way as
+    filtersystem.prepare_tags) with set operations instead of looking at
+    every entry, and complete() finds tags for autocompletion. Both use
+    the sorted vocabulary of all tags.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.untagged = set()
+        self.vocabulary = TagVocabulary()
+
+    def rebuild(self, entries):
+        self.ids = {}
+        self.untagged = set()
+        for entryid, entry in entries.items():
+            tags = entry['tags']
+            if not tags:
+                self.untagged.add(entryid)
+            for tag in tags:
+                self.ids.setdefault(tag, set()).add(entryid)
+        self.vocabulary = TagVocabulary(self.ids)
+
+    def _add_tag(self, entryid, tag):
+        if tag not in self.ids:
+            self.ids[tag] = set()
+            self.vocabulary.add(tag)
+        self.ids[tag].add(entryid)
+
+    def _remove_tag(self, entryid, tag):
+        ids = self.ids[tag]
+        ids.discard(entryid)
+        if not ids:
+            del self.ids[tag]
+            self.vocabulary.remove(tag)
+
+    def entry_added(self, entryid, entry):
+        tags = entry['tags']
+        if not tags:
+            self.untagged.add(entryid)
+        for tag in tags:
+            self._add_tag(entryid, tag)
+
+    def value_changed(self, entryid, attribute, oldvalue, newvalue):
+        if attribute != 'tags':
+            return
+        for tag in oldvalue - newvalue:
+            self._remove_tag(entryid, tag)
+        for tag in newvalue - oldvalue:
+            self._add_tag(entryid, tag)
+        if newvalue:
+            self.untagged.discard(entryid)
+        else:
+            self.untagged.add(entryid)
+
+    def find(self, arg):
+        """
+        Return a set with the ids of the entries matching a tag, which may
+        have * wildcards. An empty tag matches entries without tags.
+
+        The set may belong to the index and must not be changed.
+        """
+        tag = arg.strip()
+        if not tag:
+            return self.untagged
+        if '*' in tag:
+            # Turn the wildcard into the tags it matches, once
+            tags = self.vocabulary.expand(tag)
+            if len(tags) == 1:
+                return self.ids[tags[0]]
+            return set().union(*(self.ids[t] for t in tags))
+        return self.ids.get(tag, frozenset())
+
+    def count(self, arg):
+        """
+        Return the number of entries matching a tag, like find().
+        """
+        return len(self.find(arg))
+
+    def complete(self, prefix):
+        """
+        Return a list of all tags starting with the prefix, the most used
+        tags first.
+        """
+        return sorted(self.vocabulary.with_prefix(prefix),
+                      key=lambda t: (-len(self.ids[t]), t))
+
+
+class SortedIndex(EntryIndex):
+    """
+    Keep the ids of all entries sorted by an attribute.
+
+    rangefunc is one of the entryfunctions.range_* functions and is used by
+    find() to turn a filter argument into a range of values, which is then
+    looked up by bisection. Entries where the attribute is None (eg. unset
+    dates) aren't in the index.
+    """
+    def __init__(self, attribute, rangefunc):
+        self.attribute = attribute
+        self.rangefunc = rangefunc
+        # Sorted by value and then id, so a single entry can be found
+        self.values = []
+        self.ids = []
+
+    def rebuild(self, entries):
+        pairs = sorted((entry[self.attribute], entryid)
+                       for entryid, entry in entries.items()
+                       if entry[self.attribute] is not None)
+        self.values = [value for value, _ in pairs]
+        self.ids = [entryid for _, entryid in pairs]
+
+    def _position(self, value, entryid):
+        start = bisect_left(self.values, value)
+        end = bisect_right(self.values, value, start)
+        return bisect_left(self.ids, entryid, start, end)
+
+    def _insert(self, entryid, value):
+        if value is not None:
+            pos = self._position(value, entryid)
+            self.values.insert(pos, value)
+            self.ids.insert(pos, entryid)
+
+    def _remove(self, entryid, value):
+        if value is not None:
+            pos = self._position(value, entryid)
+            del self.values[pos]
+            del self.ids[pos]
+
+    def entry_added(self, entryid, entry):
+        self._insert(entryid, entry[self.attribute])
+
+    def value_changed(self, entryid, attribute, oldvalue, newvalue):
+        if attribute == self.attribute:
+            self._remove(entryid, oldvalue)
+            self._insert(entryid, newvalue)
+
+    def find(self, arg):
+        """
+        Return a set with the ids of the entries matching a filter argument,
+        or None if the argument can't be turned into a range.
+        """
+        bounds = self._bounds(arg)
+        if bounds is None:
+            return None
+        return set(self.ids[bounds[0]:bounds[1]])
+
+    def count(self, arg):
+        """
+        Return the number of entries matching a filter argument without
+        collecting their ids, or None like find().
+        """
+        bounds = self._bounds(arg)
+        if bounds is None:
+            return None
+        return max(bounds[1] - bounds[0], 0)
+
+    def _bounds(self, arg):
+        try:
+            start, end = self.rangefunc(arg)
+        except (ValueError, OverflowError):
+            # Eg. a date past year 9999
+            return None
+        first = 0 if start is None else bisect_left(self.values, start)
+        last = len(self.values) if end is None else bisect_left(self.values, end)
+        return first, last
+
+
+class VersionCounter(EntryIndex):
+    """
+    Count changes to the entries, per attribute.
+
+    Every change gets a new version number, so anything computed from the
+    entries at one version is still valid as long as none of the
+    attributes it depends on has changed since then.
+    """
+    def __init__(self):
+        self.version = 0
+        # Versions of the last reload, the last new entry and the last
+        # change of every attribute
+        self.rebuilt = 0
+        self.added = 0
+        self.changed = {}
+
+    def rebuild(self, entries):
+        self.version += 1
+        self.rebuilt = self.version
+
+    def entry_added(self, entryid, entry):
+        self.version += 1
+        self.added = self.version
+
+    def value_changed(self, entryid, attribute, oldvalue, newvalue):
+        self.version += 1
+        self.changed[attribute] = self.version
+
+    def last_change(self, attributes):
+        """
+        Return the version of the last change that affects the attributes.
+        """
+        return max([self.rebuilt, self.added] + [self.changed.get(x, 0) for x in attributes])
+
+
+def sort_key(value):
+    """
+    Return what a value is compared by when sorting: text ignoring case,
+    dates as ordinals and tags by how many there are. None is kept as it
+    is, and sorts last.
+    """
+    if isinstance(value, str):
+        return value.casefold()
+    if isinstance(value, date):
+        return value.toordinal()
+    if isinstance(value, (set, frozenset)):
+        return len(value)
+    return value
+
+
+def parse_sort_key(sortkey, reverse=False):
+    """
+    Return a tuple of (attribute, reverse) pairs from a sort key like
+    'score_overall,-airing_started,title', where a - sorts that attribute
+    in reverse. reverse reverses all of them.
+    """
+    result = []
+    for attribute in sortkey.split(','):
+        attribute = attribute.strip()
+        if attribute:
+            descending = attribute.startswith('-')
+            result.append((attribute[descending:], descending != reverse))
+    return tuple(result)
+
+
+class SortOrders(EntryIndex):
+    """
+    Remember the order of all entry ids sorted by a sort key (see
+    parse_sort_key), per sort key and direction.
+
+    The values are turned into sort_key()s once per attribute and kept up
+    to date after that, like the orders: edited and new entries are moved
+    into place with bisection, instead of sorting everything again. Ties
+    keep the order of the entries, like a stable sort would. The sort key
+    '' means sorting by id.
+    """
+    def __init__(self):
+        self.entries = {}
+        # (sort key, reverse) -> list of ids
+        self.orders = {}
+        # The ids in the order of the entries, and the other way around
+        self.ids = []
+        self.positions = {}
+        # attribute -> list of the sort_key()s of the values, by position
+        self.keys = {}
+        # attribute -> set of the positions where it's None
+        self.unset = {}
+
+    def rebuild(self, entries):
+        self.entries = entries
+        self.orders = {}
+        self.ids = list(entries)
+        self.positions = {entryid: n for n, entryid in enumerate(self.ids)}
+        self.keys = {}
+        self.unset = {}
+
+    def _keys(self, attribute):
+        keys = self.keys.get(attribute)
+        if keys is None:
+            # Some entry lists only load everything when asked for all values
+            values = self.entries.values()
+            if list(self.entries) == self.ids:
+                keys = [sort_key(entry[attribute]) for entry in values]
+            else:
+                keys = [None] * len(self.ids)
+                positions = self.positions
+                for entryid, entry in self.entries.items():
+                    keys[positions[entryid]] = sort_key(entry[attribute])
+            self.keys[attribute] = keys
+            self.unset[attribute] = {n for n, key in enumerate(keys) if key is None}
+        return keys
+
+    def _set_key(self, attribute, entryid, value):
+        position = self.positions[entryid]
+        key = self.keys[attribute][position] = sort_key(value)
+        if key is None:
+            self.unset[attribute].add(position)
+        else:
+            self.unset[attribute].discard(position)
+
+    def sortable(self, sortkey, entry):
+        """
+        Return True if the entry has all attributes in the sort key, which
+        isn't the case for eg. relevance.
+        """
+        return all(attribute in entry for attribute, _ in parse_sort_key(sortkey))
+
+    def get(self, sortkey, reverse, provider=None):
+        """
+        Return the sorted list of ids, which must not be changed.
+
+        provider is an optional function that takes the sort key and
+        direction and returns the sorted ids, or None to sort them here.
+        """
+        key = (sortkey, reverse)
+        order = self.orders.get(key)
+        if order is None:
+            if provider is not None:
+                order = provider(sortkey, reverse)
+            if order is None and not sortkey:
+                order = sorted(self.ids, reverse=reverse)
+            elif order is None:
+                order = self._sort(parse_sort_key(sortkey, reverse))
+            self.orders[key] = order
+        return order
+
+    def _sort(self, attributes):
+        # Positions are faster to look up keys with than ids
+        order = list(range(len(self.ids)))
+        # One attribute at a time, starting with the last one, since every
+        # sort keeps the order of the ties from the one before
+        for attribute, descending in reversed(attributes):
+            keys = self._keys(attribute)
+            unset = self.unset[attribute]
+            if unset:
+                last = [n for n in order if n in unset]
+                order = [n for n in order if n not in unset]
+            order.sort(key=keys.__getitem__, reverse=descending)
+            if unset:
+                order += last
+        ids = self.ids
+        return [ids[n] for n in order]
+
+    def invalidate(self, attribute):
+        """
+        Forget the orders using an attribute, eg. one that isn't an
+        attribute of the entries and doesn't get any changes.
+        """
+        for key in list(self.orders):
+            if any(a == attribute for a, _ in parse_sort_key(*key)):
+                del self.orders[key]
+
+    def bisect(self, ids, entryid, sortkey, reverse, lo=0, hi=None):
+        """
+        Return where the entry belongs in ids[lo:hi], which must be sorted
+        by the sort key.
+        """
+        positions = self.positions
+        position = positions[entryid]
+        columns = [(self._keys(attribute), descending)
+                   for attribute, descending in parse_sort_key(sortkey, reverse)]
+        hi = len(ids) if hi is None else hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            other = ids[mid]
+            otherposition = positions[other]
+            if not columns:
+                # Sorted by id
+                before = other > entryid if reverse else other < entryid
+            else:
+                before = otherposition < position
+            for keys, descending in columns:
+                value = keys[position]
+                othervalue = keys[otherposition]
+                if othervalue == value:
+                    continue
+                if othervalue is None or value is None:
+                    before = value is None
+                elif descending:
+                    before = othervalue > value
+                else:
+                    before = othervalue < value
+                break
+            if before:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _insert(self, order, entryid, sortkey, reverse):
+        if sortkey and not self.sortable(sortkey, self.entries[entryid]):
+            # Nothing to sort it by, so it goes last
+            order.append(entryid)
+            return
+        order.insert(self.bisect(order, entryid, sortkey, reverse), entryid)
+
+    def entry_added(self, entryid, entry):
+        self.positions[entryid] = len(self.ids)
+        self.ids.append(entryid)
+        for attribute, keys in self.keys.items():
+            keys.append(None)
+            self._set_key(attribute, entryid, entry[attribute])
+        for key, order in list(self.orders.items()):
+            try:
+                self._insert(order, entryid, *key)
+            except TypeError:
+                # Values that can't be compared, eg. a number and a string
+                del self.orders[key]
+
+    def value_changed(self, entryid, attribute, oldvalue, newvalue):
+        affected = [key for key in self.orders
+                    if any(a == attribute for a, _ in parse_sort_key(*key))]
+        if affected and attribute not in self.keys:
+            self._keys(attribute)
+            self._set_key(attribute, entryid, oldvalue)
+        # Take it out while the keys still have the old value...
+        for key in affected:
+            order = self.orders[key]
+            try:
+                n = self.bisect(order, entryid, *key)
+            except TypeError:
+                n = len(order)
+            if n >= len(order) or order[n] != entryid:
+                n = order.index(entryid)
+            del order[n]
+        if attribute in self.keys:
+            self._set_key(attribute, entryid, newvalue)
+        # ...and put it back with the new one
+        for key in affected:
+            try:
+                self._insert(self.orders[key], entryid, *key)
+            except TypeError:
+                del self.orders[key]
@@ -0,0 +1,102 @@
+from os.path import join
+import sys
+
+from libsyntyche.common import read_json, local_path
+
+
+_template = read_json(local_path(join('templates', 'defaultentry-meta.json')))
+
+# Attributes with a small set of values that are repeated over and over
+_categorical = {'rating', 'status', 'studio', 'type'}
+
+
+class Entry():
+    """
+    A compact entry with one slot per attribute in the entry template.
+
+    It behaves enough like a dict (entry[attr], entry[attr] = value,
+    iteration over the attribute names) that the rest of the code doesn't
+    have to care, but without the overhead of one dict per entry.
+    Attributes not in the template are kept in a separate dict.
+    """
+    __slots__ = tuple(_template) + ('_extra',)
+
+    def __init__(self, data=None):
+        self._extra = None
+        if data is not None:
+            for attribute, value in data.items():
+                self[attribute] = value
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create an entry from a dict, sharing the memory of repeated strings.
+        """
+        entry = cls()
+        for attribute, value in data.items():
+            if attribute in _categorical and isinstance(value, str):
+                value = sys.intern(value)
+            elif attribute == 'tags':
+                value = {sys.intern(t) for t in value}
+            entry[attribute] = value
+        return entry
+
+    def __getitem__(self, attribute):
+        # Only the slots, not methods or _extra
+        if attribute in _template:
+            try:
+                return getattr(self, attribute)
+            except AttributeError:
+                pass
+        if self._extra is not None and attribute in self._extra:
+            return self._extra[attribute]
+        raise KeyError(attribute)
+
+    def __setitem__(self, attribute, value):
+        if attribute in _template:
+            setattr(self, attribute, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[attribute] = value
+
+    def __contains__(self, attribute):
+        return attribute in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (Entry, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Entry({!r})'.format(self.to_dict())
+
+    def keys(self):
+        keys = [x for x in _template if hasattr(self, x)]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def items(self):
+        return [(x, self[x]) for x in self.keys()]
+
+    def values(self):
+        return [self[x] for x in self.keys()]
+
+    def get(self, attribute, default=None):
+        try:
+            return self[attribute]
+        except KeyError:
+            return default
+
+    def copy(self):
+        return Entry(self.to_dict())
+
+    def to_dict(self):
+        return dict(self.items())
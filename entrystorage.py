@@ -0,0 +1,385 @@
+import gzip
+import hashlib
+import json
+import os
+import os.path
+import pickle
+import tempfile
+import threading
+import time
+
+
+def write_atomic(path, data):
+    """
+    Write text or bytes to a file without ever leaving a half-written file
+    behind.
+
+    The data is written and synced to a temporary file in the same
+    directory which then replaces the real file.
+    """
+    dirname, fname = os.path.split(os.path.abspath(path))
+    fd, temppath = tempfile.mkstemp(prefix='.' + fname + '.', suffix='.tmp', dir=dirname)
+    try:
+        if isinstance(data, bytes):
+            f = os.fdopen(fd, 'wb')
+        else:
+            f = os.fdopen(fd, 'w', encoding='utf-8')
+        with f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temppath, path)
+    except BaseException:
+        os.remove(temppath)
+        raise
+    _sync_directory(dirname)
+
+
+def _sync_directory(dirname):
+    """
+    Make sure a rename in the directory has reached the disk.
+    """
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        # Not possible on all platforms
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def data_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_fingerprint(path, digest):
+    """
+    Return something that identifies the current contents of a file.
+
+    digest should be the data_digest() of the file's contents.
+    """
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size, digest)
+
+
+def write_checksummed(path, data):
+    """
+    Atomically write data (text or bytes) to a file and its checksum to a
+    file beside it. Return the written bytes.
+
+    The checksum file lists both the new and the old checksum while the
+    data file is being replaced, so a crash at any point leaves a data file
+    that matches one of them.
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    checksumpath = path + '.sha256'
+    digest = data_digest(data)
+    olddigests = _read_checksums(checksumpath) or []
+    write_atomic(checksumpath, '\n'.join([digest] + olddigests[:1]) + '\n')
+    write_atomic(path, data)
+    write_checksum(path, digest)
+    return data
+
+
+def write_checksum(path, digest):
+    """
+    Write only the checksum of a data file, eg. to accept a file that was
+    changed outside of nomia.
+    """
+    write_atomic(path + '.sha256', digest + '\n')
+
+
+def _read_checksums(checksumpath):
+    try:
+        with open(checksumpath, encoding='utf-8') as f:
+            return f.read().split()
+    except FileNotFoundError:
+        return None
+
+
+def verify_checksum(path, digest):
+    """
+    Check the digest of a data file against the checksum written with it.
+
+    Return True if it matches, False if it doesn't and None if the file
+    has no checksum (eg. if it was written by an older version).
+    """
+    checksums = _read_checksums(path + '.sha256')
+    if checksums is None:
+        return None
+    return digest in checksums
+
+
+class DataFileDamaged(Exception):
+    """
+    The data file can't be read and there is no intact backup of it.
+    """
+
+
+class BackupStore():
+    """
+    A directory of gzipped copies of a data file, named after the
+    data_digest() of their uncompressed contents.
+
+    Identical data is only stored once, and only the newest copies are
+    kept.
+    """
+    def __init__(self, directory, count):
+        self.directory = directory
+        self.count = count
+
+    def _backups(self):
+        """
+        Return the paths of all backups, newest first.
+        """
+        try:
+            fnames = [f for f in os.listdir(self.directory) if f.endswith('.json.gz')]
+        except FileNotFoundError:
+            return []
+        paths = [os.path.join(self.directory, f) for f in fnames]
+        return sorted(paths, key=os.path.getmtime, reverse=True)
+
+    def add(self, data, digest=None):
+        if self.count < 1:
+            return
+        if digest is None:
+            digest = data_digest(data)
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, digest + '.json.gz')
+        if os.path.exists(path):
+            # Already backed up, just mark it as the newest
+            os.utime(path)
+        else:
+            write_atomic(path, gzip.compress(data))
+        for oldpath in self._backups()[self.count:]:
+            os.remove(oldpath)
+
+    def newest_valid(self):
+        """
+        Return the contents of the newest backup that is still intact, or
+        None if there isn't one.
+        """
+        for path in self._backups():
+            try:
+                with open(path, 'rb') as f:
+                    data = gzip.decompress(f.read())
+            except (OSError, EOFError):
+                continue
+            if data_digest(data) + '.json.gz' == os.path.basename(path):
+                return data
+        return None
+
+
+class SnapshotCache():
+    """
+    A pickled copy of already parsed entries, to skip the slow JSON parsing
+    and conversion on startup.
+
+    The snapshot is tied to a fingerprint of the data file and is ignored
+    if the data file has changed since the snapshot was made.
+    """
+    # Bumped whenever the pickled entries change format (2: Entry records)
+    version = 2
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, fingerprint):
+        """
+        Return the entries in the snapshot, or None if there is no valid
+        snapshot for the fingerprint.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                header = pickle.load(f)
+                if header != {'version': self.version, 'fingerprint': fingerprint}:
+                    return None
+                return pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+
+    def save(self, fingerprint, pickledentries):
+        """
+        Write a new snapshot. pickledentries should be the result of
+        pickle.dumps() on the entries.
+        """
+        header = pickle.dumps({'version': self.version, 'fingerprint': fingerprint})
+        write_atomic(self.path, header + pickledentries)
+
+
+class EditJournal():
+    """
+    An append-only log of edits made to an entry list.
+
+    Every edit is stored as one line of JSON next to the data file, which is
+    a lot cheaper than rewriting the whole data file for every change. The
+    journal has to be replayed on top of the data when it is read, and
+    compacted into the data file every now and then.
+
+    All records set absolute values, so replaying a journal that has already
+    been (partly) compacted is harmless.
+    """
+    def __init__(self, path, default=None):
+        self.path = path
+        self.rotatedpath = path + '.old'
+        self.default = default
+
+    def append(self, records):
+        """
+        Add a list of records (dicts) to the end of the journal.
+        """
+        lines = ''.join(json.dumps(r, ensure_ascii=False, default=self.default) + '\n'
+                        for r in records)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+            f.flush()
+
+    def read(self):
+        """
+        Return a list of all records in the journal.
+
+        A broken last line (eg. from a crash in the middle of a write) is
+        ignored, but anything broken before that is an error.
+        """
+        records = []
+        for path in [self.rotatedpath, self.path]:
+            if os.path.exists(path):
+                records.extend(self._read_file(path))
+        return records
+
+    def _read_file(self, path):
+        with open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        records = []
+        for n, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                if n == len(lines) - 1:
+                    break
+                raise
+        return records
+
+    def is_empty(self):
+        """
+        Return True if there are no records that haven't been compacted.
+        """
+        return not self.size() and not os.path.exists(self.rotatedpath)
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def rotate(self):
+        """
+        Move the current records aside so new records go into a fresh file.
+
+        This should be done right before the data is serialized for a
+        compaction, and discard_rotated() called once the data has been
+        written. If the write fails, the rotated records are still there and
+        will be replayed.
+        """
+        if not os.path.exists(self.path):
+            return
+        if os.path.exists(self.rotatedpath):
+            with open(self.path, encoding='utf-8') as f:
+                text = f.read()
+            with open(self.rotatedpath, 'a', encoding='utf-8') as f:
+                f.write(text)
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.rotatedpath)
+
+    def discard_rotated(self):
+        if os.path.exists(self.rotatedpath):
+            os.remove(self.rotatedpath)
+
+    def clear(self):
+        for path in [self.path, self.rotatedpath]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class BackgroundWriter():
+    """
+    Write data to disk in a separate thread.
+
+    mark_dirty() tells the writer that the data has changed. The writer then
+    waits a short while before writing, so a burst of changes only results
+    in one write.
+
+    serialize is called in the writer thread and should return the full
+    text to write. It is responsible for any locking needed to get a
+    consistent snapshot of the data. The data is written with
+    write_checksummed(). on_written (optional) is called with the written
+    bytes after every successful write, and status_callback (optional) with
+    a short status message whenever a write starts, finishes or fails.
+    """
+    def __init__(self, path, serialize, on_written=None,
+                 status_callback=None, delay=0.5):
+        self.path = path
+        self.serialize = serialize
+        self.on_written = on_written
+        self.status_callback = status_callback
+        self.delay = delay
+        self._dirty = False
+        self._closing = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='nomia-writer',
+                                        daemon=True)
+        self._thread.start()
+
+    def mark_dirty(self):
+        with self._condition:
+            self._dirty = True
+            self._condition.notify()
+
+    def close(self):
+        """
+        Write any pending changes and stop the thread.
+        """
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _set_status(self, status):
+        if self.status_callback is not None:
+            self.status_callback(status)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._dirty and not self._closing:
+                    self._condition.wait()
+                if not self._dirty:
+                    return
+                # Give more changes a chance to pile up
+                deadline = time.monotonic() + self.delay
+                while not self._closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                self._dirty = False
+            self._write()
+
+    def _write(self):
+        self._set_status('Saving…')
+        try:
+            data = write_checksummed(self.path, self.serialize())
+            if self.on_written is not None:
+                self.on_written(data)
+        except Exception as e:
+            self._set_status('Save failed: {}'.format(e))
+        else:
+            self._set_status('Saved')
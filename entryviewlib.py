@@ -4,6 +4,8 @@ from abc import ABCMeta, abstractmethod
 
 from libsyntyche.common import read_json, write_json
 
+from entryindexes import SortOrders
+
 
 class EntryList(metaclass=ABCMeta):
     @abstractmethod
@@ -22,6 +24,27 @@ class EntryList(metaclass=ABCMeta):
     def set_entry_value(self, entryid, attribute, newvalue):
         pass
 
+    def filter_ids(self, filterexpression):
+        """
+        Return a set with the ids of the entries matching a compiled filter
+        expression, or None if the entry list can't do the filtering itself.
+        """
+        return None
+
+    def sorted_ids(self, attribute, reverse):
+        """
+        Return a list with all entry ids sorted by an attribute, or None if
+        the entry list can't do the sorting itself.
+        """
+        return None
+
+    def add_index(self, index):
+        """
+        Keep an EntryIndex up to date with all changes to the entries.
+        """
+        self.indexes.append(index)
+        index.rebuild(self.entries)
+
 
 class JSONEntryList(EntryList):
     def __init__(self):
@@ -74,10 +97,19 @@ class HTMLEntryView(EntryView):
                  stylesheetpath):
         self.entryelementid = entryelementid
         self.separatorelementid = separatorelementid
+        # One or more attributes, see entryindexes.parse_sort_key
         self.sortkey = ''
         self.sortreverse = False
+        # Optional function that returns the sorted entry ids (or None)
+        # when given the sort key and direction
+        self.sortprovider = None
+        # Optional entryindexes.SortOrders that is kept up to date by the
+        # entry list, so the entries don't have to be sorted every time
+        self.sortorders = None
         self.hiddenentries = set()
         self._entrynumbers = []
+        # Selector for the element with the entry's number, inside the entry
+        self.numberselector = '.id'
         self.webview = QtWebKit.QWebView(parent)
         self.webview.setDisabled(True)
         self.set_stylesheet(stylesheetpath)
@@ -92,22 +124,23 @@ class HTMLEntryView(EntryView):
     def set_stylesheet(self, path):
         self.webview.settings().setUserStyleSheetUrl(QtCore.QUrl('file:///{}'.format(path)))
 
+    def sorted_visible_ids(self, entries):
+        """
+        Return the ids of all visible entries in the order they are shown.
+        """
+        sortorders = self.sortorders
+        if sortorders is None:
+            # Nothing keeps it up to date, so it's only used this once
+            sortorders = SortOrders()
+            sortorders.rebuild(entries)
+        sortedids = sortorders.get(self.sortkey, self.sortreverse, self.sortprovider)
+        return [id_ for id_ in sortedids if id_ not in self.hiddenentries]
+
     def update_html(self, entries):
-        def key(entry):
-            id_, datadict = entry
-            if not self.sortkey:
-                return id_
-            else:
-                return datadict[self.sortkey]
-        sortedvisibleentries = [
-            (id_, datadict)
-            for id_, datadict in sorted(entries.items(), key=key, reverse=self.sortreverse)
-            if id_ not in self.hiddenentries
-        ]
-        self._entrynumbers = [id_ for id_, _ in sortedvisibleentries]
+        self._entrynumbers = self.sorted_visible_ids(entries)
         htmlentries = (
-            self.format_entry(n, id_, entry)
-            for n, (id_, entry) in enumerate(sortedvisibleentries)
+            self.format_entry(n, id_, entries[id_])
+            for n, id_ in enumerate(self._entrynumbers)
         )
         self.webview.setHtml(self.pagetemplate.format('\n'.join(htmlentries)))
 
@@ -130,15 +163,109 @@ class HTMLEntryView(EntryView):
     def get_entry_id(self, number):
         return self._entrynumbers[number]
 
-    def set_entry_data(self, entryid, data):
+    def _sorted_position(self, entryid, data):
+        """
+        Return where a visible entry belongs among the other visible
+        entries, or None if it's unknown (and it should stay put).
+        """
+        if self.sortorders is None or not self.sortorders.sortable(self.sortkey, data):
+            return None
+        ids = self._entrynumbers
+        pos = ids.index(entryid)
+        # The entry itself may be out of place, so search around it
+        newpos = self.sortorders.bisect(ids, entryid, self.sortkey, self.sortreverse, hi=pos)
+        if newpos < pos:
+            return newpos
+        return self.sortorders.bisect(ids, entryid, self.sortkey, self.sortreverse,
+                                      lo=pos+1) - 1
+
+    def set_entry_data(self, entryid, data, renumber=True):
+        """
+        Redraw an entry, moving it if its sort attribute changed.
+
+        Return the first position whose number changed, or None. If
+        renumber is False the caller has to call renumber() itself.
+        """
         eid = self.entryelementid.format(entryid)
         frame = self.webview.page().mainFrame()
         entryelement = frame.findFirstElement(eid)
-        html = self.format_entry(self._entrynumbers.index(entryid), entryid, data)
+        oldpos = self._entrynumbers.index(entryid)
+        newpos = self._sorted_position(entryid, data)
         sid = self.separatorelementid.format(entryid)
         separatorelement = frame.findFirstElement(sid)
         separatorelement.removeFromDocument()
-        entryelement.setOuterXml(html)
+        if newpos is None or newpos == oldpos:
+            entryelement.setOuterXml(self.format_entry(oldpos, entryid, data))
+            return None
+        # The sort attribute changed, so move it
+        entryelement.removeFromDocument()
+        del self._entrynumbers[oldpos]
+        self._entrynumbers.insert(newpos, entryid)
+        self._insert_entry_html(newpos, self.format_entry(newpos, entryid, data))
+        if renumber:
+            self.renumber(min(oldpos, newpos), max(oldpos, newpos) + 1)
+        return min(oldpos, newpos)
+
+    def _insert_entry_html(self, pos, html):
+        """
+        Add the html of the entry at pos in _entrynumbers to the page.
+        """
+        frame = self.webview.page().mainFrame()
+        if pos + 1 < len(self._entrynumbers):
+            nextid = self._entrynumbers[pos+1]
+            frame.findFirstElement(self.entryelementid.format(nextid)).prependOutside(html)
+        else:
+            frame.findFirstElement('body').appendInside(html)
+
+    def renumber(self, start, end=None):
+        """
+        Update the shown numbers of the entries from start up to end (or
+        the last one).
+        """
+        frame = self.webview.page().mainFrame()
+        end = len(self._entrynumbers) if end is None else end
+        for n in range(start, end):
+            eid = self.entryelementid.format(self._entrynumbers[n])
+            frame.findFirstElement(eid).findFirst(self.numberselector).setPlainText(str(n))
+
+    def hide_entry(self, entryid, renumber=True):
+        """
+        Hide a single entry without redrawing the others.
+
+        Return the position it was shown at, or None if it wasn't shown.
+        If renumber is False the caller has to call renumber() itself.
+        """
+        self.hiddenentries.add(entryid)
+        if entryid not in self._entrynumbers:
+            return None
+        pos = self._entrynumbers.index(entryid)
+        del self._entrynumbers[pos]
+        frame = self.webview.page().mainFrame()
+        frame.findFirstElement(self.entryelementid.format(entryid)).removeFromDocument()
+        frame.findFirstElement(self.separatorelementid.format(entryid)).removeFromDocument()
+        if renumber:
+            self.renumber(pos)
+        return pos
+
+    def show_entry(self, entryid, entries, renumber=True):
+        """
+        Show a single hidden entry in its place without redrawing the others.
+
+        Return the position it is shown at. If renumber is False the caller
+        has to call renumber() itself.
+        """
+        self.hiddenentries.discard(entryid)
+        entry = entries[entryid]
+        if self.sortorders is not None and self.sortorders.sortable(self.sortkey, entry):
+            pos = self.sortorders.bisect(self._entrynumbers, entryid,
+                                         self.sortkey, self.sortreverse)
+        else:
+            pos = self.sorted_visible_ids(entries).index(entryid)
+        self._entrynumbers.insert(pos, entryid)
+        self._insert_entry_html(pos, self.format_entry(pos, entryid, entry))
+        if renumber:
+            self.renumber(pos + 1)
+        return pos
 
 
     def format_entry(self, n, id_, entry):
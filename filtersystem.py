@@ -1,4 +1,11 @@
+from collections import OrderedDict
+import random
 import re
+import time
+
+from entryindexes import VersionCounter
+from tagvocabulary import wildcard_matcher
+from textindex import fuzzy_attributes, prepare_fuzzy, prepare_words, text_attributes
 
 
 def _match_tags_original(tag, oldtags, negative):
@@ -26,31 +33,31 @@ def _match_tags_original(tag, oldtags, negative):
     # Otherwise it's fine
     return True
 
-def match_tags(rawtag, oldtags):
+def prepare_tags(rawtag):
     """
-    See if the tag exists in oldtags.
+    Return a function that sees if the tag exists in a set of tags.
     """
     tag = rawtag.strip()
     if not tag:
-        if not oldtags:
-            return True
-        else:
-            return False
-    if '*' in tag:
-        rx = re.compile(tag.replace('*', '.+')+'$')
-        for t in oldtags:
-            if rx.match(t):
-                # If it exists, move on to next tag
-                break
-        else:
-            # If it doesn't exist, quit
+        def match(oldtags):
+            return not oldtags
+    elif '*' in tag:
+        matchtag = wildcard_matcher(tag)
+        def match(oldtags):
+            for t in oldtags:
+                if matchtag(t):
+                    return True
             return False
     else:
-        # If isn't there, quit
-        if tag not in oldtags:
-            return False
-    # Otherwise it's fine
-    return True
+        def match(oldtags):
+            return tag in oldtags
+    return match
+
+def match_tags(rawtag, oldtags):
+    """
+    See if the tag exists in oldtags.
+    """
+    return prepare_tags(rawtag)(oldtags)
 
 
 
@@ -65,20 +72,10 @@ def _handle_chunk(chunk, entrydata, matchfuncs):
     if not isinstance(chunk, str):
         return _parse(chunk, entrydata, matchfuncs)
     # Otherwise get on with it
-    negative = chunk.startswith('-')
-    chunk = chunk[negative:]
-    # Tags
-    # TODO: add a more generic way of having these kinds of special cases
-    if chunk.startswith('#'):
-        result = matchfuncs['tags'](chunk[1:], entrydata['tags'])
-    else:
-        try:
-            attribute, arg = re.fullmatch(r'(.+?):(.*)', chunk).groups()
-        except AttributeError:
-            raise SyntaxError('Invalid filter chunk: {}'.format(chunk))
-        if attribute not in entrydata:
-            raise SyntaxError('Unknown attribute: {}'.format(attribute))
-        result = matchfuncs[attribute](arg, entrydata[attribute])
+    negative, attribute, arg = _split_chunk(chunk)
+    if attribute not in entrydata:
+        raise SyntaxError('Unknown attribute: {}'.format(attribute))
+    result = matchfuncs[attribute](arg, entrydata[attribute])
     return not result if negative else result
 
 
@@ -87,10 +84,6 @@ def _parse(exp, entrydata, matchfuncs):
     """
     Parse the actual command to see if it matches the tags.
     """
-    #def handle(x):
-    #    """ Match x if it's a tag, otherwise parse it as an expression """
-    #    return (_match if isinstance(x, str) else _parse)(x, oldtags)
-
     if exp[0] is None and len(exp) == 2:
         return _handle_chunk(exp[1], entrydata, matchfuncs)
     elif exp[0] == 'AND':
@@ -107,14 +100,448 @@ def _parse(exp, entrydata, matchfuncs):
         raise SyntaxError('Invalid expression')
 
 
-#def match_tag_filter(tag_filter, oldtags):
-#    return _parse(tag_filter, oldtags)
+def interpret_filter(filterexp, entrydata, matchfuncs):
+    """
+    Match an entry against an uncompiled filter expression.
 
-def run_filter(filterexp, entrydata, matchfuncs):
+    This parses the whole expression again for every entry, so use
+    compile_filter and run_filter when filtering more than one entry.
+    """
     return _parse(filterexp, entrydata, matchfuncs)
 
 
 
+# COMPILED FILTERS
+
+def _split_chunk(chunk):
+    """
+    Return a tuple with the negation, attribute and argument of a chunk.
+    """
+    negative = chunk.startswith('-')
+    chunk = chunk[negative:]
+    # Tags
+    # TODO: add a more generic way of having these kinds of special cases
+    if chunk.startswith('#'):
+        return negative, 'tags', chunk[1:]
+    # Word search in all text attributes
+    if chunk.startswith('~'):
+        return negative, 'text', chunk[1:]
+    rx = re.fullmatch(r'(.+?):(.*)', chunk)
+    if rx is None:
+        raise SyntaxError('Invalid filter chunk: {}'.format(chunk))
+    attribute, arg = rx.groups()
+    return negative, attribute, arg
+
+
+class FilterNode():
+    """
+    A node in a compiled filter expression.
+
+    op is 'AND', 'OR' or 'CHUNK'. AND and OR nodes have their compiled
+    subexpressions in children, and chunks have the attribute, argument and
+    negation they were compiled from, and the predicate that checks a
+    value of the attribute (ignoring the negation). match is a function
+    that takes an entry and returns whether it matches the node.
+
+    Compiled filter macros (see ExpressionCache) are chunks with the
+    attribute '@', the macro's name as argument and the macro's compiled
+    filter as their only child.
+    """
+    __slots__ = ('op', 'children', 'attribute', 'arg', 'negative', 'predicate',
+                 'match')
+
+    def __init__(self, op, match, children=(), attribute=None, arg=None,
+                 negative=False, predicate=None):
+        self.op = op
+        self.match = match
+        self.children = children
+        self.attribute = attribute
+        self.arg = arg
+        self.negative = negative
+        self.predicate = predicate
+
+    def __repr__(self):
+        if self.op == 'CHUNK':
+            return 'FilterNode({}{}:{})'.format('-' * self.negative,
+                                                self.attribute, self.arg)
+        return 'FilterNode({}, {})'.format(self.op, list(self.children))
+
+
+def _compile_chunk(chunk, preparefuncs, shared):
+    if not isinstance(chunk, str):
+        return _compile(chunk, preparefuncs, shared)
+    negative, attribute, arg = _split_chunk(chunk)
+    if attribute == 'text':
+        # This looks at several attributes, so it gets the whole entry
+        predicate = prepare_words(arg)
+        match = (lambda entry: not predicate(entry)) if negative else predicate
+        return FilterNode('CHUNK', match, attribute=attribute, arg=arg,
+                          negative=negative, predicate=predicate)
+    if attribute.endswith('~'):
+        # Fuzzy search, matched against the attribute without the ~
+        valueattribute = attribute[:-1]
+        if valueattribute not in fuzzy_attributes:
+            raise SyntaxError('Fuzzy search only works with: {}'.format(
+                ', '.join(fuzzy_attributes)))
+        prepare = prepare_fuzzy
+    elif attribute in preparefuncs:
+        valueattribute = attribute
+        prepare = preparefuncs[attribute]
+    else:
+        raise SyntaxError('Unknown attribute: {}'.format(attribute))
+    predicate = prepare(arg)
+    if negative:
+        def match(entry):
+            return not predicate(entry[valueattribute])
+    else:
+        def match(entry):
+            return predicate(entry[valueattribute])
+    return FilterNode('CHUNK', match, attribute=attribute, arg=arg, negative=negative,
+                      predicate=predicate)
+
+
+def _compile(exp, preparefuncs, shared):
+    if shared and exp in shared:
+        return shared[exp]
+    if exp[0] is None and len(exp) == 2:
+        return _compile_chunk(exp[1], preparefuncs, shared)
+    elif exp[0] in ('AND', 'OR'):
+        children = tuple(_compile_chunk(e, preparefuncs, shared) for e in exp[1:])
+        return _combine(exp[0], children)
+    else:
+        raise SyntaxError('Invalid expression')
+
+
+def _combine(op, children):
+    """
+    Return an AND or OR node with the children.
+    """
+    funcs = tuple(c.match for c in children)
+    if len(funcs) == 1:
+        match = funcs[0]
+    elif op == 'AND':
+        def match(entry):
+            for f in funcs:
+                if not f(entry):
+                    return False
+            return True
+    else:
+        def match(entry):
+            for f in funcs:
+                if f(entry):
+                    return True
+            return False
+    return FilterNode(op, match, children=children)
+
+
+def compile_filter(filterexp, preparefuncs, shared=None):
+    """
+    Compile a filter expression (from compile_tag_filter) into a tree of
+    FilterNodes.
+
+    preparefuncs maps every attribute to a function that takes a match
+    argument and returns a predicate for the attribute's value (eg.
+    entryfunctions.prepare_int). All parsing, including the arguments,
+    happens here, so any syntax error is raised before a single entry is
+    matched.
+
+    shared optionally maps subexpressions to already compiled nodes
+    (eg. ExpressionCache.shared), which are used instead of compiling
+    them again.
+    """
+    return _compile(filterexp, preparefuncs, shared)
+
+
+def run_filter(compiledfilter, entrydata):
+    """
+    Return True if the entry matches a compiled filter.
+    """
+    return compiledfilter.match(entrydata)
+
+
+def chunk_text(chunk):
+    """
+    Return a compiled chunk as it would be written in a filter.
+    """
+    if chunk.attribute == 'tags':
+        text = '#' + chunk.arg
+    elif chunk.attribute == 'text':
+        text = '~' + chunk.arg
+    elif chunk.attribute == '@':
+        text = '@' + chunk.arg
+    else:
+        text = '{}:{}'.format(chunk.attribute, chunk.arg)
+    return '-' + text if chunk.negative else text
+
+
+def filter_expression(compiledfilter):
+    """
+    Return a filter expression in the same format as compile_tag_filter,
+    that compiles into the same filter (with its subexpressions in the
+    same order).
+    """
+    if compiledfilter.op == 'CHUNK':
+        if compiledfilter.attribute == '@':
+            # Expand macros, so nothing else is needed to compile it
+            return filter_expression(compiledfilter.children[0])
+        return (None, chunk_text(compiledfilter))
+    children = []
+    for child in compiledfilter.children:
+        expression = filter_expression(child)
+        children.append(expression[1] if expression[0] is None else expression)
+    return (compiledfilter.op,) + tuple(children)
+
+
+# EVALUATION WITH INDEXES
+
+def index_usage(node, indexes):
+    """
+    Return 'all' if every chunk in the node has an index, 'none' if no chunk
+    has one, and 'some' otherwise.
+    """
+    if node.op == 'CHUNK':
+        return 'all' if node.attribute in indexes else 'none'
+    usage = {index_usage(c, indexes) for c in node.children}
+    return usage.pop() if len(usage) == 1 else 'some'
+
+
+def _scan(match, candidates, entries, excluded=frozenset()):
+    """
+    Return the candidate ids whose entries match and aren't excluded.
+    None means that all entries are candidates.
+    """
+    if candidates is None:
+        return {k for k, entry in entries.items() if k not in excluded and match(entry)}
+    return {k for k in candidates if k not in excluded and match(entries[k])}
+
+
+def _evaluate(node, candidates, entries, indexes):
+    """
+    Return a new set with the candidate ids that match the node.
+    None means that all entries are candidates.
+    """
+    if node.op == 'CHUNK':
+        index = indexes.get(node.attribute)
+        ids = index.find(node.arg) if index is not None else None
+        if ids is None:
+            return _scan(node.match, candidates, entries)
+        if candidates is None:
+            if not node.negative:
+                return set(ids)
+            candidates = entries.keys()
+        if node.negative:
+            return set(candidates) - ids
+        if len(ids) < len(candidates):
+            return set(ids).intersection(candidates)
+        return set(candidates).intersection(ids)
+    usage = {c: index_usage(c, indexes) for c in node.children}
+    if node.op == 'OR':
+        if any(u != 'all' for u in usage.values()):
+            # The entries have to be looked at anyway
+            return _scan(node.match, candidates, entries)
+        result = set()
+        for child in node.children:
+            result |= _evaluate(child, candidates, entries, indexes)
+        return result
+    rest = [c for c in node.children if usage[c] != 'all']
+    excluded = set()
+    for child in node.children:
+        if usage[child] != 'all':
+            continue
+        if rest and child.op == 'CHUNK' and child.negative:
+            # Check these while scanning instead of copying all other ids
+            ids = indexes[child.attribute].find(child.arg)
+            if ids is not None:
+                excluded |= ids
+                continue
+        candidates = _evaluate(child, candidates, entries, indexes)
+        if not candidates:
+            return set()
+    if not rest:
+        return candidates
+    if candidates is not None and 2 * len(candidates) <= len(entries):
+        # Few enough left that the mixed subexpressions can use their
+        # indexes, and then everything else is matched in one pass
+        for child in [c for c in rest if usage[c] == 'some']:
+            candidates = _evaluate(child, candidates, entries, indexes) - excluded
+            if not candidates:
+                return set()
+        rest = [c for c in rest if usage[c] == 'none']
+        if not rest:
+            return candidates - excluded
+    return _scan(_combine('AND', rest).match, candidates, entries, excluded)
+
+
+def evaluate_filter(compiledfilter, entries, indexes):
+    """
+    Return a set with the ids of all entries that match a compiled filter.
+
+    indexes maps attributes to indexes with a find(arg) method, that
+    returns a set with the ids of the entries matching a chunk's argument,
+    or None if it can't answer it. Chunks are answered by the indexes
+    where possible and combined with set operations, and the rest are only
+    matched against the entries that can still match.
+    """
+    if index_usage(compiledfilter, indexes) == 'none':
+        return _scan(compiledfilter.match, None, entries)
+    return _evaluate(compiledfilter, None, entries, indexes)
+
+
+# PLANNING
+
+class FilterPlanner():
+    """
+    Reorder the subexpressions of compiled filters so the ones that are
+    cheap and most likely to decide the result are matched first.
+
+    The cost of matching each attribute is measured on a sample of the
+    entries and kept as a running estimate. How many entries a chunk
+    matches is counted with the indexes where possible (tag frequencies and
+    sorted values, through their count(arg) methods) and estimated from
+    the sample otherwise.
+
+    If versions (the VersionCounter added to the entry list) is given, the
+    costs and selectivities are kept until an attribute they depend on
+    changes, so the same filter gets the same plan without being timed
+    again.
+    """
+    samplesize = 200
+
+    def __init__(self, entries, indexes, versions=None):
+        self.entries = entries
+        self.indexes = indexes
+        self.versions = versions
+        # cost key (see _cost_key) -> (version, seconds per entry)
+        self.costs = {}
+        # (attribute, arg, negative) -> (version, selectivity)
+        self.selectivities = {}
+        self.estimates = {}
+        self.sample = []
+        self.samplebase = 0
+        self.overhead = 0
+
+    def _update_sample(self):
+        # Only resample when the number of entries has changed noticeably
+        total = len(self.entries)
+        if self.sample and abs(total - self.samplebase) * 10 <= total:
+            return
+        entries = list(self.entries.values())
+        self.sample = random.Random(0).sample(entries, min(total, self.samplesize))
+        self.samplebase = total
+        self.overhead = self._time(lambda entry: False)
+
+    def _time(self, match):
+        """
+        Return the fastest of a few timings of matching all of the sample.
+        """
+        sample = self.sample
+        best = float('inf')
+        for _ in range(3):
+            start = time.perf_counter()
+            for entry in sample:
+                match(entry)
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    def _cost_key(self, node):
+        # Macros and searches cost very different amounts depending on
+        # what they look for, other chunks mostly depend on the attribute
+        if node.attribute in ('@', 'text') or node.attribute.endswith('~'):
+            return (node.attribute, node.arg)
+        return node.attribute
+
+    def _version(self, node):
+        if self.versions is None:
+            return None
+        return self.versions.last_change(filter_attributes(node))
+
+    def _estimate_chunk(self, node):
+        """
+        Return the estimated cost (seconds per entry) and selectivity (the
+        fraction of entries that match) of a chunk.
+        """
+        version = self._version(node)
+        sample = self.sample
+        costkey = self._cost_key(node)
+        cached = self.costs.get(costkey)
+        if cached is not None and version is not None and cached[0] == version:
+            cost = cached[1]
+        else:
+            # Not counting the loop itself, which is the same for every chunk
+            cost = max(self._time(node.match) - self.overhead, 0) / max(len(sample), 1)
+            if cached is not None:
+                cost = (cached[1] + cost) / 2
+            self.costs[costkey] = (version, cost)
+        selectivitykey = (node.attribute, node.arg, node.negative)
+        cached = self.selectivities.get(selectivitykey)
+        if cached is not None and version is not None and cached[0] == version:
+            return cost, cached[1]
+        index = self.indexes.get(node.attribute)
+        count = index.count(node.arg) if index is not None and self.entries else None
+        if count is not None:
+            selectivity = count / len(self.entries)
+            if node.negative:
+                selectivity = 1 - selectivity
+        elif sample:
+            selectivity = sum(1 for entry in sample if node.match(entry)) / len(sample)
+        else:
+            selectivity = 0.5
+        self.selectivities[selectivitykey] = (version, selectivity)
+        return cost, selectivity
+
+    def _plan(self, node):
+        if node.op == 'CHUNK':
+            self.estimates[node] = self._estimate_chunk(node)
+            return node
+        children = [self._plan(c) for c in node.children]
+        estimates = self.estimates
+        if node.op == 'AND':
+            # Cheap chunks that rule out many entries first
+            def rank(child):
+                cost, selectivity = estimates[child]
+                return cost / (1 - selectivity) if selectivity < 1 else float('inf')
+        else:
+            # Cheap chunks that let many entries through first
+            def rank(child):
+                cost, selectivity = estimates[child]
+                return cost / selectivity if selectivity > 0 else float('inf')
+        children.sort(key=rank)
+        cost = 0
+        passing = 1
+        for child in children:
+            childcost, selectivity = estimates[child]
+            cost += passing * childcost
+            passing *= selectivity if node.op == 'AND' else 1 - selectivity
+        planned = _combine(node.op, tuple(children))
+        estimates[planned] = (cost, passing if node.op == 'AND' else 1 - passing)
+        return planned
+
+    def plan(self, compiledfilter):
+        """
+        Return a compiled filter that matches the same entries, with the
+        subexpressions of every AND and OR in the order that should be the
+        fastest to match.
+        """
+        self._update_sample()
+        self.estimates = {}
+        return self._plan(compiledfilter)
+
+    def explain(self, plannedfilter):
+        """
+        Return a one-line description of a planned filter (from the latest
+        call to plan()) in the order it's matched, with the estimated
+        selectivity and cost of every chunk.
+        """
+        cost, selectivity = self.estimates[plannedfilter]
+        if plannedfilter.op == 'CHUNK':
+            method = 'index' if plannedfilter.attribute in self.indexes else 'scan'
+            return '{} [{:.0%}, {:.2f} µs, {}]'.format(
+                chunk_text(plannedfilter), selectivity, cost * 1e6, method)
+        separator = ', ' if plannedfilter.op == 'AND' else ' | '
+        return '(' + separator.join(self.explain(c) for c in plannedfilter.children) + ')'
+
+
+
 def filter_text(attribute, payload, entries):
     """
     Return a tuple with the entries that include the specified text
@@ -166,4 +593,234 @@ def sort_entries(entries, attribute, reverse):
 
 def generate_visible_entries(entries, filters, attributedata, sort_by, reverse, tagmacros):
     filtered_entries = filter_entries(entries, filters, attributedata, tagmacros)
-    return sort_entries(filtered_entries, sort_by, reverse)
\ No newline at end of file
+    return sort_entries(filtered_entries, sort_by, reverse)
+
+
+# CACHING
+
+def normalize_filter(filterexp):
+    """
+    Return a filter expression (from compile_tag_filter) in a form where
+    expressions that only differ in whitespace or in the order of their
+    subexpressions are equal.
+    """
+    if isinstance(filterexp, str):
+        return filterexp.strip()
+    if filterexp[0] is None:
+        return normalize_filter(filterexp[1])
+    children = sorted((normalize_filter(x) for x in filterexp[1:]), key=repr)
+    return (filterexp[0],) + tuple(children)
+
+
+def filter_attributes(compiledfilter):
+    """
+    Return a set with all attributes a compiled filter looks at.
+    """
+    if compiledfilter.op == 'CHUNK':
+        if compiledfilter.attribute == 'text':
+            return set(text_attributes)
+        if compiledfilter.attribute == '@':
+            return filter_attributes(compiledfilter.children[0])
+        return {compiledfilter.attribute.rstrip('~')}
+    return set().union(*(filter_attributes(c) for c in compiledfilter.children))
+
+
+def search_chunks(compiledfilter):
+    """
+    Return a list with all word search (~words) and fuzzy search
+    (attribute~:query) chunks that aren't negated, which the results can
+    be ranked by.
+    """
+    if compiledfilter.op == 'CHUNK':
+        if compiledfilter.attribute == '@':
+            return search_chunks(compiledfilter.children[0])
+        if (compiledfilter.attribute == 'text' or compiledfilter.attribute.endswith('~')) \
+                and not compiledfilter.negative:
+            return [compiledfilter]
+        return []
+    return [chunk for c in compiledfilter.children for chunk in search_chunks(c)]
+
+
+class FilterCache():
+    """
+    Remember the results of the latest filters.
+
+    The results are keyed on the normalized filter expression, with the
+    least recently used ones thrown out when there are more than size of
+    them. versions should be added to the entry list as an index, and a
+    result is only used if none of the attributes in its filter has
+    changed since it was stored.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.versions = VersionCounter()
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filterexp, compiledfilter):
+        """
+        Return the cached set of matching ids or None.
+        """
+        key = normalize_filter(filterexp)
+        item = self.results.get(key)
+        if item is not None:
+            version, result = item
+            if self.versions.last_change(filter_attributes(compiledfilter)) <= version:
+                self.results.move_to_end(key)
+                self.hits += 1
+                return result
+            del self.results[key]
+        self.misses += 1
+        return None
+
+    def put(self, filterexp, result):
+        if self.size <= 0:
+            return
+        key = normalize_filter(filterexp)
+        self.results[key] = (self.versions.version, result)
+        self.results.move_to_end(key)
+        self.set_size(self.size)
+
+    def set_size(self, size):
+        self.size = size
+        while len(self.results) > max(size, 0):
+            self.results.popitem(last=False)
+
+    def stats(self):
+        """
+        Return a one-line summary of the cache.
+        """
+        lookups = self.hits + self.misses
+        return 'Filter cache: {}/{} results, {} hits, {} misses ({:.0%} hit rate)'.format(
+            len(self.results), self.size, self.hits, self.misses,
+            self.hits / lookups if lookups else 0)
+
+
+class ExpressionCache():
+    """
+    Remember parsed filter expressions, and compile the filter macros once
+    so every filter using a macro shares the same compiled node.
+
+    parse is the function that parses (and expands the macros in) a
+    filter, ie. compile_tag_filter. The parsed expressions are keyed on
+    the filter and the macros, with the least recently used ones thrown
+    out when there are more than size of them.
+    """
+    def __init__(self, parse, size=128):
+        self.parse = parse
+        self.size = size
+        self.expressions = OrderedDict()
+        self.macros = {}
+        self.macrokey = None
+        # Expanded macro expression -> compiled macro chunk
+        self.shared = {}
+        # Macro name -> compiled macro chunk
+        self.compiled = {}
+
+    def set_macros(self, macros, preparefuncs):
+        """
+        Compile the macros, unless they are the same as before. Return
+        True if they changed.
+        """
+        macrokey = hash(tuple(sorted(macros.items())))
+        if macrokey == self.macrokey:
+            return False
+        self.macrokey = macrokey
+        self.macros = dict(macros)
+        self.expressions.clear()
+        self.shared = {}
+        self.compiled = {}
+        expanded = {}
+        for name in macros:
+            try:
+                expression = self.parse('@' + name, self.macros)
+            except SyntaxError:
+                # Broken macros only give an error when they are used
+                continue
+            # The macro's own group, as it is in the filters using it
+            while expression[0] is None and not isinstance(expression[1], str):
+                expression = expression[1]
+            expanded[name] = expression
+        # Smaller ones first, so macros using other macros share them
+        for name, expression in sorted(expanded.items(), key=lambda x: len(repr(x[1]))):
+            if expression[0] not in ('AND', 'OR'):
+                # Single chunks are as fast as they get already
+                continue
+            if expression not in self.shared:
+                try:
+                    compiled = compile_filter(expression, preparefuncs, self.shared)
+                except SyntaxError:
+                    continue
+                self.shared[expression] = FilterNode('CHUNK', compiled.match,
+                                                     children=(compiled,), attribute='@',
+                                                     arg=name)
+            self.compiled[name] = self.shared[expression]
+        return True
+
+    def get(self, filtertext):
+        """
+        Return the parsed and macro expanded filter expression.
+        """
+        key = (filtertext, self.macrokey)
+        expression = self.expressions.get(key)
+        if expression is None:
+            expression = self.parse(filtertext, self.macros)
+            self.expressions[key] = expression
+            while len(self.expressions) > self.size:
+                self.expressions.popitem(last=False)
+        self.expressions.move_to_end(key)
+        return expression
+
+
+class MacroResults():
+    """
+    The ids matching each compiled filter macro, computed once and reused
+    by all filters until an attribute the macro looks at has changed.
+
+    This works like an index for '@' chunks, with the macros from an
+    ExpressionCache. It should be in indexes under '@' itself, so macros
+    using other macros can use it too. versions is the VersionCounter
+    added to the entry list.
+    """
+    def __init__(self, expressioncache, versions, entries, indexes):
+        self.expressioncache = expressioncache
+        self.versions = versions
+        self.entries = entries
+        self.indexes = indexes
+        # macro name -> (compiled macro, version, ids)
+        self.results = {}
+
+    def find(self, arg):
+        """
+        Return the set of ids matching the macro, which must not be changed.
+        """
+        macro = self.expressioncache.compiled.get(arg)
+        if macro is None:
+            return None
+        if self._fresh(arg, macro):
+            return self.results[arg][2]
+        version = self.versions.version
+        ids = evaluate_filter(macro.children[0], self.entries, self.indexes)
+        self.results[arg] = (macro, version, ids)
+        return ids
+
+    def _fresh(self, arg, macro):
+        cached = self.results.get(arg)
+        # A redefined macro is compiled into a new node
+        return cached is not None and cached[0] is macro \
+            and self.versions.last_change(filter_attributes(macro.children[0])) <= cached[1]
+
+    def count(self, arg):
+        """
+        Return how many entries match the macro, or None if that isn't
+        known without matching them again. Only used for planning, which
+        shouldn't cost as much as filtering.
+        """
+        macro = self.expressioncache.compiled.get(arg)
+        if macro is None or not self._fresh(arg, macro):
+            return None
+        return len(self.results[arg][2])
+
+    def clear(self):
+        self.results.clear()
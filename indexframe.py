@@ -1,9 +1,12 @@
 from collections import Counter
 from collections.abc import Set
 from datetime import datetime
+import json
 from operator import attrgetter
 from os.path import join
+import pickle
 import re
+import threading
 import webbrowser
 
 import requests
@@ -16,33 +19,186 @@ from libsyntyche.tagsystem import compile_tag_filter
 from libsyntyche.terminal import GenericTerminalInputBox, GenericTerminalOutputBox, GenericTerminal
 
 from autocompletion import AutoCompleter
-from filtersystem import run_filter, match_tags
+from filtersystem import compile_filter, evaluate_filter, index_usage, run_filter,\
+        filter_expression, prepare_tags, search_chunks, ExpressionCache, FilterCache, FilterPlanner,\
+        MacroResults
 from entryviewlib import HTMLEntryView, EntryList
 from entryfunctions import *
+from entrystorage import BackgroundWriter, BackupStore, DataFileDamaged, EditJournal,\
+        SnapshotCache, data_digest, file_fingerprint, verify_checksum, write_atomic,\
+        write_checksum, write_checksummed
+from sqliteentrylist import SQLiteEntryList
+from parallelfilter import ParallelFilter
+from shardedentrylist import ShardedEntryList
+from textindex import fuzzy_attributes, text_attributes, FuzzyIndex, TextIndex, TextSearch
+from entryrecord import Entry
+from undohistory import UndoHistory
+from entryindexes import parse_sort_key, IdAllocator, SortedIndex, SortOrders, TagIndex,\
+        ValueIndex
+import columnarindex
 import malapi
 
-class NomiaEntryList():
+class NomiaEntryList(EntryList):
 
-    def __init__(self, dryrun):
+    def __init__(self, dryrun, status_callback=None):
         self.dateformat = '%Y-%m-%d'
+        self.dateattributes = ['airing_started', 'airing_finished',
+                               'watching_started', 'watching_finished']
         self.dryrun = dryrun
+        self.status_callback = status_callback
+        self.usejournal = True
+        self.journalthreshold = 2**20
+        self.journal = None
+        self.usesnapshot = True
+        self.snapshot = None
+        self.backupcount = 10
+        self.backups = None
+        self._pendingsnapshot = None
+        self.writer = None
+        self.undobudget = 2**24
+        self.persistentundo = False
+        self.history = None
+        self.entries = {}
+        self.idallocator = IdAllocator()
+        self.malidindex = ValueIndex('mal_id')
+        # Kept up to date on every change to the entries
+        self.indexes = [self.idallocator, self.malidindex]
+        # Held while changing the entries, so the writer thread always
+        # gets a consistent snapshot
+        self.lock = threading.RLock()
+
+    def update_settings(self, settings):
+        self.usejournal = settings['journal edits']
+        self.journalthreshold = settings['journal compaction threshold']
+        self.usesnapshot = settings['snapshot cache']
+        self.backupcount = settings['backup count']
+        if self.backups is not None:
+            self.backups.count = self.backupcount
+        self.undobudget = settings['undo memory budget']
+        self.persistentundo = settings['persistent undo history']
+        if self.history is not None:
+            self.history.budget = self.undobudget
 
     def set_datapath(self, datapath):
+        if self.writer is not None:
+            self.close()
         self.datapath = datapath
-        self.entries = self.read_data(datapath)
-        self.undostack = []
+        self.journal = EditJournal(datapath + '.journal',
+                                   default=self.nonstandard_data_to_json)
+        self.snapshot = SnapshotCache(datapath + '.snapshot')
+        self.backups = BackupStore(datapath + '.backups', self.backupcount)
+        try:
+            self.entries = self.read_data(datapath)
+        except DataFileDamaged as e:
+            # Keep whatever is left of the data file for manual recovery,
+            # by never writing anything over it
+            if self.status_callback is not None:
+                self.status_callback('{} – nothing will be saved'.format(e))
+            self.entries = {}
+            self.dryrun = True
+            self.writer = None
+        if not self.dryrun:
+            self.writer = BackgroundWriter(datapath, self.serialize_data,
+                                           on_written=self.data_written,
+                                           status_callback=self.status_callback)
+        for index in self.indexes:
+            index.rebuild(self.entries)
+        undopath = datapath + '.undo' if self.persistentundo and not self.dryrun else None
+        self.history = UndoHistory(self.undobudget, path=undopath,
+                                   default=self.nonstandard_data_to_json,
+                                   parse_value=self.parse_value)
+        if not self.usejournal:
+            self.compact_journal()
 
     def read_data(self, datapath):
-        data = read_json(datapath)
-        dateattributes = ['airing_started', 'airing_finished', 'watching_started', 'watching_finished']
-        for entry in data.values():
-            for x in dateattributes:
-                if entry[x] is not None:
-                    entry[x] = datetime.strptime(entry[x], self.dateformat).date()
-            entry['tags'] = set(entry['tags'])
+        with open(datapath, 'rb') as f:
+            rawdata = f.read()
+        digest = data_digest(rawdata)
+        checksum = verify_checksum(datapath, digest)
+        data = None
+        if self.usesnapshot:
+            data = self.snapshot.load(file_fingerprint(datapath, digest))
+        # Parse the JSON if the snapshot is missing or out of date
+        if data is None:
+            try:
+                jsondata = json.loads(rawdata.decode('utf-8'))
+            except ValueError:
+                # Only a file that can't be parsed (eg. a truncated one)
+                # is damaged, whatever its checksum says
+                rawdata, digest = self.recover_data(datapath, rawdata)
+                jsondata = json.loads(rawdata.decode('utf-8'))
+                checksum = True
+            data = {entryid: self.parse_entry(entry)
+                    for entryid, entry in jsondata.items()}
+            if self.usesnapshot and not self.dryrun:
+                self.snapshot.save(file_fingerprint(datapath, digest),
+                                   pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        if checksum is False:
+            # Changed outside of nomia (eg. by hand or by
+            # generatelocalanimelist.py), which is fine since it's intact
+            if not self.dryrun:
+                write_checksum(datapath, digest)
+            if self.status_callback is not None:
+                self.status_callback('The data file was changed outside of nomia')
+        if not self.dryrun:
+            self.backups.add(rawdata, digest)
+        # Replay any edits that haven't been compacted into the main file yet
+        skipped = 0
+        for record in self.journal.read():
+            if 'entry' in record:
+                data[record['id']] = self.parse_entry(record['entry'])
+            elif record['id'] in data:
+                data[record['id']][record['attribute']] = \
+                        self.parse_value(record['attribute'], record['value'])
+            else:
+                # Edits of entries added after the backup that was recovered
+                skipped += 1
+        if skipped and self.status_callback is not None:
+            self.status_callback('Skipped {} journaled edits of unknown entries'.format(skipped))
         return data
 
+    def recover_data(self, datapath, damageddata):
+        """
+        Replace a damaged data file with the newest intact backup. The
+        damaged data is kept beside it, in case the backup is old.
+
+        Return the raw data and its digest.
+        """
+        rawdata = self.backups.newest_valid()
+        if rawdata is None:
+            raise DataFileDamaged('The data file is damaged and there is '
+                                  'no backup to recover from: {}'.format(datapath))
+        if not self.dryrun:
+            write_atomic(datapath + '.damaged', damageddata)
+            write_checksummed(datapath, rawdata)
+        if self.status_callback is not None:
+            self.status_callback('The data file was damaged and has been recovered '
+                                 'from the newest backup (the damaged file is kept '
+                                 'as {}.damaged)'.format(datapath))
+        return rawdata, data_digest(rawdata)
+
+    def parse_value(self, attribute, value):
+        """
+        Convert a value from its JSON form to the one used in the entries.
+        """
+        if attribute in self.dateattributes:
+            if value is not None:
+                return datetime.strptime(value, self.dateformat).date()
+        elif attribute == 'tags':
+            return set(value)
+        return value
+
+    def parse_entry(self, entry):
+        """
+        Convert an entry from its JSON form to an Entry.
+        """
+        for x in self.dateattributes + ['tags']:
+            entry[x] = self.parse_value(x, entry[x])
+        return Entry.from_dict(entry)
+
     def nonstandard_data_to_json(self, obj):
+        if isinstance(obj, Entry):
+            return obj.to_dict()
         try:
             datestring = obj.strftime(self.dateformat)
         except AttributeError:
@@ -53,43 +209,144 @@ class NomiaEntryList():
             return list(obj)
         raise TypeError
 
+    def serialize_data(self):
+        """
+        Return all entries as JSON. Any journaled edits are included in the
+        result, so the journal is rotated at the same time.
+        """
+        # Only copying the entries holds up edits in the main thread, not
+        # serializing them. The values themselves are replaced, never
+        # changed, on edits, so they don't need to be copied.
+        with self.lock:
+            self.journal.rotate()
+            entries = {entryid: entry.copy() for entryid, entry in self.entries.items()}
+        if self.usesnapshot:
+            self._pendingsnapshot = pickle.dumps(entries, pickle.HIGHEST_PROTOCOL)
+        return json.dumps(entries, ensure_ascii=False, indent=2,
+                          sort_keys=True, default=self.nonstandard_data_to_json)
+
+    def data_written(self, data):
+        """
+        Clean up after all data has been written to the data file.
+
+        data should be the bytes that were written.
+        """
+        self.journal.discard_rotated()
+        digest = data_digest(data)
+        self.backups.add(data, digest)
+        if self._pendingsnapshot is not None:
+            fingerprint = file_fingerprint(self.datapath, digest)
+            self.snapshot.save(fingerprint, self._pendingsnapshot)
+            self._pendingsnapshot = None
+
     def write_data(self, datapath):
+        """
+        Write all data right away, without going through the writer thread.
+        """
         if self.dryrun:
             return
-        write_json(datapath, self.entries,
-                   default=self.nonstandard_data_to_json)
+        self.data_written(write_checksummed(datapath, self.serialize_data()))
+
+    def save_changes(self, records):
+        """
+        Persist a list of changes, either by appending them to the journal
+        or by having the writer thread write all data if the journal is
+        turned off.
+
+        This has to be called with the lock held.
+        """
+        if self.dryrun:
+            return
+        if not self.usejournal:
+            self.writer.mark_dirty()
+            return
+        self.journal.append(records)
+        if self.journal.size() > self.journalthreshold:
+            self.compact_journal()
+
+    def compact_journal(self):
+        """
+        Write all data to the main file and empty the journal.
+        """
+        if self.dryrun or self.journal.is_empty():
+            return
+        self.writer.mark_dirty()
+
+    def close(self):
+        """
+        Compact the journal and wait for everything to be written.
+        """
+        if self.writer is None:
+            return
+        self.compact_journal()
+        self.writer.close()
+        self.writer = None
+
+    def _set_value(self, entryid, attribute, value):
+        """
+        Change an attribute of an entry and update the indexes.
+
+        All changes to existing entries have to go through here.
+        """
+        entry = self.entries[entryid]
+        oldvalue = entry[attribute]
+        entry[attribute] = value
+        for index in self.indexes:
+            index.value_changed(entryid, attribute, oldvalue, value)
+
+    def _add_entry(self, entryid, entry):
+        self.entries[entryid] = entry
+        for index in self.indexes:
+            index.entry_added(entryid, entry)
+
+    def has_mal_id(self, malid):
+        return bool(self.malidindex.lookup(malid))
 
     def set_entry_value(self, entryid, attribute, value):
-        oldvalue = self.entries[entryid][attribute]
-        undoitem = (entryid, attribute, oldvalue)
-        self.undostack.append([undoitem])
-        self.entries[entryid][attribute] = value
-        self.write_data(self.datapath)
+        with self.lock:
+            oldvalue = self.entries[entryid][attribute]
+            self.history.push([(entryid, attribute, oldvalue, value)])
+            self._set_value(entryid, attribute, value)
+            self.save_changes([{'id': entryid, 'attribute': attribute, 'value': value}])
 
     def set_entry_values(self, actions):
         if not actions:
             return
-        undoitems = []
-        for entryid, attribute, value in actions:
-            oldvalue = self.entries[entryid][attribute]
-            undoitems.append((entryid, attribute, oldvalue))
-            self.entries[entryid][attribute] = value
-        self.undostack.append(undoitems)
-        self.write_data(self.datapath)
+        with self.lock:
+            changes = []
+            records = []
+            for entryid, attribute, value in actions:
+                oldvalue = self.entries[entryid][attribute]
+                changes.append((entryid, attribute, oldvalue, value))
+                self._set_value(entryid, attribute, value)
+                records.append({'id': entryid, 'attribute': attribute, 'value': value})
+            self.history.push(changes)
+            self.save_changes(records)
 
-    def undo_last_change(self):
-        actions = self.undostack.pop()
+    def _apply_history_actions(self, actions):
         updates = []
+        records = []
         for entryid, attribute, value in actions:
-            self.entries[entryid][attribute] = value
+            self._set_value(entryid, attribute, value)
             updates.append((entryid, self.entries[entryid]))
-        self.write_data(self.datapath)
+            records.append({'id': entryid, 'attribute': attribute, 'value': value})
+        self.save_changes(records)
         return updates
 
+    def undo_last_change(self):
+        with self.lock:
+            return self._apply_history_actions(self.history.undo(self.entries))
+
+    def redo_last_change(self):
+        with self.lock:
+            return self._apply_history_actions(self.history.redo(self.entries))
+
     def add_entry(self, entrydata):
-        newentryid = str(max(int(x) for x in self.entries.keys())+1)
-        self.entries[newentryid] = entrydata
-        self.write_data(self.datapath)
+        entrydata = Entry.from_dict(entrydata)
+        with self.lock:
+            newentryid = self.idallocator.allocate()
+            self._add_entry(newentryid, entrydata)
+            self.save_changes([{'id': newentryid, 'entry': entrydata}])
 
 
 
@@ -175,13 +432,19 @@ class NomiaHTMLEntryView(HTMLEntryView):
         child.setStyleProperty('display', newdisplay)
 
     def set_entry_data(self, entryid, *args, **kwargs):
-        super().set_entry_data(entryid, *args, **kwargs)
+        pos = super().set_entry_data(entryid, *args, **kwargs)
         # Re-expand it if it was expanded before
         if entryid in self.expandedentries:
             frame = self.webview.page().mainFrame()
             elementid = self.entryelementid.format(entryid)
             element = frame.findFirstElement(elementid).findFirst('div.entry_info')
             element.setStyleProperty('display', '-webkit-flex')
+        return pos
+
+    def hide_entry(self, entryid, *args, **kwargs):
+        pos = super().hide_entry(entryid, *args, **kwargs)
+        self.expandedentries.discard(entryid)
+        return pos
 
     def update_html(self, *args, **kwargs):
         super().update_html(*args, **kwargs)
@@ -202,13 +465,15 @@ class TerminalIndexController():
 
 
 class IndexFrame(QtGui.QWidget):
+    # Emitted from the writer thread, so don't connect it with a direct connection
+    save_status = pyqtSignal(str)
 
     def __init__(self, parent, dryrun, configdir):
         super().__init__(parent)
         self.configdir = configdir
         layout = QtGui.QVBoxLayout(self)
         kill_theming(layout)
-        self.entrylist = NomiaEntryList(dryrun)
+        self.entrylist = NomiaEntryList(dryrun, status_callback=self.save_status.emit)
         self.coverimagepath = join(configdir, 'coverimages')
         self.view = NomiaHTMLEntryView(self.coverimagepath, self, '#entry{}', '#hr{}',
                                        join(configdir, '.index.css'))
@@ -219,6 +484,19 @@ class IndexFrame(QtGui.QWidget):
         self.connect_signals()
         #self.view.set_stylesheet()
         self.currentfilter = None
+        # The compiled version of currentfilter
+        self.activefilter = None
+        self.filtercache = FilterCache(32)
+        # The version of the entries the last time changed entries were redrawn
+        self.redrawnversion = 0
+        self.expressioncache = ExpressionCache(compile_tag_filter)
+        self.filterindexes = {}
+        self.searchindexes = {}
+        # The ids matching the latest search, best match first
+        self.relevance = []
+        self.planner = None
+        self.columns = None
+        self.parallelfilter = None
         self.attributes = self.init_attributes()
         self.autocompleted_attributes = [
             'rating',
@@ -261,7 +539,10 @@ class IndexFrame(QtGui.QWidget):
                               get_suggestion_list=self.get_autocompletion_data)
         # Sorting
         ac.add_completion(name='sort',
-                          prefix=r's\s*-?',
+                          prefix=r's\s*',
+                          start=r'(^|,)\s*-?',
+                          end=r'$|,',
+                          illegal_chars=',',
                           get_suggestion_list=self.get_autocompletion_data)
         # Editing
         ac.add_completion(name='edit:attrname',
@@ -316,48 +597,208 @@ class IndexFrame(QtGui.QWidget):
             (t.edit,                    self.edit_entry),
             (t.new_entry,               self.new_entry),
             #(t.input_term.scroll_index, self.webview.event),
-            #(t.list_,                   self.list_),
+            (t.list_,                   self.list_libraries),
             #(t.quit,                    self.quit.emit),
             #(t.show_readme,             self.show_popup.emit),
             (t.test,                    self.dev_command),
             (t.open_website,            self.open_website),
+            (t.compact,                 self.compact_journal),
+            (t.cache_info,              self.show_cache_info),
+            (t.explain,                 self.explain_filter),
+            (self.save_status,          t.print_),
         )
         for signal, slot in connects:
             signal.connect(slot)
 
     def update_settings(self, settings):
         self.settings = settings
+        self.entrylist.update_settings(settings)
+        self.filtercache.set_size(settings['filter cache size'])
+        preparefuncs = {k:v[0] for k,v in self.attributes.items()}
+        if self.expressioncache.set_macros(settings['filter macros'], preparefuncs) \
+                and '@' in self.filterindexes:
+            # The results of the old macros would never be used again
+            self.filterindexes['@'].clear()
 
     def init_attributes(self):
         return {
-            'mal_id': [match_int, parse_int],
-            'airing_finished': [match_date, parse_date],
-            'airing_started': [match_date, parse_date],
-            'comment': [match_string, parse_string],
-            'description': [match_string, parse_string],
-            'episode_length': [match_duration, parse_duration],
-            'episodes_progress': [match_int, parse_int],
-            'episodes_total': [match_int, parse_int],
-            'rating': [match_string, parse_string],
-            'score_art': [match_score, parse_score],
-            'score_characters': [match_score, parse_score],
-            'score_enjoyment': [match_score, parse_score],
-            'score_overall': [match_score, parse_score],
-            'score_sound': [match_score, parse_score],
-            'score_story': [match_score, parse_score],
-            'space': [match_space, parse_space],
-            'space_per_episode': [match_space, parse_space],
-            'status': [match_string, parse_string],
-            'studio': [match_string, parse_string],
-            'tags': [match_tags, parse_tags],
-            'title': [match_string, parse_string],
-            'type': [match_string, parse_string],
-            'watching_finished': [match_date, parse_date],
-            'watching_started': [match_date, parse_date],
+            'mal_id': [prepare_int, parse_int],
+            'airing_finished': [prepare_date, parse_date],
+            'airing_started': [prepare_date, parse_date],
+            'comment': [prepare_string, parse_string],
+            'description': [prepare_string, parse_string],
+            'episode_length': [prepare_duration, parse_duration],
+            'episodes_progress': [prepare_int, parse_int],
+            'episodes_total': [prepare_int, parse_int],
+            'rating': [prepare_string, parse_string],
+            'score_art': [prepare_score, parse_score],
+            'score_characters': [prepare_score, parse_score],
+            'score_enjoyment': [prepare_score, parse_score],
+            'score_overall': [prepare_score, parse_score],
+            'score_sound': [prepare_score, parse_score],
+            'score_story': [prepare_score, parse_score],
+            'space': [prepare_space, parse_space],
+            'space_per_episode': [prepare_space, parse_space],
+            'status': [prepare_string, parse_string],
+            'studio': [prepare_string, parse_string],
+            'tags': [prepare_tags, parse_tags],
+            'title': [prepare_string, parse_string],
+            'type': [prepare_string, parse_string],
+            'watching_finished': [prepare_date, parse_date],
+            'watching_started': [prepare_date, parse_date],
         }
 
+    def create_entrylist(self, path):
+        """
+        Return a new entry list of the right kind for the data file.
+        """
+        if path.endswith(('.sqlite', '.db')):
+            return SQLiteEntryList(self.entrylist.dryrun)
+        return NomiaEntryList(self.entrylist.dryrun, status_callback=self.save_status.emit)
+
+    def create_filter_indexes(self):
+        """
+        Return the indexes used by filter_entries, by attribute.
+
+        They are added to the entry list, which keeps them up to date.
+        """
+        if isinstance(self.entrylist, SQLiteEntryList):
+            # The database has its own indexes
+            return {}
+        indexes = {'tags': TagIndex()}
+        for attribute, rangefunc in self.range_functions().items():
+            indexes[attribute] = SortedIndex(attribute, rangefunc)
+        for index in indexes.values():
+            self.entrylist.add_index(index)
+        # Already added to the entry list
+        indexes.update(self.searchindexes['text'].indexes)
+        indexes.update(self.searchindexes)
+        # Kept up to date by the filter cache's version counter instead
+        indexes['@'] = MacroResults(self.expressioncache, self.filtercache.versions,
+                                    self.entrylist.entries, indexes)
+        return indexes
+
+    def create_search_indexes(self):
+        """
+        Return the indexes for word search (~words) and fuzzy search
+        (attribute~:query), by chunk attribute, added to the entry list,
+        or nothing for the SQLite backend.
+
+        These are used for ranking the results even when they aren't used
+        for filtering.
+        """
+        if isinstance(self.entrylist, SQLiteEntryList):
+            # Building them would load every entry from the database, so
+            # searches are matched against the entries instead, unranked
+            return {}
+        textindexes = {attribute: TextIndex(attribute) for attribute in text_attributes}
+        indexes = {attribute + '~': FuzzyIndex(attribute) for attribute in fuzzy_attributes}
+        for index in list(textindexes.values()) + list(indexes.values()):
+            self.entrylist.add_index(index)
+        indexes['text'] = TextSearch(textindexes)
+        return indexes
+
+    def range_functions(self):
+        """
+        Return the range_* function of every attribute that has one.
+        """
+        rangefuncs = {
+            prepare_date: range_date,
+            prepare_duration: range_duration,
+            prepare_int: range_int,
+            prepare_score: range_score,
+            prepare_space: range_space,
+        }
+        return {attribute: rangefuncs[preparefunc]
+                for attribute, (preparefunc, _) in self.attributes.items()
+                if preparefunc in rangefuncs}
+
+    def create_columnar_index(self):
+        """
+        Return a ColumnarIndex added to the entry list, or None if it's
+        turned off or NumPy isn't installed.
+        """
+        if not self.settings['columnar engine'] or not columnarindex.available \
+                or isinstance(self.entrylist, SQLiteEntryList):
+            return None
+        rangefuncs = self.range_functions()
+        numeric = {k: v for k, v in rangefuncs.items() if v is not range_date}
+        dates = {k: v for k, v in rangefuncs.items() if v is range_date}
+        categorical = [x for x in self.autocompleted_attributes if x != 'tags']
+        index = columnarindex.ColumnarIndex(numeric, dates, categorical)
+        self.entrylist.add_index(index)
+        return index
+
+    def create_parallel_filter(self):
+        """
+        Return a ParallelFilter added to the entry list, or None if it's
+        turned off. Any old one is shut down.
+        """
+        if self.parallelfilter is not None:
+            self.parallelfilter.close()
+        if not self.settings['parallel filtering'] \
+                or isinstance(self.entrylist, SQLiteEntryList):
+            return None
+        preparefuncs = {k:v[0] for k,v in self.attributes.items()}
+        index = ParallelFilter(preparefuncs, self.settings['parallel filtering processes'])
+        self.entrylist.add_index(index)
+        return index
+
+    def use_parallel_filter(self, compiledfilter):
+        """
+        Return True if the filter should be run in the worker processes.
+        That is only faster when there are many entries, and every one
+        of them has to be matched in Python.
+        """
+        if self.parallelfilter is None \
+                or len(self.entrylist.entries) < self.settings['parallel filtering threshold'] \
+                or index_usage(compiledfilter, self.filterindexes) != 'none':
+            return False
+        return self.columns is None or not self.columns.vectorized(compiledfilter)
+
+    def sorted_ids(self, attribute, reverse):
+        """
+        Return all entry ids sorted by an attribute, or None if the view
+        should sort them itself.
+        """
+        if attribute == 'relevance':
+            # Entries shown by edits after the search go last
+            ranked = set(self.relevance)
+            ids = self.relevance + [k for k in self.entrylist.entries if k not in ranked]
+            return ids[::-1] if reverse else ids
+        ids = self.entrylist.sorted_ids(attribute, reverse)
+        if ids is None and self.columns is not None:
+            ids = self.columns.sorted_ids(attribute, reverse)
+        return ids
+
     def populate_view(self):
-        self.entrylist.set_datapath(self.settings['path'])
+        libraries = self.settings['libraries']
+        self.entrylist.close()
+        if libraries:
+            undoorderpath = None
+            if self.settings['persistent undo history'] and not self.entrylist.dryrun:
+                undoorderpath = join(self.configdir, 'libraries.undoorder')
+            self.entrylist = ShardedEntryList(self.entrylist.dryrun, libraries,
+                                              self.create_entrylist, undoorderpath)
+            self.entrylist.update_settings(self.settings)
+            # Only the libraries that are shown are loaded
+            active = [x for x in self.settings['default libraries'] if x in libraries]
+            self.entrylist.set_active_libraries(active or sorted(libraries)[:1])
+        else:
+            path = self.settings['path']
+            self.entrylist = self.create_entrylist(path)
+            self.entrylist.update_settings(self.settings)
+            self.entrylist.set_datapath(path)
+        self.searchindexes = self.create_search_indexes()
+        self.filterindexes = self.create_filter_indexes()
+        self.planner = FilterPlanner(self.entrylist.entries, self.filterindexes,
+                                     self.filtercache.versions)
+        self.columns = self.create_columnar_index()
+        self.parallelfilter = self.create_parallel_filter()
+        self.entrylist.add_index(self.filtercache.versions)
+        self.view.sortprovider = self.sorted_ids
+        self.view.sortorders = SortOrders()
+        self.entrylist.add_index(self.view.sortorders)
         self.view.set_entries(self.entrylist.entries)
         self.terminal.attributes = self.attributes.keys()
 
@@ -374,7 +815,9 @@ class IndexFrame(QtGui.QWidget):
             return [x for x in sorted(self.settings['filter macros']) if x.startswith(text)]
         elif name.startswith('filter:attr:') or name.startswith('edit:attr:') or name.startswith('replace:attr:'):
             attribute = name.split(':', 2)[2]
-            if attribute == 'tags':
+            if attribute == 'tags' and 'tags' in self.filterindexes:
+                return self.filterindexes['tags'].complete(text)
+            elif attribute == 'tags':
                 data = (tag for entry in self.entrylist.entries.values()
                         for tag in entry['tags']
                         if tag.startswith(text))
@@ -430,6 +873,103 @@ class IndexFrame(QtGui.QWidget):
         webbrowser.open_new_tab(url.format(malid))
 
 
+    def show_cache_info(self, arg):
+        self.terminal.print_(self.filtercache.stats())
+
+    def compact_journal(self, arg):
+        if self.entrylist.dryrun:
+            self.terminal.error('Nothing is written in dry run mode')
+            return
+        self.entrylist.compact_journal()
+        # The writer reports when it's actually been saved
+        self.terminal.print_('Compaction scheduled')
+
+    def list_libraries(self, arg):
+        if not isinstance(self.entrylist, ShardedEntryList):
+            self.terminal.error('No libraries are configured')
+            return
+        if not arg.strip():
+            for name in sorted(self.entrylist.libraries):
+                if name in self.entrylist.active:
+                    state = 'active'
+                elif self.entrylist.is_loaded(name):
+                    state = 'loaded'
+                else:
+                    state = 'not loaded'
+                self.terminal.print_('{}: {}'.format(name, state))
+            return
+        if arg.strip() == '*':
+            names = sorted(self.entrylist.libraries)
+        else:
+            names = [x.strip() for x in arg.split(',') if x.strip()]
+        try:
+            self.entrylist.set_active_libraries(names)
+        except KeyError as e:
+            self.terminal.error(e.args[0])
+            return
+        self.view.hiddenentries = set()
+        self.view.set_entries(self.entrylist.entries)
+        # The old sample has entries from the wrong libraries
+        self.planner.sample = []
+        if self.currentfilter:
+            self.filter_entries(self.currentfilter)
+        self.terminal.print_('Showing {}'.format(', '.join(names)))
+
+    def compile_filter_expression(self, arg):
+        """
+        Return the parsed filter expression and the compiled filter.
+        Raises SyntaxError if the filter is invalid.
+        """
+        preparefuncs = {k:v[0] for k,v in self.attributes.items()}
+        filterexpression = self.expressioncache.get(arg)
+        compiledfilter = compile_filter(filterexpression, preparefuncs,
+                                        self.expressioncache.shared)
+        return filterexpression, compiledfilter
+
+    def explain_filter(self, arg):
+        if not arg.strip():
+            if not self.currentfilter:
+                self.terminal.error('No active filter')
+                return
+            arg = self.currentfilter
+        try:
+            _, compiledfilter = self.compile_filter_expression(arg)
+        except SyntaxError as e:
+            self.terminal.error(str(e))
+            return
+        plannedfilter = self.planner.plan(compiledfilter)
+        cost, selectivity = self.planner.estimates[plannedfilter]
+        self.terminal.print_('{} – about {:.0%} match, {:.1f} ms'.format(
+            self.planner.explain(plannedfilter), selectivity,
+            cost * len(self.entrylist.entries) * 1000))
+
+    def find_matching_entries(self, filterexpression, compiledfilter):
+        """
+        Return a set with the ids of all entries that match a filter.
+        """
+        matchingentries = self.filtercache.get(filterexpression, compiledfilter)
+        if matchingentries is not None:
+            return matchingentries
+        # Let the entry list do it if it can (eg. in a database)
+        matchingentries = self.entrylist.filter_ids(filterexpression)
+        if matchingentries is None:
+            # Only planned when it has to be matched here
+            compiledfilter = self.planner.plan(compiledfilter)
+        if matchingentries is None and self.use_parallel_filter(compiledfilter):
+            # The workers get the subexpressions in the planned order
+            matchingentries = self.parallelfilter.filter_ids(filter_expression(compiledfilter))
+        if matchingentries is None:
+            # Set operations on the indexes beat the columns, but only
+            # as long as no entries have to be looked at
+            if self.columns is not None \
+                    and index_usage(compiledfilter, self.filterindexes) != 'all':
+                matchingentries = self.columns.filter_ids(compiledfilter)
+            else:
+                matchingentries = evaluate_filter(compiledfilter, self.entrylist.entries,
+                                                  self.filterindexes)
+        self.filtercache.put(filterexpression, matchingentries)
+        return matchingentries
+
     def filter_entries(self, arg):
         if not arg:
             if self.currentfilter:
@@ -439,32 +979,124 @@ class IndexFrame(QtGui.QWidget):
             return
         if arg.strip() == '-':
             self.currentfilter = None
-            self.view.set_hidden_entries(set(), self.entrylist.entries)
+            self.activefilter = None
+            self.show_filtered_entries(set(), [])
             return
         try:
-            filterexpression = compile_tag_filter(arg, self.settings['filter macros'])
+            filterexpression, compiledfilter = self.compile_filter_expression(arg)
         except SyntaxError as e:
             self.terminal.error(str(e))
             return
-        hiddenentries = set()
-        matchfuncs = {k:v[0] for k,v in self.attributes.items()}
         try:
-            for id_, entry in self.entrylist.entries.items():
-                if not run_filter(filterexpression, entry, matchfuncs):
-                    hiddenentries.add(id_)
+            matchingentries = self.find_matching_entries(filterexpression, compiledfilter)
+            hiddenentries = set(self.entrylist.entries.keys()) - matchingentries
         except SyntaxError as e:
             self.terminal.error(str(e))
             return
         self.currentfilter = arg
-        self.view.set_hidden_entries(hiddenentries, self.entrylist.entries)
+        self.activefilter = compiledfilter
+        # Ranking needs the search indexes
+        searches = search_chunks(compiledfilter) if self.searchindexes else []
+        if searches:
+            self.relevance = self.rank_entries(searches, matchingentries)
+        self.show_filtered_entries(hiddenentries, searches)
+
+    def rank_entries(self, searches, entryids):
+        """
+        Return a list with the ids sorted by how well their entries match
+        the search chunks, best first. Ties are broken by the next chunk.
+        """
+        scores = [self.searchindexes[chunk.attribute].scores(chunk.arg, entryids)
+                  for chunk in searches]
+        return sorted(sorted(entryids), key=lambda k: tuple(s[k] for s in scores),
+                      reverse=True)
+
+    def show_filtered_entries(self, hiddenentries, searches):
+        """
+        Hide the entries, and show the rest by relevance if the filter has
+        search chunks, or stop doing that if it doesn't.
+        """
+        if not searches and self.view.sortkey != 'relevance':
+            self.view.set_hidden_entries(hiddenentries, self.entrylist.entries)
+            return
+        self.view.sortorders.invalidate('relevance')
+        if searches:
+            self.view.sortkey = 'relevance'
+            self.view.sortreverse = False
+        else:
+            self.relevance = []
+            self.view.sortkey = ''
+        self.view.hiddenentries = hiddenentries
+        self.view.update_html(self.entrylist.entries)
 
     def sort_entries(self, arg):
-        reverse = arg.startswith('-')
-        arg = arg[reverse:]
-        if arg not in self.attributes:
-            self.terminal.error('Unknown attribute: {}'.format(arg))
+        """
+        Sort by one or more attributes, separated by commas and each
+        reversed with a -, eg. "score_overall,-airing_started,title".
+        """
+        sortkeys = [x.strip() for x in arg.split(',')]
+        for key in sortkeys:
+            attribute = key[key.startswith('-'):]
+            if attribute not in self.attributes:
+                self.terminal.error('Unknown attribute: {}'.format(attribute))
+                return
+        if len(sortkeys) == 1:
+            reverse = sortkeys[0].startswith('-')
+            self.view.sort_entries(sortkeys[0][reverse:], self.entrylist.entries, reverse)
+        else:
+            self.view.sort_entries(','.join(sortkeys), self.entrylist.entries)
+
+    def update_changed_entries(self, entryids):
+        """
+        Redraw changed entries, and hide or show them depending on if they
+        match the active filter.
+        """
+        entries = self.entrylist.entries
+        hiddenentries = self.view.hiddenentries
+        nowhidden = set()
+        nowshown = set()
+        for entryid in entryids:
+            matches = self.activefilter is None \
+                    or run_filter(self.activefilter, entries[entryid])
+            if matches and entryid in hiddenentries:
+                nowshown.add(entryid)
+            elif not matches and entryid not in hiddenentries:
+                nowhidden.add(entryid)
+        # Only a change to a sorted attribute can move an entry
+        versions = self.filtercache.versions
+        sortattributes = {attribute for attribute, _ in parse_sort_key(self.view.sortkey)}
+        resorted = any(versions.changed.get(attribute, 0) > self.redrawnversion
+                       for attribute in sortattributes)
+        self.redrawnversion = versions.version
+        # Moving an entry into place only works if the others are in place,
+        # so when several may have moved, they're all taken out first
+        moved = set()
+        if len(entryids) > 1 and resorted:
+            moved = {x for x in entryids if x not in hiddenentries and x not in nowhidden}
+        # Hiding, showing or moving an entry costs a few DOM operations
+        # while a redraw formats every shown entry, so a redraw only pays off
+        # once about a tenth of the shown entries are touched
+        changes = len(nowhidden) + len(nowshown) + len(moved)
+        if changes > (len(entries) - len(hiddenentries)) // 10:
+            self.view.hiddenentries = (hiddenentries - nowshown) | nowhidden
+            self.view.update_html(entries)
             return
-        self.view.sort_entries(arg, self.entrylist.entries, reverse)
+        # Take out everything that goes away before putting anything back,
+        # since a hidden entry may be out of place too. The numbers are only
+        # updated once at the end, from the first touched position.
+        positions = [self.view.hide_entry(entryid, renumber=False)
+                     for entryid in moved | nowhidden]
+        nowshown |= moved
+        # An entry can be in entryids more than once
+        for entryid in dict.fromkeys(entryids):
+            if entryid in nowshown:
+                positions.append(self.view.show_entry(entryid, entries, renumber=False))
+            elif entryid not in hiddenentries:
+                positions.append(self.view.set_entry_data(entryid, entries[entryid],
+                                                          renumber=False))
+        positions = [pos for pos in positions if pos is not None]
+        if positions:
+            self.view.renumber(min(positions))
 
     def replace_tags(self, oldtag, newtag):
         if not oldtag and not newtag:
@@ -478,8 +1110,7 @@ class IndexFrame(QtGui.QWidget):
         actions = [(id_, 'tags', self.entrylist.entries[id_]['tags'] - {oldtag} | newtagset)
                    for id_ in selectedentries]
         self.entrylist.set_entry_values(actions)
-        for id_ in selectedentries:
-            self.view.set_entry_data(id_, self.entrylist.entries[id_])
+        self.update_changed_entries(selectedentries)
 
     def edit_entry(self, arg):
         if arg.strip() == 'u':
@@ -488,8 +1119,15 @@ class IndexFrame(QtGui.QWidget):
             except IndexError:
                 self.terminal.error('Nothing to undo')
             else:
-                for entryid, data in actions:
-                    self.view.set_entry_data(entryid, data)
+                self.update_changed_entries([entryid for entryid, _ in actions])
+            return
+        if arg.strip() == 'r':
+            try:
+                actions = self.entrylist.redo_last_change()
+            except IndexError:
+                self.terminal.error('Nothing to redo')
+            else:
+                self.update_changed_entries([entryid for entryid, _ in actions])
             return
         replacerx = re.fullmatch(r'\*\s*tags:\s*([^,]*?)\s*,\s*([^,]*?)\s*', arg)
         if replacerx:
@@ -527,7 +1165,7 @@ class IndexFrame(QtGui.QWidget):
             self.terminal.error(str(e))
             return
         self.entrylist.set_entry_value(entryid, attribute, parseddata)
-        self.view.set_entry_data(entryid, self.entrylist.entries[entryid])
+        self.update_changed_entries([entryid])
 
     def new_entry(self, arg):
         rx = re.fullmatch(r'(\d+)\s+(.+)', arg)
@@ -540,7 +1178,7 @@ class IndexFrame(QtGui.QWidget):
         malid, pw = rx.groups()
         self.terminal.censor_last_command(' '.join(['n', malid, '*****']))
         malid = int(malid)
-        if malid in self.entrylist.entries:
+        if self.entrylist.has_mal_id(malid):
             self.terminal.error('The MAL id already exists')
             return
         auth = (self.settings['maluser'], pw)
@@ -556,6 +1194,11 @@ class IndexFrame(QtGui.QWidget):
         newentry = malapi.get_mal_data(malid, self.settings['maluser'], self.coverimagepath)
         self.entrylist.add_entry(newentry)
         self.view.set_entries(self.entrylist.entries)
+        if isinstance(self.entrylist, ShardedEntryList) \
+                and self.entrylist.new_entry_library() not in self.entrylist.active:
+            self.terminal.print_('Entry added to {} (not shown): {}'.format(
+                self.entrylist.new_entry_library(), newentry['title']))
+            return
         self.terminal.print_('Entry added: {}'.format(newentry['title']))
 
 
@@ -590,6 +1233,9 @@ class Terminal(GenericTerminal):
     show_readme = pyqtSignal(str, str, str, str)
     test = pyqtSignal(str)
     open_website = pyqtSignal(str)
+    compact = pyqtSignal(str)
+    cache_info = pyqtSignal(str)
+    explain = pyqtSignal(str)
 
     def __init__(self, parent):
         super().__init__(parent, TerminalInputBox, GenericTerminalOutputBox)
@@ -602,11 +1248,14 @@ class Terminal(GenericTerminal):
             's': (self.sort, 'Sort'),
             'q': (self.quit, 'Quit'),
             '?': (self.cmd_help, 'List commands or help for [command]'),
-            'l': (self.list_, 'List'),
+            'l': (self.list_, 'List libraries, or show [library, ...|*]'),
             'n': (self.new_entry, 'New entry'),
             'h': (self.cmd_show_readme, 'Show readme'),
             't': (self.test, 'DEVCOMMAND'),
-            'w': (self.open_website, 'Open MAL page in browser')
+            'w': (self.open_website, 'Open MAL page in browser'),
+            'c': (self.compact, 'Compact the edit journal into the data file'),
+            'i': (self.cache_info, 'Show filter cache statistics'),
+            'x': (self.explain, 'Explain how [filter] (or the active one) is matched')
         }
 
     def censor_last_command(self, newtext):
@@ -2,6 +2,9 @@
 
 import collections
 import copy
+import hashlib
+import json
+import os
 from os import getenv
 from os.path import isdir, join
 import re
@@ -43,10 +46,9 @@ class MainWindow(QtGui.QWidget):
                                             self.show_index)
 
         # Load settings
-        self.defaultstyle = read_json(local_path('defaultstyle.json'))
-        self.css_template = read_file(local_path(join('templates','template.css')))
-        self.index_css_template = read_file(local_path(join('templates','index_page.css')))
+        self.configfiles = ConfigFileCache()
         self.settings, self.style = {}, {}
+        self.css, self.indexcss = None, None
         self.reload_settings()
         self.index_viewer.populate_view()
 
@@ -55,6 +57,9 @@ class MainWindow(QtGui.QWidget):
         self.show()
 
     def closeEvent(self, event):
+        self.index_viewer.entrylist.close()
+        if self.index_viewer.parallelfilter is not None:
+            self.index_viewer.parallelfilter.close()
         event.accept()
 
     def quit(self, force):
@@ -80,26 +85,34 @@ class MainWindow(QtGui.QWidget):
 
 
     def reload_settings(self):
-        self.defaultstyle = read_json(local_path('defaultstyle.json'))
-        self.css_template = read_file(local_path(join('templates','template.css')))
-        self.index_css_template = read_file(local_path(join('templates','index_page.css')))
-
-        settings, style, stylepath = read_config(self.configdir, self.defaultstyle)
-        # TODO: FIX THIS UGLY ASS SHIT
-        # Something somewhere fucks up and changes the settings dict,
-        # therefor the deepcopy(). Fix pls.
-        #if settings != self.settings:
-        if settings['title']:
-            self.setWindowTitle(settings['title'])
-        else:
-            self.setWindowTitle('Nomia')
-        self.settings = copy.deepcopy(settings)
-        self.index_viewer.update_settings(settings)
-        self.popuphomekey.setKey(QtGui.QKeySequence(settings['hotkey home']))
-        #if style != self.style:
-        self.style = style.copy()
-        self.update_style(style)
-        write_json(stylepath, style)
+        """
+        Reload the settings and the style, but only apply (and write) the
+        parts that have actually changed since last time.
+
+        This is run every time the window is activated.
+        """
+        files = self.configfiles
+        self.defaultstyle = files.read(local_path('defaultstyle.json'), json.loads)
+        self.css_template = files.read(local_path(join('templates','template.css')))
+        self.index_css_template = files.read(local_path(join('templates','index_page.css')))
+
+        settings, style, stylepath, stylefiledata = read_config(self.configdir, self.defaultstyle, files)
+        if settings != self.settings:
+            if settings['title']:
+                self.setWindowTitle(settings['title'])
+            else:
+                self.setWindowTitle('Nomia')
+            # The parsed files are cached, so nothing else may change them
+            self.settings = copy.deepcopy(settings)
+            self.index_viewer.update_settings(copy.deepcopy(settings))
+            self.popuphomekey.setKey(QtGui.QKeySequence(settings['hotkey home']))
+        if style != self.style or files.changed:
+            self.style = copy.deepcopy(style)
+            self.update_style(style)
+        # Only add missing keys to the style file if there are any
+        if style != stylefiledata:
+            write_json(stylepath, style)
+        files.changed = False
 
 
     def update_style(self, style):
@@ -110,12 +123,22 @@ class MainWindow(QtGui.QWidget):
             print(e)
             #self.index_viewer.error('Invalid style config: key missing')
             return
-        self.setStyleSheet(css)
+        if css != self.css:
+            self.setStyleSheet(css)
+            self.css = css
         self.index_viewer.defaulttagcolor = style['index entry tag default background']
-        disclaimer = '/* AUTOGENERATED! NO POINT IN EDITING THIS */\n\n'
-        write_file(join(self.configdir, '.index.css'), disclaimer + indexcss)
-        self.index_viewer.css = indexcss
-        self.index_viewer.refresh_view(keep_position=True)
+        if indexcss != self.indexcss:
+            disclaimer = '/* AUTOGENERATED! NO POINT IN EDITING THIS */\n\n'
+            indexcsspath = join(self.configdir, '.index.css')
+            try:
+                oldindexcss = read_file(indexcsspath)
+            except OSError:
+                oldindexcss = None
+            if oldindexcss != disclaimer + indexcss:
+                write_file(indexcsspath, disclaimer + indexcss)
+            self.indexcss = indexcss
+            self.index_viewer.css = indexcss
+            self.index_viewer.refresh_view(keep_position=True)
 
 
     # ===== Input overrides ===========================
@@ -136,7 +159,42 @@ class MainWindow(QtGui.QWidget):
     # =================================================
 
 
-def read_config(configpath, defaultstyle):
+class ConfigFileCache():
+    """
+    Keep the parsed contents of files around and only read and parse them
+    again when they have changed on disk.
+
+    A file counts as unchanged if its mtime and size are the same as last
+    time, or if its contents hash to the same value. changed is set to True
+    whenever a file has to be parsed again, and it's up to the user to
+    reset it.
+
+    The returned data is shared between calls and must not be modified.
+    """
+    def __init__(self):
+        self._files = {}
+        self.changed = False
+
+    def read(self, path, parse=None):
+        stat = os.stat(path)
+        statkey = (stat.st_mtime_ns, stat.st_size)
+        cached = self._files.get(path)
+        if cached is not None and cached['stat'] == statkey:
+            return cached['data']
+        with open(path, 'rb') as f:
+            rawdata = f.read()
+        digest = hashlib.sha1(rawdata).hexdigest()
+        if cached is not None and cached['digest'] == digest:
+            cached['stat'] = statkey
+            return cached['data']
+        text = rawdata.decode('utf-8')
+        data = text if parse is None else parse(text)
+        self._files[path] = {'stat': statkey, 'digest': digest, 'data': data}
+        self.changed = True
+        return data
+
+
+def read_config(configpath, defaultstyle, files):
     #if configdir:
     #    configpath = configdir
     #else:
@@ -146,10 +204,13 @@ def read_config(configpath, defaultstyle):
     make_sure_config_exists(configfile, local_path('defaultconfig.json'))
     make_sure_config_exists(stylefile, local_path('defaultstyle.json'))
     # Make sure to update the style with the defaultstyle's values
-    newstyle = read_json(stylefile)
+    newstyle = files.read(stylefile, json.loads)
     style = defaultstyle.copy()
     style.update({k:v for k,v in newstyle.items() if k in defaultstyle})
-    return read_json(configfile), style, stylefile
+    # Same with the settings, so new options get their default values
+    settings = files.read(local_path('defaultconfig.json'), json.loads).copy()
+    settings.update(files.read(configfile, json.loads))
+    return settings, style, stylefile, newstyle
 
 
 def main():
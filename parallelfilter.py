@@ -0,0 +1,154 @@
+"""
+Filtering in several processes at once, for libraries where matching
+every entry in one process is too slow.
+
+Every worker process has its own part of the entries, and is sent the
+changes made to them since then right before the next filter. Compiled
+filters can't be sent to other processes, so the workers compile the
+filter expression themselves.
+"""
+import multiprocessing
+import os
+
+from entryindexes import EntryIndex
+from filtersystem import compile_filter
+
+
+def _worker(connection, preparefuncs):
+    entries = {}
+    while True:
+        command, arg = connection.recv()
+        if command == 'load':
+            entries = arg
+        elif command == 'update':
+            entries.update(arg)
+        elif command == 'filter':
+            try:
+                match = compile_filter(arg, preparefuncs).match
+                connection.send({k for k, entry in entries.items() if match(entry)})
+            except Exception as e:
+                connection.send(e)
+        elif command == 'quit':
+            return
+
+
+class ParallelFilter(EntryIndex):
+    """
+    A pool of worker processes that filter the entries together.
+
+    It should be added to the entry list like an index, which keeps the
+    workers' copies of the entries up to date. preparefuncs is passed on
+    to compile_filter in the workers, so it has to be picklable (eg.
+    module level functions). The processes are started the first time
+    they're needed.
+    """
+    def __init__(self, preparefuncs, processes=0):
+        self.preparefuncs = preparefuncs
+        self.processcount = processes or os.cpu_count() or 1
+        self.processes = []
+        self.connections = []
+        self.entries = {}
+        # entry id -> the number of the worker that has it
+        self.owners = {}
+        # The changes not sent to each worker yet, or None if they all
+        # need all of their entries again
+        self.pending = None
+
+    def rebuild(self, entries):
+        self.entries = entries
+        self.owners = {}
+        self.pending = None
+
+    def _changed(self, entryid, entry):
+        if self.pending is None:
+            return
+        worker = self.owners.get(entryid)
+        if worker is None:
+            worker = self.owners[entryid] = len(self.owners) % self.processcount
+        self.pending[worker][entryid] = entry
+
+    def entry_added(self, entryid, entry):
+        self._changed(entryid, entry)
+
+    def value_changed(self, entryid, attribute, oldvalue, newvalue):
+        self._changed(entryid, self.entries[entryid])
+
+    def _start(self):
+        # Forking would copy the whole GUI process
+        context = multiprocessing.get_context('spawn')
+        for _ in range(self.processcount):
+            connection, childconnection = context.Pipe()
+            process = context.Process(target=_worker, args=(childconnection, self.preparefuncs),
+                                      daemon=True)
+            process.start()
+            self.processes.append(process)
+            self.connections.append(connection)
+
+    def _send_entries(self):
+        if self.pending is None:
+            items = list(self.entries.items())
+            count = self.processcount
+            self.owners = {entryid: n % count for n, (entryid, _) in enumerate(items)}
+            for n, connection in enumerate(self.connections):
+                connection.send(('load', dict(items[n::count])))
+        else:
+            for connection, changes in zip(self.connections, self.pending):
+                if changes:
+                    connection.send(('update', changes))
+        self.pending = [{} for _ in self.connections]
+
+    def filter_ids(self, filterexpression):
+        """
+        Return a set with the ids of the entries matching a filter
+        expression (from compile_tag_filter or filter_expression), or None
+        if a worker has died. New workers are started the next time.
+        """
+        if not self.processes:
+            self._start()
+        try:
+            return self._filter(filterexpression)
+        except (EOFError, OSError):
+            # A broken pipe or a closed connection, so the other workers
+            # may be out of step too
+            self._stop(0)
+            return None
+
+    def _filter(self, filterexpression):
+        self._send_entries()
+        for connection in self.connections:
+            connection.send(('filter', filterexpression))
+        result = set()
+        error = None
+        # Read every answer, so none are left for the next filter
+        for connection in self.connections:
+            ids = connection.recv()
+            if isinstance(ids, Exception):
+                error = ids
+            else:
+                result |= ids
+        if error is not None:
+            raise error
+        return result
+
+    def _stop(self, timeout):
+        """
+        Wait at most timeout seconds for every worker to quit and kill the
+        ones that don't.
+        """
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        for connection in self.connections:
+            connection.close()
+        self.processes = []
+        self.connections = []
+        self.pending = None
+
+    def close(self, timeout=1):
+        for connection in self.connections:
+            try:
+                connection.send(('quit', None))
+            except OSError:
+                pass
+        self._stop(timeout)
@@ -0,0 +1,312 @@
+from collections.abc import Mapping
+import os
+import os.path
+
+from entryindexes import EntryIndex
+
+
+def namespaced_id(library, entryid):
+    return '{}-{}'.format(library, entryid)
+
+def split_namespaced_id(nsid):
+    """
+    Return the library name and the library's own id of an entry.
+    """
+    library, entryid = nsid.rsplit('-', 1)
+    return library, entryid
+
+
+class MergedEntries(Mapping):
+    """
+    A read-only dict-like view of the entries in several libraries, with
+    the library name prepended to every entry id.
+    """
+    def __init__(self, shards):
+        self._shards = shards
+
+    def __getitem__(self, nsid):
+        try:
+            library, entryid = split_namespaced_id(nsid)
+        except ValueError:
+            raise KeyError(nsid)
+        if library not in self._shards:
+            raise KeyError(nsid)
+        return self._shards[library].entries[entryid]
+
+    def __iter__(self):
+        for library, shard in self._shards.items():
+            for entryid in shard.entries:
+                yield namespaced_id(library, entryid)
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self._shards.values())
+
+    def items(self):
+        for library, shard in self._shards.items():
+            for entryid, entry in shard.entries.items():
+                yield namespaced_id(library, entryid), entry
+
+    def values(self):
+        for shard in self._shards.values():
+            yield from shard.entries.values()
+
+
+class _ForwardingIndex(EntryIndex):
+    """
+    Pass changes in one library on to the sharded entry list's own indexes,
+    with namespaced entry ids.
+    """
+    def __init__(self, library, shardedlist):
+        self.library = library
+        self.shardedlist = shardedlist
+
+    def entry_added(self, entryid, entry):
+        if self.library in self.shardedlist.active:
+            nsid = namespaced_id(self.library, entryid)
+            for index in self.shardedlist.indexes:
+                index.entry_added(nsid, entry)
+
+    def value_changed(self, entryid, attribute, oldvalue, newvalue):
+        if self.library in self.shardedlist.active:
+            nsid = namespaced_id(self.library, entryid)
+            for index in self.shardedlist.indexes:
+                index.value_changed(nsid, attribute, oldvalue, newvalue)
+
+
+class _LibraryOrder():
+    """
+    The libraries that undoable (or redoable) changes were made in, oldest
+    first.
+
+    If a path is given, the order is kept in that file, one library per
+    line, so it survives restarts like the libraries' own undo histories.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.libraries = []
+        if path is not None and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                text = f.read()
+            # Skip a broken last line
+            self.libraries = text[:text.rfind('\n') + 1].splitlines()
+
+    def __len__(self):
+        return len(self.libraries)
+
+    def last(self):
+        return self.libraries[-1]
+
+    def push(self, library):
+        self.libraries.append(library)
+        if self.path is not None:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(library + '\n')
+
+    def pop(self):
+        library = self.libraries.pop()
+        if self.path is not None:
+            os.truncate(self.path, os.path.getsize(self.path)
+                        - len((library + '\n').encode('utf-8')))
+        return library
+
+    def remove_all(self, library):
+        self.libraries = [x for x in self.libraries if x != library]
+        self._rewrite()
+
+    def clear(self):
+        if self.libraries:
+            self.libraries = []
+            self._rewrite()
+
+    def _rewrite(self):
+        if self.path is not None:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write(''.join(x + '\n' for x in self.libraries))
+
+
+class ShardedEntryList():
+    """
+    Several libraries (eg. anime, movies and tv), each in its own data file,
+    shown as one list.
+
+    A library is only loaded the first time it's activated, and every
+    library keeps its own entry list, so an edit only ever writes to the
+    file of the library it touches. Entry ids are namespaced as
+    "<library>-<id>".
+
+    create_entrylist is a function that takes a data path and returns a
+    new (not yet loaded) entry list for it. If undoorderpath is given, the
+    order of the undo steps in the libraries is kept in that file, which
+    should be done when the libraries keep their undo histories on disk.
+    """
+    def __init__(self, dryrun, libraries, create_entrylist, undoorderpath=None):
+        self.dryrun = dryrun
+        self.libraries = libraries
+        self.create_entrylist = create_entrylist
+        self.settings = None
+        self.shards = {}
+        self.active = []
+        self.activeshards = {}
+        self.entries = MergedEntries(self.activeshards)
+        self.indexes = []
+        # Which library each undoable change was made in
+        self.undoorder = _LibraryOrder(undoorderpath)
+        self.redoorder = _LibraryOrder()
+
+    def update_settings(self, settings):
+        self.settings = settings
+        self.libraries = settings['libraries']
+        for shard in self.shards.values():
+            shard.update_settings(settings)
+
+    def get_shard(self, library):
+        """
+        Return the entry list of a library, loading it if needed.
+        """
+        if library not in self.shards:
+            shard = self.create_entrylist(self.libraries[library])
+            if self.settings is not None:
+                shard.update_settings(self.settings)
+            shard.set_datapath(self.libraries[library])
+            shard.add_index(_ForwardingIndex(library, self))
+            self.shards[library] = shard
+        return self.shards[library]
+
+    def set_active_libraries(self, libraries):
+        """
+        Set which libraries are shown, loading them if needed.
+        """
+        for library in libraries:
+            if library not in self.libraries:
+                raise KeyError('Unknown library: {}'.format(library))
+        for library in libraries:
+            self.get_shard(library)
+        self.active = list(libraries)
+        self.activeshards.clear()
+        self.activeshards.update((x, self.shards[x]) for x in self.active)
+        for index in self.indexes:
+            index.rebuild(self.entries)
+
+    def is_loaded(self, library):
+        return library in self.shards
+
+    def add_index(self, index):
+        self.indexes.append(index)
+        index.rebuild(self.entries)
+
+    def _shard_of(self, nsid):
+        library, entryid = split_namespaced_id(nsid)
+        return library, self.activeshards[library], entryid
+
+    # == Editing ==
+
+    def set_entry_value(self, nsid, attribute, value):
+        library, shard, entryid = self._shard_of(nsid)
+        shard.set_entry_value(entryid, attribute, value)
+        self.undoorder.push(library)
+        self.redoorder.clear()
+
+    def set_entry_values(self, actions):
+        if not actions:
+            return
+        # One undo step per library
+        bylibrary = {}
+        for nsid, attribute, value in actions:
+            library, entryid = split_namespaced_id(nsid)
+            bylibrary.setdefault(library, []).append((entryid, attribute, value))
+        for library, shardactions in bylibrary.items():
+            self.activeshards[library].set_entry_values(shardactions)
+            self.undoorder.push(library)
+        self.redoorder.clear()
+
+    def _namespace_updates(self, library, updates):
+        # Changes to libraries that aren't shown don't need to be redrawn
+        if library not in self.activeshards:
+            return []
+        return [(namespaced_id(library, entryid), entry) for entryid, entry in updates]
+
+    def _step(self, order, otherorder, step):
+        """
+        Undo or redo (with step) the latest change in order, and move its
+        library to otherorder. Raise IndexError if there's nothing to do.
+        """
+        while order:
+            library = order.last()
+            if library not in self.libraries:
+                # Removed from the settings since the change
+                order.remove_all(library)
+                continue
+            try:
+                updates = step(self.get_shard(library))
+            except IndexError:
+                # The library's own history has dropped its older steps to
+                # stay within the memory budget, so nothing of it is left
+                order.remove_all(library)
+                continue
+            order.pop()
+            otherorder.push(library)
+            return self._namespace_updates(library, updates)
+        raise IndexError('Nothing left in any library')
+
+    def undo_last_change(self):
+        return self._step(self.undoorder, self.redoorder,
+                          lambda shard: shard.undo_last_change())
+
+    def redo_last_change(self):
+        return self._step(self.redoorder, self.undoorder,
+                          lambda shard: shard.redo_last_change())
+
+    def new_entry_library(self):
+        """
+        Return the name of the library new entries are added to.
+        """
+        library = self.settings['new entry library'] if self.settings else None
+        if library in self.libraries:
+            return library
+        return self.active[0]
+
+    def has_mal_id(self, malid):
+        """
+        Return True if any library has an entry with the MAL id. This loads
+        all libraries.
+        """
+        # The loaded ones first, since they're cheaper to check
+        libraries = sorted(self.libraries, key=lambda x: not self.is_loaded(x))
+        return any(self.get_shard(x).has_mal_id(malid) for x in libraries)
+
+    def add_entry(self, entrydata):
+        self.get_shard(self.new_entry_library()).add_entry(entrydata)
+
+    # == Queries ==
+
+    def filter_ids(self, filterexpression):
+        """
+        Return the matching ids if every active library can filter by
+        itself, otherwise None.
+        """
+        result = set()
+        for library, shard in self.activeshards.items():
+            ids = shard.filter_ids(filterexpression)
+            if ids is None:
+                return None
+            result.update(namespaced_id(library, x) for x in ids)
+        return result
+
+    def sorted_ids(self, attribute, reverse):
+        if len(self.activeshards) != 1:
+            return None
+        library, shard = next(iter(self.activeshards.items()))
+        ids = shard.sorted_ids(attribute, reverse)
+        if ids is None:
+            return None
+        return [namespaced_id(library, x) for x in ids]
+
+    # == Persistence ==
+
+    def compact_journal(self):
+        for shard in self.shards.values():
+            shard.compact_journal()
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
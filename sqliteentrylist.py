@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+from collections.abc import Mapping
+from datetime import datetime
+from operator import lt, gt, le, ge, eq
+from os.path import join
+import json
+import re
+import sqlite3
+
+from libsyntyche.common import read_json, write_file, local_path
+
+from entryviewlib import EntryList
+from entryrecord import Entry
+from undohistory import UndoHistory
+from entryindexes import IdAllocator
+from entryfunctions import attribute_types, _get_comparison_function, _parse_space_arg,\
+        _parse_date_arg, _parse_duration_arg
+
+
+_sqlops = {lt: '<', gt: '>', le: '<=', ge: '>=', eq: '='}
+
+# Free text doesn't gain anything from a b-tree index since it's only
+# ever searched for substrings
+_unindexed = {'comment', 'description'}
+
+
+def _casefold(text):
+    return None if text is None else text.casefold()
+
+
+class SQLiteEntries(Mapping):
+    """
+    A read-only dict-like view of the entries in the database.
+
+    Entries are fetched when they are needed and then kept in memory.
+    Iterating over all items loads everything with two queries instead of
+    one per entry.
+    """
+    def __init__(self, entrylist):
+        self._entrylist = entrylist
+        self._cache = {}
+        self._fullyloaded = False
+
+    def __getitem__(self, entryid):
+        if entryid not in self._cache:
+            entry = self._entrylist._fetch_entry(entryid)
+            if entry is None:
+                raise KeyError(entryid)
+            self._cache[entryid] = entry
+        return self._cache[entryid]
+
+    def __iter__(self):
+        if self._fullyloaded:
+            return iter(list(self._cache))
+        # In the same order as when they're all loaded, and not the order
+        # of the id index
+        return iter([row[0] for row in
+                     self._entrylist.db.execute('SELECT id FROM entries ORDER BY rowid')])
+
+    def __len__(self):
+        if self._fullyloaded:
+            return len(self._cache)
+        return self._entrylist.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def __contains__(self, entryid):
+        if entryid in self._cache:
+            return True
+        return self._entrylist.db.execute('SELECT 1 FROM entries WHERE id = ?',
+                                          (entryid,)).fetchone() is not None
+
+    def items(self):
+        if not self._fullyloaded:
+            self._cache = self._entrylist._fetch_all_entries()
+            self._fullyloaded = True
+        return self._cache.items()
+
+    def values(self):
+        return [entry for _, entry in self.items()]
+
+    def _set(self, entryid, entry):
+        self._cache[entryid] = entry
+
+
+class SQLiteEntryList(EntryList):
+    """
+    An entry list stored in an SQLite database with one row per entry.
+
+    Tags are stored in their own table. Edits only touch the affected
+    rows, and filters and sorts that can be expressed in SQL are run by
+    the database.
+    """
+    def __init__(self, dryrun):
+        self.dateformat = '%Y-%m-%d'
+        self.dryrun = dryrun
+        self.db = None
+        self.undobudget = 2**24
+        self.history = UndoHistory(self.undobudget)
+        self.entries = {}
+        # Indexes added with add_index, kept up to date on every change
+        self.indexes = []
+        template = read_json(local_path(join('templates', 'defaultentry-meta.json')))
+        self.dateattributes = [k for k, v in template.items() if v['type'] == 'date']
+        self.columns = sorted(k for k, v in template.items() if v['type'] != 'list')
+        self.columntypes = {k: 'INTEGER' if v['type'] in ('int', 'bool') else 'TEXT'
+                            for k, v in template.items()}
+
+    def update_settings(self, settings):
+        self.undobudget = settings['undo memory budget']
+        self.history.budget = self.undobudget
+
+    def set_datapath(self, datapath):
+        if self.db is not None:
+            self.close()
+        self.datapath = datapath
+        self.db = sqlite3.connect(datapath)
+        self.db.create_function('casefold', 1, _casefold, deterministic=True)
+        self.create_tables()
+        self.read_data()
+        self.history = UndoHistory(self.undobudget)
+        self.idallocator = IdAllocator()
+        self.idallocator.rebuild([row[0] for row in self.db.execute('SELECT id FROM entries')])
+        for index in self.indexes:
+            index.rebuild(self.entries)
+
+    def create_tables(self):
+        columns = ', '.join('{} {}'.format(c, self.columntypes[c]) for c in self.columns)
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries '
+                        '(id TEXT PRIMARY KEY, {})'.format(columns))
+        self.db.execute('CREATE TABLE IF NOT EXISTS tags '
+                        '(entryid TEXT NOT NULL, tag TEXT NOT NULL, '
+                        'PRIMARY KEY (entryid, tag))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag)')
+        for c in self.columns:
+            if c not in _unindexed:
+                self.db.execute('CREATE INDEX IF NOT EXISTS entries_{0} '
+                                'ON entries ({0})'.format(c))
+        self.commit()
+
+    def read_data(self):
+        self.entries = SQLiteEntries(self)
+
+    def write_data(self):
+        self.commit()
+
+    def commit(self):
+        if not self.dryrun:
+            self.db.commit()
+
+    def compact_journal(self):
+        pass
+
+    def close(self):
+        if self.db is None:
+            return
+        # An uncommitted transaction (in dry run mode) is rolled back here
+        self.db.close()
+        self.db = None
+
+    # == Conversion ==
+
+    def _row_to_entry(self, row, tags):
+        entry = dict(zip(self.columns, row))
+        for x in self.dateattributes:
+            if entry[x] is not None:
+                entry[x] = datetime.strptime(entry[x], self.dateformat).date()
+        entry['tags'] = tags
+        return Entry.from_dict(entry)
+
+    def _to_sql_value(self, attribute, value):
+        if attribute in self.dateattributes and value is not None:
+            return value.strftime(self.dateformat)
+        return value
+
+    def _fetch_entry(self, entryid):
+        row = self.db.execute('SELECT {} FROM entries WHERE id = ?'.format(
+                              ', '.join(self.columns)), (entryid,)).fetchone()
+        if row is None:
+            return None
+        tags = {t for t, in self.db.execute('SELECT tag FROM tags WHERE entryid = ?',
+                                            (entryid,))}
+        return self._row_to_entry(row, tags)
+
+    def _fetch_all_entries(self):
+        tags = {}
+        for entryid, tag in self.db.execute('SELECT entryid, tag FROM tags'):
+            tags.setdefault(entryid, set()).add(tag)
+        query = 'SELECT id, {} FROM entries ORDER BY rowid'.format(', '.join(self.columns))
+        return {row[0]: self._row_to_entry(row[1:], tags.get(row[0], set()))
+                for row in self.db.execute(query)}
+
+    # == Editing ==
+
+    def _update_value(self, entryid, attribute, value):
+        oldvalue = self.entries[entryid][attribute]
+        if attribute == 'tags':
+            oldtags = oldvalue
+            self.db.executemany('DELETE FROM tags WHERE entryid = ? AND tag = ?',
+                                [(entryid, t) for t in oldtags - value])
+            self.db.executemany('INSERT INTO tags (entryid, tag) VALUES (?, ?)',
+                                [(entryid, t) for t in value - oldtags])
+        else:
+            self.db.execute('UPDATE entries SET {} = ? WHERE id = ?'.format(attribute),
+                            (self._to_sql_value(attribute, value), entryid))
+        self.entries[entryid][attribute] = value
+        for index in self.indexes:
+            index.value_changed(entryid, attribute, oldvalue, value)
+
+    def set_entry_value(self, entryid, attribute, value):
+        oldvalue = self.entries[entryid][attribute]
+        self.history.push([(entryid, attribute, oldvalue, value)])
+        self._update_value(entryid, attribute, value)
+        self.commit()
+
+    def set_entry_values(self, actions):
+        if not actions:
+            return
+        changes = []
+        for entryid, attribute, value in actions:
+            oldvalue = self.entries[entryid][attribute]
+            changes.append((entryid, attribute, oldvalue, value))
+            self._update_value(entryid, attribute, value)
+        self.history.push(changes)
+        self.commit()
+
+    def _apply_history_actions(self, actions):
+        updates = []
+        for entryid, attribute, value in actions:
+            self._update_value(entryid, attribute, value)
+            updates.append((entryid, self.entries[entryid]))
+        self.commit()
+        return updates
+
+    def undo_last_change(self):
+        return self._apply_history_actions(self.history.undo(self.entries))
+
+    def redo_last_change(self):
+        return self._apply_history_actions(self.history.redo(self.entries))
+
+    def _insert_entry(self, entryid, entrydata):
+        self.db.execute('INSERT INTO entries (id, {}) VALUES (?{})'.format(
+                            ', '.join(self.columns), ', ?' * len(self.columns)),
+                        [entryid] + [self._to_sql_value(c, entrydata[c])
+                                     for c in self.columns])
+        self.db.executemany('INSERT INTO tags (entryid, tag) VALUES (?, ?)',
+                            [(entryid, t) for t in set(entrydata['tags'])])
+
+    def has_mal_id(self, malid):
+        return self.db.execute('SELECT 1 FROM entries WHERE mal_id = ?',
+                               (malid,)).fetchone() is not None
+
+    def add_entry(self, entrydata):
+        newentryid = self.idallocator.allocate()
+        entrydata = Entry.from_dict(entrydata)
+        self._insert_entry(newentryid, entrydata)
+        self.idallocator.entry_added(newentryid, entrydata)
+        self.entries._set(newentryid, entrydata)
+        for index in self.indexes:
+            index.entry_added(newentryid, entrydata)
+        self.commit()
+
+    # == Queries ==
+
+    def filter_ids(self, filterexpression):
+        """
+        Return a set with the ids of all entries matching the filter
+        expression, or None if it can't be translated to SQL.
+        """
+        try:
+            where, params = self._translate_expression(filterexpression)
+        except NotImplementedError:
+            return None
+        query = 'SELECT id FROM entries WHERE {}'.format(where)
+        return {row[0] for row in self.db.execute(query, params)}
+
+    def sorted_ids(self, attribute, reverse):
+        """
+        Return a list of all entry ids sorted by the attribute, or None if
+        the attribute can't be sorted by the database.
+        """
+        if attribute not in self.columns:
+            return None
+        column = attribute
+        if attribute_types.get(attribute) == 'string':
+            # Text is sorted ignoring case (see entryindexes.sort_key),
+            # which SQLite's own lower() only does for ASCII
+            column = 'casefold({})'.format(attribute)
+        # Unset values go last, and ties are kept in insertion order, like
+        # a stable sort would
+        direction = 'DESC' if reverse else 'ASC'
+        query = 'SELECT id FROM entries ORDER BY {0} IS NULL, {0} {1}, rowid'.format(
+            column, direction)
+        return [row[0] for row in self.db.execute(query)]
+
+    def _translate_expression(self, exp):
+        if exp[0] is None and len(exp) == 2:
+            return self._translate_chunk(exp[1])
+        elif exp[0] in ('AND', 'OR'):
+            parts = [self._translate_chunk(e) for e in exp[1:]]
+            where = ' {} '.format(exp[0]).join('({})'.format(w) for w, _ in parts)
+            return where, [p for _, params in parts for p in params]
+        else:
+            raise SyntaxError('Invalid expression')
+
+    def _translate_chunk(self, chunk):
+        if not isinstance(chunk, str):
+            return self._translate_expression(chunk)
+        negative = chunk.startswith('-')
+        chunk = chunk[negative:]
+        if chunk.startswith('#'):
+            where, params = self._translate_tag(chunk[1:].strip())
+        elif chunk.startswith('~'):
+            # Word search is done by the text indexes
+            raise NotImplementedError
+        else:
+            try:
+                attribute, arg = re.fullmatch(r'(.+?):(.*)', chunk).groups()
+            except AttributeError:
+                raise SyntaxError('Invalid filter chunk: {}'.format(chunk))
+            if attribute.endswith('~'):
+                # So is fuzzy search
+                raise NotImplementedError
+            if attribute not in attribute_types:
+                raise SyntaxError('Unknown attribute: {}'.format(attribute))
+            translate = getattr(self, '_translate_' + attribute_types[attribute])
+            where, params = translate(attribute, arg)
+        if negative:
+            # NULL should count as not matching, so the negation matches
+            where = 'NOT COALESCE(({}), 0)'.format(where)
+        return where, params
+
+    def _translate_tag(self, tag):
+        if not tag:
+            return 'id NOT IN (SELECT entryid FROM tags)', []
+        if '*' in tag:
+            # A wildcard matches one or more characters
+            pattern = re.sub(r'[\[?]', r'[\g<0>]', tag).replace('*', '?*')
+            return 'id IN (SELECT entryid FROM tags WHERE tag GLOB ?)', [pattern]
+        return 'id IN (SELECT entryid FROM tags WHERE tag = ?)', [tag]
+
+    def _translate_comparison(self, column, arg, parsefunc):
+        op, rest = _get_comparison_function(arg)
+        return '{} {} ?'.format(column, _sqlops[op]), [parsefunc(rest)]
+
+    def _translate_string(self, attribute, arg):
+        if not arg:
+            return '{} = \'\''.format(attribute), []
+        # SQLite's lower() only handles ASCII, so anything else is left to Python
+        if not arg.isascii():
+            raise NotImplementedError
+        return 'instr(lower({}), ?) > 0'.format(attribute), [arg.lower()]
+
+    def _translate_int(self, attribute, arg):
+        def parse(rest):
+            if not rest.isdecimal():
+                raise SyntaxError('Invalid int match expression')
+            return int(rest)
+        return self._translate_comparison(attribute, arg, parse)
+
+    def _translate_score(self, attribute, arg):
+        # Only show unscored entries when explicitly told to
+        if not arg:
+            return '{} = 0'.format(attribute), []
+        where, params = self._translate_int(attribute, arg)
+        return '{} != 0 AND {}'.format(attribute, where), params
+
+    def _translate_space(self, attribute, arg):
+        return self._translate_comparison(attribute, arg, _parse_space_arg)
+
+    def _translate_duration(self, attribute, arg):
+        return self._translate_comparison(attribute, arg, _parse_duration_arg)
+
+    def _translate_date(self, attribute, arg):
+        op, rest = _get_comparison_function(arg.lower(), keepspaces=True)
+        precision, value = _parse_date_arg(rest)
+        if precision == 'year':
+            column = 'CAST(substr({}, 1, 4) AS INTEGER)'.format(attribute)
+        elif precision == 'month':
+            column = ('CAST(substr({0}, 1, 4) AS INTEGER)*12 '
+                      '+ CAST(substr({0}, 6, 2) AS INTEGER)'.format(attribute))
+        else:
+            column = attribute
+            value = value.strftime(self.dateformat)
+        return '{} {} ?'.format(column, _sqlops[op]), [value]
+
+
+def import_json(jsonpath, dbpath):
+    """
+    Create (or add to) a database with the entries in a JSON data file.
+    """
+    entrylist = SQLiteEntryList(False)
+    entrylist.set_datapath(dbpath)
+    for entryid, entry in read_json(jsonpath).items():
+        # The dates are already in the right format
+        entrylist.db.execute('DELETE FROM entries WHERE id = ?', (entryid,))
+        entrylist.db.execute('DELETE FROM tags WHERE entryid = ?', (entryid,))
+        entrylist.db.execute('INSERT INTO entries (id, {}) VALUES (?{})'.format(
+                                 ', '.join(entrylist.columns), ', ?' * len(entrylist.columns)),
+                             [entryid] + [entry[c] for c in entrylist.columns])
+        entrylist.db.executemany('INSERT INTO tags (entryid, tag) VALUES (?, ?)',
+                                 [(entryid, t) for t in set(entry['tags'])])
+    entrylist.commit()
+    entrylist.close()
+
+def export_json(dbpath, jsonpath):
+    """
+    Write all entries in a database to a JSON data file.
+    """
+    entrylist = SQLiteEntryList(False)
+    entrylist.set_datapath(dbpath)
+    data = {}
+    for entryid, entry in entrylist.entries.items():
+        data[entryid] = {k: entrylist._to_sql_value(k, v) for k, v in entry.items()}
+        data[entryid]['tags'] = sorted(entry['tags'])
+    entrylist.close()
+    write_file(jsonpath, json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert between the JSON '
+                                     'and the SQLite data formats')
+    parser.add_argument('command', choices=['import', 'export'],
+                        help='import JSON into SQLite or export SQLite to JSON')
+    parser.add_argument('source')
+    parser.add_argument('target')
+    args = parser.parse_args()
+    if args.command == 'import':
+        import_json(args.source, args.target)
+    else:
+        export_json(args.source, args.target)
+
+if __name__ == '__main__':
+    main()
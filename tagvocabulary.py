@@ -0,0 +1,65 @@
+from bisect import bisect_left, insort
+from functools import lru_cache
+import re
+
+
+def is_prefix_wildcard(tag):
+    """
+    Return True if the only wildcard in the tag is at the end, eg. "mecha*".
+    """
+    return tag.endswith('*') and tag.count('*') == 1
+
+
+@lru_cache(maxsize=256)
+def wildcard_matcher(tag):
+    """
+    Return a function that checks if a tag matches a tag with * wildcards.
+
+    Every * matches at least one character. The matchers are cached, so the
+    same wildcard is only compiled once.
+    """
+    if is_prefix_wildcard(tag):
+        prefix = tag[:-1]
+        length = len(prefix)
+        def match(t):
+            return len(t) > length and t.startswith(prefix)
+        return match
+    return re.compile(tag.replace('*', '.+')+'$').match
+
+
+class TagVocabulary():
+    """
+    All tags in use, kept sorted so tags with a prefix can be found by
+    bisection.
+    """
+    def __init__(self, tags=()):
+        self.tags = sorted(tags)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def add(self, tag):
+        insort(self.tags, tag)
+
+    def remove(self, tag):
+        del self.tags[bisect_left(self.tags, tag)]
+
+    def with_prefix(self, prefix):
+        """
+        Return a list with all tags that start with the prefix.
+        """
+        start = bisect_left(self.tags, prefix)
+        end = start
+        while end < len(self.tags) and self.tags[end].startswith(prefix):
+            end += 1
+        return self.tags[start:end]
+
+    def expand(self, tag):
+        """
+        Return a list with all tags that match a tag with * wildcards.
+        """
+        if is_prefix_wildcard(tag):
+            prefix = tag[:-1]
+            return [t for t in self.with_prefix(prefix) if t != prefix]
+        match = wildcard_matcher(tag)
+        return [t for t in self.tags if match(t)]
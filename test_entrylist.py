@@ -0,0 +1,148 @@
+"""
+Check that NomiaEntryList keeps the data file, its checksum and its backups
+consistent, also when the file is damaged or changed outside of nomia.
+"""
+import json
+
+import pytest
+
+pytest.importorskip('PyQt4')
+pytest.importorskip('libsyntyche')
+
+import benchmarks
+from entrystorage import EditJournal, data_digest, verify_checksum
+from indexframe import NomiaEntryList
+
+
+def write_library(path, size=20):
+    """
+    Write a data file like generatelocalanimelist.py does, without a
+    checksum.
+    """
+    entries = benchmarks.generate_library(size)
+    tojson = NomiaEntryList(True).nonstandard_data_to_json
+    path.write_text(json.dumps(entries, default=tojson), encoding='utf-8')
+
+
+def open_library(path, messages=None):
+    status_callback = messages.append if messages is not None else None
+    entrylist = NomiaEntryList(False, status_callback=status_callback)
+    entrylist.set_datapath(str(path))
+    return entrylist
+
+
+def test_external_edit_is_kept(tmp_path):
+    path = tmp_path / 'library.json'
+    write_library(path)
+    entrylist = open_library(path)
+    entrylist.set_entry_value('0', 'title', 'Edited in nomia')
+    entrylist.close()
+    # Rewritten by something that doesn't know about the checksum
+    data = json.loads(path.read_text(encoding='utf-8'))
+    data['0']['title'] = 'Edited by hand'
+    path.write_text(json.dumps(data), encoding='utf-8')
+    messages = []
+    entrylist = open_library(path, messages)
+    entrylist.close()
+    assert entrylist.entries['0']['title'] == 'Edited by hand'
+    assert 'The data file was changed outside of nomia' in messages
+    rawdata = path.read_bytes()
+    assert verify_checksum(str(path), data_digest(rawdata))
+    assert entrylist.backups.newest_valid() == rawdata
+
+
+def test_truncated_file_is_recovered(tmp_path):
+    path = tmp_path / 'library.json'
+    write_library(path)
+    entrylist = open_library(path)
+    entrylist.close()
+    original = entrylist.entries
+    truncated = path.read_bytes()[:1000]
+    path.write_bytes(truncated)
+    messages = []
+    entrylist = open_library(path, messages)
+    entrylist.close()
+    assert {k: e.to_dict() for k, e in entrylist.entries.items()} \
+        == {k: e.to_dict() for k, e in original.items()}
+    assert (tmp_path / 'library.json.damaged').read_bytes() == truncated
+    assert any('recovered' in message for message in messages)
+
+
+def test_damaged_file_without_backup_is_left_alone(tmp_path):
+    path = tmp_path / 'library.json'
+    path.write_text('{"0": {"title": ', encoding='utf-8')
+    messages = []
+    entrylist = open_library(path, messages)
+    assert entrylist.entries == {}
+    assert entrylist.dryrun
+    assert path.read_text(encoding='utf-8') == '{"0": {"title": '
+    assert not (tmp_path / 'library.json.damaged').exists()
+    assert any('nothing will be saved' in message for message in messages)
+
+
+def test_missing_file_is_an_error(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        open_library(tmp_path / 'missing.json')
+
+
+def test_journaled_edits_of_unknown_entries_are_skipped(tmp_path):
+    path = tmp_path / 'library.json'
+    write_library(path)
+    EditJournal(str(path) + '.journal').append([
+        {'id': '0', 'attribute': 'title', 'value': 'Journaled'},
+        {'id': 'unknown', 'attribute': 'title', 'value': 'Lost'},
+    ])
+    messages = []
+    entrylist = open_library(path, messages)
+    entrylist.close()
+    assert entrylist.entries['0']['title'] == 'Journaled'
+    assert 'unknown' not in entrylist.entries
+    assert 'Skipped 1 journaled edits of unknown entries' in messages
+
+
+def test_edits_are_journaled_and_compacted(tmp_path):
+    path = tmp_path / 'library.json'
+    write_library(path)
+    entrylist = open_library(path)
+    original = path.read_bytes()
+    entrylist.set_entry_value('0', 'title', 'Journaled')
+    entrylist.set_entry_value('1', 'tags', {'new', 'tags'})
+    # Only the journal is written until it's compacted, and a crash
+    # before that loses nothing
+    assert path.read_bytes() == original
+    reopened = open_library(path)
+    assert reopened.entries['0']['title'] == 'Journaled'
+    assert reopened.entries['1']['tags'] == {'new', 'tags'}
+    reopened.writer.close()
+    entrylist.close()
+    assert entrylist.journal.is_empty()
+    data = json.loads(path.read_text(encoding='utf-8'))
+    assert data['0']['title'] == 'Journaled'
+    assert sorted(data['1']['tags']) == ['new', 'tags']
+
+
+def test_edits_without_journal_are_written_in_the_background(tmp_path):
+    path = tmp_path / 'library.json'
+    write_library(path)
+    entrylist = open_library(path)
+    entrylist.usejournal = False
+    entrylist.set_entry_value('0', 'title', 'Written')
+    entrylist.close()
+    assert not (tmp_path / 'library.json.journal').exists()
+    rawdata = path.read_bytes()
+    assert json.loads(rawdata.decode('utf-8'))['0']['title'] == 'Written'
+    assert verify_checksum(str(path), data_digest(rawdata))
+    assert entrylist.backups.newest_valid() == rawdata
+
+
+def test_entries_are_loaded_from_the_snapshot(tmp_path, monkeypatch):
+    path = tmp_path / 'library.json'
+    write_library(path)
+    entrylist = open_library(path)
+    entrylist.close()
+    # Parsing the JSON again would fail
+    monkeypatch.setattr(json, 'loads', None)
+    reopened = open_library(path)
+    reopened.close()
+    assert {k: e.to_dict() for k, e in reopened.entries.items()} \
+        == {k: e.to_dict() for k, e in entrylist.entries.items()}
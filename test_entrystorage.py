@@ -0,0 +1,153 @@
+"""
+Check the pieces the entry lists are stored with: checksums, backups,
+snapshots, the edit journal and the background writer.
+"""
+import gzip
+import os
+import pickle
+
+import pytest
+
+from entrystorage import BackgroundWriter, BackupStore, EditJournal, SnapshotCache,\
+        data_digest, file_fingerprint, verify_checksum, write_checksummed
+
+
+def test_checksum_matches_written_data(tmp_path):
+    path = str(tmp_path / 'data.json')
+    data = write_checksummed(path, '{"ä": 1}')
+    assert data == '{"ä": 1}'.encode('utf-8')
+    assert verify_checksum(path, data_digest(data)) is True
+    assert verify_checksum(path, data_digest(b'{}')) is False
+
+
+def test_file_without_checksum(tmp_path):
+    path = str(tmp_path / 'data.json')
+    with open(path, 'w') as f:
+        f.write('{}')
+    assert verify_checksum(path, data_digest(b'{}')) is None
+
+
+def test_backups_keep_the_newest_intact_copies(tmp_path):
+    backups = BackupStore(str(tmp_path / 'backups'), 2)
+    for n in range(4):
+        backups.add('{}'.format(n).encode())
+        # The backups are ordered by modification time
+        path = os.path.join(backups.directory, data_digest(str(n).encode()) + '.json.gz')
+        os.utime(path, (n, n))
+    assert len(os.listdir(backups.directory)) == 2
+    assert backups.newest_valid() == b'3'
+    # A broken newest backup is skipped
+    newest = os.path.join(backups.directory, data_digest(b'3') + '.json.gz')
+    with open(newest, 'wb') as f:
+        f.write(gzip.compress(b'something else'))
+    assert backups.newest_valid() == b'2'
+
+
+def test_no_backups(tmp_path):
+    assert BackupStore(str(tmp_path / 'backups'), 2).newest_valid() is None
+    backups = BackupStore(str(tmp_path / 'off'), 0)
+    backups.add(b'data')
+    assert not os.path.exists(backups.directory)
+
+
+def test_journal_replays_appended_records(tmp_path):
+    journal = EditJournal(str(tmp_path / 'data.json.journal'))
+    assert journal.is_empty()
+    journal.append([{'id': '1', 'attribute': 'title', 'value': 'ä'}])
+    journal.append([{'id': '2', 'entry': {'title': 'b'}},
+                    {'id': '1', 'attribute': 'x', 'value': 1}])
+    assert journal.read() == [{'id': '1', 'attribute': 'title', 'value': 'ä'},
+                              {'id': '2', 'entry': {'title': 'b'}},
+                              {'id': '1', 'attribute': 'x', 'value': 1}]
+    assert not journal.is_empty()
+
+
+def test_journal_ignores_only_a_broken_last_line(tmp_path):
+    journal = EditJournal(str(tmp_path / 'data.json.journal'))
+    journal.append([{'id': '1'}, {'id': '2'}])
+    with open(journal.path, 'a', encoding='utf-8') as f:
+        f.write('{"id": "3", "attr')
+    assert journal.read() == [{'id': '1'}, {'id': '2'}]
+    with open(journal.path, 'w', encoding='utf-8') as f:
+        f.write('{"id": \n{"id": "2"}\n')
+    with pytest.raises(ValueError):
+        journal.read()
+
+
+def test_journal_rotation(tmp_path):
+    journal = EditJournal(str(tmp_path / 'data.json.journal'))
+    journal.append([{'id': '1'}])
+    journal.rotate()
+    journal.append([{'id': '2'}])
+    # A failed write leaves the rotated records, and they pile up
+    journal.rotate()
+    journal.append([{'id': '3'}])
+    assert journal.read() == [{'id': '1'}, {'id': '2'}, {'id': '3'}]
+    journal.discard_rotated()
+    assert journal.read() == [{'id': '3'}]
+    journal.clear()
+    assert journal.is_empty()
+
+
+def test_writer_writes_a_burst_of_changes_once(tmp_path):
+    path = str(tmp_path / 'data.json')
+    serialized = []
+    def serialize():
+        serialized.append(len(serialized))
+        return str(len(serialized))
+    written = []
+    statuses = []
+    writer = BackgroundWriter(path, serialize, on_written=written.append,
+                              status_callback=statuses.append, delay=0.2)
+    for _ in range(10):
+        writer.mark_dirty()
+    writer.close()
+    assert serialized == [0]
+    assert written == [b'1']
+    assert statuses == ['Saving…', 'Saved']
+    assert verify_checksum(path, data_digest(b'1'))
+
+
+def test_writer_reports_failures(tmp_path):
+    def serialize():
+        raise ValueError('broken')
+    statuses = []
+    writer = BackgroundWriter(str(tmp_path / 'data.json'), serialize,
+                              status_callback=statuses.append, delay=0)
+    writer.mark_dirty()
+    writer.close()
+    assert statuses == ['Saving…', 'Save failed: broken']
+    assert not os.path.exists(str(tmp_path / 'data.json'))
+
+
+def test_writer_without_changes_writes_nothing(tmp_path):
+    writer = BackgroundWriter(str(tmp_path / 'data.json'), lambda: '{}')
+    writer.close()
+    assert not os.path.exists(str(tmp_path / 'data.json'))
+
+
+def test_snapshot_is_tied_to_the_data_file(tmp_path):
+    path = str(tmp_path / 'data.json')
+    data = write_checksummed(path, '{}')
+    fingerprint = file_fingerprint(path, data_digest(data))
+    snapshot = SnapshotCache(path + '.snapshot')
+    assert snapshot.load(fingerprint) is None
+    snapshot.save(fingerprint, pickle.dumps({'1': {'title': 'a'}}))
+    assert snapshot.load(fingerprint) == {'1': {'title': 'a'}}
+    data = write_checksummed(path, '{"1": {}}')
+    assert snapshot.load(file_fingerprint(path, data_digest(data))) is None
+
+
+def test_snapshot_of_another_version_is_ignored(tmp_path, monkeypatch):
+    snapshot = SnapshotCache(str(tmp_path / 'data.json.snapshot'))
+    snapshot.save('fingerprint', pickle.dumps({}))
+    monkeypatch.setattr(SnapshotCache, 'version', SnapshotCache.version + 1)
+    assert snapshot.load('fingerprint') is None
+
+
+def test_broken_snapshot_is_ignored(tmp_path):
+    snapshot = SnapshotCache(str(tmp_path / 'data.json.snapshot'))
+    snapshot.save('fingerprint', pickle.dumps({'1': 1}))
+    with open(snapshot.path, 'r+b') as f:
+        f.truncate(os.path.getsize(snapshot.path) - 3)
+    assert snapshot.load('fingerprint') is None
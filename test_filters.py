@@ -0,0 +1,286 @@
+"""
+Check the faster ways of filtering against the original interpreter, and
+the sort orders that are kept up to date against sorting from scratch, on
+generated libraries (see benchmarks.generate_library).
+"""
+import random
+
+import pytest
+
+import benchmarks
+import columnarindex
+import entryfunctions
+from entryfunctions import attribute_types
+from entryindexes import SortOrders, VersionCounter
+from filtersystem import ExpressionCache, FilterCache, MacroResults, compile_filter,\
+        evaluate_filter, interpret_filter
+from parallelfilter import ParallelFilter
+
+
+# Filter expressions the way compile_tag_filter returns them
+expressions = [
+    (None, '#mecha'),
+    (None, '-#comedy'),
+    (None, '#'),
+    (None, '-#'),
+    ('AND', '-#mecha', '-#comedy'),
+    ('OR', '#tag1*', '#dr*a'),
+    ('AND', ('OR', '#sci-fi', 'score_overall:>=8'), '-status:completed'),
+    ('OR', ('AND', 'airing_started:>jan 2010', '-#romance'),
+           ('AND', 'title:robot', 'episodes_total:<13')),
+    ('AND', 'space:>10gib', ('OR', 'episode_length:<25m', 'type:movie')),
+    # Unset dates never match, so only the negations include them
+    (None, 'watching_finished:<2005'),
+    (None, '-watching_finished:<2005'),
+    ('OR', '-airing_started:>=1980', '-airing_finished:>=1980'),
+    ('AND', 'description:train star', '-comment:sword', '-#tag2*'),
+]
+
+sortkeys = ['score_overall', 'title', 'airing_started', 'tags', 'score_story,-title']
+
+
+def edit_randomly(entries, listeners, seed, count):
+    """
+    Change and add entries and tell the listeners (indexes) about it, like
+    an entry list would.
+    """
+    rnd = random.Random(seed)
+    attributes = ['tags', 'score_overall', 'title', 'airing_started',
+                  'watching_finished', 'status', 'description']
+    for n in range(count):
+        if n % 10 == 0:
+            entryid = 'new{}'.format(n)
+            entries[entryid] = dict(entries[rnd.choice(list(entries))])
+            for listener in listeners:
+                listener.entry_added(entryid, entries[entryid])
+            continue
+        entryid = rnd.choice(list(entries))
+        attribute = rnd.choice(attributes)
+        oldvalue = entries[entryid][attribute]
+        newvalue = entries[rnd.choice(list(entries))][attribute]
+        entries[entryid][attribute] = newvalue
+        for listener in listeners:
+            listener.value_changed(entryid, attribute, oldvalue, newvalue)
+
+
+def parse_filter(text, macros):
+    """
+    Parse a filter like a tiny compile_tag_filter, that only knows about
+    chunks separated by commas and macros.
+    """
+    chunks = []
+    for chunk in text.split(','):
+        chunk = chunk.strip()
+        if chunk.startswith('@'):
+            if chunk[1:] not in macros:
+                raise SyntaxError('Unknown macro')
+            chunks.append(parse_filter(macros[chunk[1:]], macros))
+        else:
+            chunks.append(chunk)
+    if len(chunks) == 1:
+        return (None, chunks[0])
+    return ('AND',) + tuple(chunks)
+
+
+def interpreted_ids(expression, entries):
+    matchfuncs = benchmarks.filter_functions('match_')
+    return {k for k, entry in entries.items() if interpret_filter(expression, entry, matchfuncs)}
+
+
+def create_columns():
+    rangefuncs = {k: getattr(entryfunctions, 'range_' + v)
+                  for k, v in attribute_types.items() if v != 'string'}
+    return columnarindex.ColumnarIndex(
+        {k: v for k, v in rangefuncs.items() if attribute_types[k] != 'date'},
+        {k: v for k, v in rangefuncs.items() if attribute_types[k] == 'date'},
+        ['rating', 'status', 'studio', 'type'])
+
+
+@pytest.fixture(scope='module')
+def library():
+    entries = benchmarks.generate_library(2000, seed=1)
+    indexes = benchmarks.filter_indexes(entries)
+    return entries, indexes
+
+
+@pytest.fixture(scope='module')
+def pool(library):
+    entries, _ = library
+    parallelfilter = ParallelFilter(benchmarks.filter_functions('prepare_'), 2)
+    parallelfilter.rebuild(entries)
+    yield parallelfilter
+    parallelfilter.close()
+
+
+@pytest.mark.parametrize('expression', expressions)
+def test_evaluate_filter(library, expression):
+    entries, indexes = library
+    compiledfilter = compile_filter(expression, benchmarks.filter_functions('prepare_'))
+    assert evaluate_filter(compiledfilter, entries, indexes) \
+        == interpreted_ids(expression, entries)
+
+
+@pytest.mark.skipif(not columnarindex.available, reason='NumPy is not installed')
+@pytest.mark.parametrize('expression', expressions)
+def test_columnar_index(library, expression):
+    entries, _ = library
+    columns = create_columns()
+    columns.rebuild(entries)
+    compiledfilter = compile_filter(expression, benchmarks.filter_functions('prepare_'))
+    assert columns.filter_ids(compiledfilter) == interpreted_ids(expression, entries)
+
+
+@pytest.mark.parametrize('expression', expressions)
+def test_parallel_filter(library, pool, expression):
+    entries, _ = library
+    assert pool.filter_ids(expression) == interpreted_ids(expression, entries)
+
+
+def test_filters_after_edits():
+    entries = benchmarks.generate_library(1000, seed=2)
+    indexes = benchmarks.filter_indexes(entries)
+    listeners = list(indexes.values())
+    columns = None
+    if columnarindex.available:
+        columns = create_columns()
+        columns.rebuild(entries)
+        listeners.append(columns)
+    parallelfilter = ParallelFilter(benchmarks.filter_functions('prepare_'), 2)
+    parallelfilter.rebuild(entries)
+    listeners.append(parallelfilter)
+    try:
+        # Start the workers before the edits, so they get them as updates
+        parallelfilter.filter_ids(expressions[0])
+        edit_randomly(entries, listeners, seed=3, count=300)
+        preparefuncs = benchmarks.filter_functions('prepare_')
+        for expression in expressions:
+            expected = interpreted_ids(expression, entries)
+            compiledfilter = compile_filter(expression, preparefuncs)
+            assert evaluate_filter(compiledfilter, entries, indexes) == expected, expression
+            if columns is not None:
+                assert columns.filter_ids(compiledfilter) == expected, expression
+            assert parallelfilter.filter_ids(expression) == expected, expression
+    finally:
+        parallelfilter.close()
+
+
+@pytest.mark.parametrize('sortkey', sortkeys)
+def test_sort_orders_after_edits(sortkey):
+    entries = benchmarks.generate_library(500, seed=4)
+    sortorders = SortOrders()
+    sortorders.rebuild(entries)
+    for reverse in (False, True):
+        sortorders.get(sortkey, reverse)
+    edit_randomly(entries, [sortorders], seed=5, count=300)
+    fresh = SortOrders()
+    fresh.rebuild(entries)
+    for reverse in (False, True):
+        assert sortorders.get(sortkey, reverse) == fresh.get(sortkey, reverse)
+
+
+@pytest.mark.parametrize('sortkey', sortkeys)
+def test_sort_orders_bisect(sortkey):
+    entries = benchmarks.generate_library(500, seed=6)
+    sortorders = SortOrders()
+    sortorders.rebuild(entries)
+    ids = list(sortorders.get(sortkey, False))
+    rnd = random.Random(7)
+    for entryid in rnd.sample(ids, 50):
+        ids.remove(entryid)
+        ids.insert(sortorders.bisect(ids, entryid, sortkey, False), entryid)
+    assert ids == sortorders.get(sortkey, False)
+
+
+def test_filter_cache_is_invalidated_by_relevant_changes():
+    entries = benchmarks.generate_library(100, seed=8)
+    cache = FilterCache(10)
+    cache.versions.rebuild(entries)
+    expression = ('AND', '#mecha', 'score_overall:>5')
+    compiledfilter = compile_filter(expression, benchmarks.filter_functions('prepare_'))
+    assert cache.get(expression, compiledfilter) is None
+    cache.put(expression, {'1'})
+    # The order of the subexpressions and whitespace don't matter
+    assert cache.get(('AND', ' score_overall:>5', '#mecha'), compiledfilter) == {'1'}
+    cache.versions.value_changed('1', 'title', 'a', 'b')
+    assert cache.get(expression, compiledfilter) == {'1'}
+    cache.versions.value_changed('1', 'score_overall', 5, 6)
+    assert cache.get(expression, compiledfilter) is None
+    cache.put(expression, {'1'})
+    cache.versions.entry_added('new', entries['1'])
+    assert cache.get(expression, compiledfilter) is None
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_filter_cache_size():
+    preparefuncs = benchmarks.filter_functions('prepare_')
+    cache = FilterCache(2)
+    a, b, c = (None, '#a'), (None, '#b'), (None, '#c')
+    compiled = {x: compile_filter(x, preparefuncs) for x in (a, b, c)}
+    cache.put(a, {'a'})
+    cache.put(b, {'b'})
+    cache.get(a, compiled[a])
+    cache.put(c, {'c'})
+    # The least recently used one is thrown out
+    assert cache.get(b, compiled[b]) is None
+    assert cache.get(a, compiled[a]) == {'a'}
+    cache.set_size(0)
+    assert not cache.results
+    cache.put(a, {'a'})
+    assert cache.get(a, compiled[a]) is None
+
+
+def test_expression_cache():
+    parsed = []
+    def parse(text, macros):
+        parsed.append(text)
+        return parse_filter(text, macros)
+    preparefuncs = benchmarks.filter_functions('prepare_')
+    cache = ExpressionCache(parse)
+    macros = {'good': '#mecha, score_overall:>5', 'broken': '@missing'}
+    assert cache.set_macros(macros, preparefuncs)
+    assert set(cache.compiled) == {'good'}
+    assert not cache.set_macros(dict(macros), preparefuncs)
+    expression = cache.get('@good, -#comedy')
+    assert cache.get('@good, -#comedy') is expression
+    assert parsed.count('@good, -#comedy') == 1
+    # Filters using the macro share its compiled node
+    compiledfilter = compile_filter(expression, preparefuncs, cache.shared)
+    assert compiledfilter.children[0] is cache.compiled['good']
+    macros['good'] = '#mecha'
+    assert cache.set_macros(macros, preparefuncs)
+    assert cache.get('@good, -#comedy') == ('AND', (None, '#mecha'), '-#comedy')
+    # Single chunks aren't worth sharing
+    assert not cache.compiled
+
+
+def test_macro_results_are_reused_until_relevant_changes():
+    entries = benchmarks.generate_library(500, seed=9)
+    indexes = benchmarks.filter_indexes(entries)
+    versions = VersionCounter()
+    versions.rebuild(entries)
+    listeners = list(indexes.values()) + [versions]
+    preparefuncs = benchmarks.filter_functions('prepare_')
+    cache = ExpressionCache(parse_filter)
+    cache.set_macros({'good': '#mecha, score_overall:>5'}, preparefuncs)
+    macroresults = indexes['@'] = MacroResults(cache, versions, entries, indexes)
+    expression = cache.get('@good, -#comedy')
+    compiledfilter = compile_filter(expression, preparefuncs, cache.shared)
+    assert macroresults.count('good') is None
+    assert evaluate_filter(compiledfilter, entries, indexes) \
+        == interpreted_ids(expression, entries)
+    # The filter stored the macro's results
+    count = macroresults.count('good')
+    ids = macroresults.find('good')
+    assert count == len(ids)
+    assert macroresults.find('good') is ids
+    versions.value_changed('1', 'title', 'a', 'b')
+    assert macroresults.find('good') is ids
+    for listener in listeners:
+        listener.value_changed('1', 'score_overall', entries['1']['score_overall'], 10)
+    entries['1']['score_overall'] = 10
+    assert macroresults.count('good') is None
+    assert evaluate_filter(compiledfilter, entries, indexes) \
+        == interpreted_ids(expression, entries)
+    macroresults.clear()
+    assert macroresults.count('good') is None
+    assert macroresults.find('unknown') is None
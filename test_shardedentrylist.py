@@ -0,0 +1,80 @@
+"""
+Check that several libraries behave like one entry list, also across
+restarts.
+"""
+import json
+
+import pytest
+
+pytest.importorskip('PyQt4')
+pytest.importorskip('libsyntyche')
+
+import benchmarks
+from indexframe import NomiaEntryList
+from shardedentrylist import ShardedEntryList
+
+
+@pytest.fixture
+def settings(tmp_path):
+    with open('defaultconfig.json', encoding='utf-8') as f:
+        settings = json.load(f)
+    tojson = NomiaEntryList(True).nonstandard_data_to_json
+    libraries = {}
+    for seed, name in enumerate(['anime', 'movies']):
+        entries = benchmarks.generate_library(5, seed=seed)
+        for entryid, entry in entries.items():
+            entry['mal_id'] = 1000 * seed + int(entryid)
+        path = tmp_path / (name + '.json')
+        path.write_text(json.dumps(entries, default=tojson), encoding='utf-8')
+        libraries[name] = str(path)
+    settings['libraries'] = libraries
+    settings['new entry library'] = 'anime'
+    settings['persistent undo history'] = True
+    return settings
+
+
+def open_libraries(settings, undoorderpath=None, active=('anime',)):
+    entrylist = ShardedEntryList(False, settings['libraries'],
+                                 lambda path: NomiaEntryList(False), undoorderpath)
+    entrylist.update_settings(settings)
+    entrylist.set_active_libraries(list(active))
+    return entrylist
+
+
+def test_mal_ids_in_all_libraries(settings):
+    entrylist = open_libraries(settings)
+    assert not entrylist.is_loaded('movies')
+    assert entrylist.has_mal_id(3)
+    assert entrylist.has_mal_id(1003)
+    assert not entrylist.has_mal_id(2003)
+    entrylist.close()
+
+
+def test_undo_order_survives_restarts(settings, tmp_path):
+    undoorderpath = str(tmp_path / 'libraries.undoorder')
+    entrylist = open_libraries(settings, undoorderpath, active=['anime', 'movies'])
+    entrylist.set_entry_value('anime-1', 'title', 'First')
+    entrylist.set_entry_value('movies-1', 'title', 'Second')
+    entrylist.set_entry_value('anime-2', 'title', 'Third')
+    entrylist.close()
+    entrylist = open_libraries(settings, undoorderpath, active=['anime', 'movies'])
+    for entryid in ['anime-2', 'movies-1', 'anime-1']:
+        assert [nsid for nsid, _ in entrylist.undo_last_change()] == [entryid]
+    with pytest.raises(IndexError):
+        entrylist.undo_last_change()
+    assert [nsid for nsid, _ in entrylist.redo_last_change()] == ['anime-1']
+    entrylist.close()
+
+
+def test_undo_skips_libraries_with_nothing_left(settings, tmp_path):
+    undoorderpath = tmp_path / 'libraries.undoorder'
+    # Left over from changes that aren't in the histories anymore, with a
+    # broken last line
+    undoorderpath.write_text('movies\nanime\nremoved\nmov', encoding='utf-8')
+    entrylist = open_libraries(settings, str(undoorderpath))
+    entrylist.set_entry_value('anime-1', 'title', 'Changed')
+    assert [nsid for nsid, _ in entrylist.undo_last_change()] == ['anime-1']
+    with pytest.raises(IndexError):
+        entrylist.undo_last_change()
+    assert undoorderpath.read_text(encoding='utf-8') == ''
+    entrylist.close()
@@ -0,0 +1,86 @@
+"""
+Check the SQLite entry list against the same entries in memory.
+"""
+import datetime
+import json
+
+import pytest
+
+pytest.importorskip('libsyntyche')
+
+import benchmarks
+from entryindexes import SortOrders
+from sqliteentrylist import SQLiteEntryList, import_json
+from test_filters import expressions, interpreted_ids
+
+
+def json_value(value):
+    if isinstance(value, set):
+        return sorted(value)
+    return value.isoformat()
+
+
+@pytest.fixture
+def library(tmp_path):
+    """
+    Return an SQLite entry list and the same entries in a dict.
+    """
+    entries = benchmarks.generate_library(300, seed=1)
+    # Text that only sorts right when ignoring case beyond ASCII
+    for entryid, title in zip(['0', '1', '2', '3', '4'],
+                              ['ärger', 'Ärger 2', 'zebra', 'Ölfass', 'ZEBRA']):
+        entries[entryid]['title'] = title
+    jsonpath = tmp_path / 'library.json'
+    jsonpath.write_text(json.dumps(entries, default=json_value), encoding='utf-8')
+    dbpath = str(tmp_path / 'library.db')
+    import_json(str(jsonpath), dbpath)
+    entrylist = SQLiteEntryList(False)
+    entrylist.set_datapath(dbpath)
+    yield entrylist, entries
+    entrylist.close()
+
+
+@pytest.mark.parametrize('attribute', ['title', 'status', 'score_overall', 'airing_started'])
+def test_sorted_ids_without_loading_entries(library, attribute):
+    entrylist, entries = library
+    sortorders = SortOrders()
+    sortorders.rebuild(entries)
+    for reverse in (False, True):
+        assert entrylist.sorted_ids(attribute, reverse) == sortorders.get(attribute, reverse)
+    assert not entrylist.entries._fullyloaded
+
+
+@pytest.mark.parametrize('expression', expressions)
+def test_filter_ids_match_the_interpreter(library, expression):
+    entrylist, entries = library
+    assert entrylist.filter_ids(expression) == interpreted_ids(expression, entries)
+
+
+@pytest.mark.parametrize('expression', [(None, '~robot'), (None, 'title~:robto'),
+                                        ('AND', '#mecha', 'title:ärger')])
+def test_filters_sql_cant_do(library, expression):
+    entrylist, _ = library
+    assert entrylist.filter_ids(expression) is None
+
+
+def test_edits_are_stored(library):
+    entrylist, _ = library
+    date = entrylist.entries['5']['airing_started'] or datetime.date(2000, 1, 1)
+    entrylist.set_entry_value('5', 'title', 'Changed')
+    entrylist.set_entry_values([('5', 'tags', {'a', 'b'}),
+                                ('6', 'airing_started', date.replace(year=1999))])
+    entrylist.undo_last_change()
+    entrylist.undo_last_change()
+    assert entrylist.entries['5']['title'] != 'Changed'
+    entrylist.redo_last_change()
+    entrylist.redo_last_change()
+    entrylist.add_entry(dict(entrylist.entries['7'].to_dict(), mal_id=1))
+    path = entrylist.datapath
+    entrylist.close()
+    entrylist.set_datapath(path)
+    assert entrylist.entries['5']['title'] == 'Changed'
+    assert entrylist.entries['5']['tags'] == {'a', 'b'}
+    assert entrylist.entries['6']['airing_started'] == date.replace(year=1999)
+    assert entrylist.has_mal_id(1)
+    assert len(entrylist.entries) == 301
+    assert entrylist.filter_ids((None, '#a')) == {'5'}
@@ -0,0 +1,132 @@
+"""
+Check the word and fuzzy search indexes against matching every entry.
+"""
+import random
+
+import pytest
+
+import benchmarks
+from entryfunctions import prepare_string
+from textindex import FuzzyIndex, TextIndex, TextSearch, prepare_fuzzy, prepare_words,\
+        text_attributes
+
+
+queries = ['robot', 'robto', 'nihgt star', 'sky sword', 'bons', 'kyoto animaton', 'xyz']
+
+substrings = ['', 'robot', 'obo', 'ar', 'sky s', 'kyoto animation', 'Star 1', 'i.g', 'xyz']
+
+words = ['robot', 'sky sword', 'st', 'drag night', 'kyoto', 'a', 'xyz']
+
+
+def create_text_indexes(entries):
+    indexes = {attribute: TextIndex(attribute) for attribute in text_attributes}
+    for index in indexes.values():
+        index.rebuild(entries)
+    return indexes
+
+
+def edit_titles(entries, index, seed, count):
+    rnd = random.Random(seed)
+    for n in range(count):
+        if n % 10 == 0:
+            entryid = 'new{}'.format(len(entries))
+            entries[entryid] = dict(entries[rnd.choice(list(entries))])
+            index.entry_added(entryid, entries[entryid])
+            continue
+        entryid = rnd.choice(list(entries))
+        oldvalue = entries[entryid]['title']
+        newvalue = entries[rnd.choice(list(entries))]['title'] + ' Ōkami'
+        entries[entryid]['title'] = newvalue
+        index.value_changed(entryid, 'title', oldvalue, newvalue)
+
+
+@pytest.mark.parametrize('attribute', list(text_attributes))
+def test_text_index_finds_what_matches(attribute):
+    entries = benchmarks.generate_library(1000, seed=1)
+    index = TextIndex(attribute)
+    index.rebuild(entries)
+    for arg in substrings:
+        match = prepare_string(arg)
+        assert index.find(arg) == {k for k, e in entries.items() if match(e[attribute])}, arg
+    # Nothing to look up, so it has to be matched the slow way
+    assert index.find('.') is None
+
+
+def test_text_index_after_edits():
+    entries = benchmarks.generate_library(500, seed=2)
+    index = TextIndex('title')
+    index.rebuild(entries)
+    # Edits before the index is built are picked up when it is
+    edit_titles(entries, index, seed=3, count=50)
+    assert not index.built
+    index.find('robot')
+    edit_titles(entries, index, seed=4, count=200)
+    fresh = TextIndex('title')
+    fresh.rebuild(entries)
+    fresh.find('robot')
+    assert index.postings == fresh.postings
+    assert index.trigrams == fresh.trigrams
+    assert index.lengths == fresh.lengths
+    assert index.totallength == fresh.totallength
+    for arg in substrings + ['ōkami']:
+        assert index.find(arg) == fresh.find(arg), arg
+
+
+def test_text_search_finds_what_matches():
+    entries = benchmarks.generate_library(1000, seed=5)
+    search = TextSearch(create_text_indexes(entries))
+    for arg in words:
+        match = prepare_words(arg)
+        assert search.find(arg) == {k for k, e in entries.items() if match(e)}, arg
+
+
+def test_text_search_ranks_better_matches_first():
+    entries = {
+        '1': {'title': 'Robot Girl', 'studio': '', 'description': '', 'comment': ''},
+        '2': {'title': 'Summer', 'studio': '', 'description': 'a robot and a girl',
+              'comment': ''},
+        '3': {'title': 'Summer', 'studio': '', 'description': 'a robot, robot and a girl',
+              'comment': ''},
+        '4': {'title': 'Sky', 'studio': '', 'description': 'no match', 'comment': ''},
+    }
+    search = TextSearch(create_text_indexes(entries))
+    ids = search.find('robot girl')
+    assert ids == {'1', '2', '3'}
+    scores = search.scores('robot girl', ids)
+    # Title matches count more than the description, and more uses of a
+    # word more than fewer
+    assert scores['1'] > scores['3'] > scores['2'] > 0
+
+
+@pytest.mark.parametrize('attribute', ['title', 'studio'])
+def test_fuzzy_index_finds_what_matches(attribute):
+    entries = benchmarks.generate_library(1000, seed=1)
+    index = FuzzyIndex(attribute)
+    index.rebuild(entries)
+    for query in queries:
+        match = prepare_fuzzy(query)
+        assert index.find(query) == {k for k, e in entries.items() if match(e[attribute])}, query
+
+
+def test_fuzzy_index_after_edits():
+    entries = benchmarks.generate_library(500, seed=2)
+    index = FuzzyIndex('title')
+    index.rebuild(entries)
+    edit_titles(entries, index, seed=3, count=200)
+    fresh = FuzzyIndex('title')
+    fresh.rebuild(entries)
+    assert index.postings == fresh.postings
+    assert index.sizes == fresh.sizes
+    for query in queries + ['okami']:
+        assert index.find(query) == fresh.find(query), query
+
+
+def test_fuzzy_scores_prefer_closer_values():
+    entries = {'1': {'title': 'Cowboy Bebop'}, '2': {'title': 'Cowboy Bebop Tengoku no Tobira'},
+               '3': {'title': 'Trigun'}}
+    index = FuzzyIndex('title')
+    index.rebuild(entries)
+    scores = index.scores('cowboy bebop', ['1', '2', '3'])
+    assert scores['1'] == 1
+    assert scores['1'] > scores['2'] > scores['3']
+    assert scores['3'] == 0
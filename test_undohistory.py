@@ -0,0 +1,87 @@
+"""
+Check the undo and redo history, in memory and on disk.
+"""
+import pytest
+
+from undohistory import UndoHistory
+
+
+def apply(entries, actions):
+    for entryid, attribute, value in actions:
+        entries[entryid][attribute] = value
+
+
+def change(entries, history, entryid, attribute, value):
+    history.push([(entryid, attribute, entries[entryid][attribute], value)])
+    entries[entryid][attribute] = value
+
+
+@pytest.fixture(params=['memory', 'disk'])
+def history(request, tmp_path):
+    path = str(tmp_path / 'data.json.undo') if request.param == 'disk' else None
+    return UndoHistory(2**20, path=path)
+
+
+def test_undo_and_redo(history):
+    entries = {'1': {'title': 'a', 'tags': {'x', 'y'}}}
+    change(entries, history, '1', 'title', 'b')
+    change(entries, history, '1', 'tags', {'y', 'z'})
+    apply(entries, history.undo(entries))
+    assert entries['1'] == {'title': 'b', 'tags': {'x', 'y'}}
+    apply(entries, history.undo(entries))
+    assert entries['1'] == {'title': 'a', 'tags': {'x', 'y'}}
+    with pytest.raises(IndexError):
+        history.undo(entries)
+    apply(entries, history.redo(entries))
+    apply(entries, history.redo(entries))
+    assert entries['1'] == {'title': 'b', 'tags': {'y', 'z'}}
+    with pytest.raises(IndexError):
+        history.redo(entries)
+
+
+def test_tag_changes_only_touch_their_tags(history):
+    entries = {'1': {'tags': {'x'}}}
+    change(entries, history, '1', 'tags', {'x', 'y'})
+    # Changed by something that isn't in the history
+    entries['1']['tags'] = {'x', 'y', 'other'}
+    apply(entries, history.undo(entries))
+    assert entries['1']['tags'] == {'x', 'other'}
+
+
+def test_new_change_clears_redo(history):
+    entries = {'1': {'title': 'a'}}
+    change(entries, history, '1', 'title', 'b')
+    history.undo(entries)
+    assert history.can_redo()
+    change(entries, history, '1', 'title', 'c')
+    assert not history.can_redo()
+
+
+def test_oldest_steps_are_dropped_past_the_budget(history):
+    entries = {'1': {'title': ''}}
+    history.budget = 2000
+    for n in range(100):
+        change(entries, history, '1', 'title', str(n))
+    assert history.size() <= 2000
+    undone = 0
+    while history.can_undo():
+        apply(entries, history.undo(entries))
+        undone += 1
+    assert 0 < undone < 100
+    assert entries['1']['title'] == str(99 - undone)
+
+
+def test_history_on_disk_survives_restarts(tmp_path):
+    path = str(tmp_path / 'data.json.undo')
+    entries = {'1': {'title': 'a', 'tags': {'x'}}}
+    history = UndoHistory(2**20, path=path)
+    change(entries, history, '1', 'title', 'b')
+    change(entries, history, '1', 'tags', {'y'})
+    # A step that was cut off while it was written
+    with open(path, 'ab') as f:
+        f.write(b'[["value", "1", "ti')
+    history = UndoHistory(2**20, path=path)
+    apply(entries, history.undo(entries))
+    apply(entries, history.undo(entries))
+    assert entries['1'] == {'title': 'a', 'tags': {'x'}}
+    assert not history.can_undo()
@@ -0,0 +1,372 @@
+"""
+Word and substring search in the text attributes.
+
+Every word in an attribute is indexed with the entries it's used in, and
+every word is in turn indexed by its trigrams (all three letter parts of
+it). Only the distinct words are split into trigrams, which keeps the
+index small even for long descriptions.
+
+Fuzzy search (title~:query) also uses trigrams, but compares them
+directly, so that titles with typos or other spellings still match.
+"""
+from collections import Counter
+from math import ceil, log
+import re
+import unicodedata
+
+from entryindexes import EntryIndex
+
+
+# The attributes searched by ~ chunks, and how much a match in each of
+# them counts when ranking the results
+text_attributes = {
+    'title': 3,
+    'studio': 2,
+    'description': 1,
+    'comment': 1,
+}
+
+# The attributes that can be searched with attribute~:query
+fuzzy_attributes = ('title', 'studio')
+
+# How large part of the query's trigrams a value needs for a fuzzy match
+fuzzy_threshold = 0.4
+
+# BM25 parameters
+_K1 = 1.2
+_B = 0.75
+
+
+def tokenize(text):
+    """
+    Return a list with all words in the text, in lower case.
+    """
+    return re.findall(r'\w+', text.lower())
+
+
+def trigrams(word):
+    return {word[i:i+3] for i in range(len(word) - 2)}
+
+
+def prepare_words(arg):
+    """
+    Return a predicate for ~ chunks, that takes an entry and checks if
+    every word in the argument is the start of a word in any of the text
+    attributes.
+    """
+    words = tokenize(arg)
+    if not words:
+        raise SyntaxError('Nothing to search for')
+    # A word starts wherever the previous character isn't part of one
+    regexes = [re.compile(r'(?<!\w)' + re.escape(word)) for word in words]
+    def match(entry):
+        text = '\n'.join(entry[attribute] for attribute in text_attributes).lower()
+        return all(rx.search(text) for rx in regexes)
+    return match
+
+
+def fuzzy_trigrams(text):
+    """
+    Return a set with the trigrams of all words in the text, with the words
+    padded so their beginnings and ends get trigrams of their own.
+
+    Accents are removed and long vowels written as ou, oo or uu shortened,
+    so different romanizations of Japanese end up the same.
+    """
+    text = text.lower()
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r'o[ou]', 'o', text).replace('uu', 'u')
+    grams = set()
+    for word in re.findall(r'\w+', text):
+        word = '  ' + word + ' '
+        grams.update(word[i:i+3] for i in range(len(word) - 2))
+    return grams
+
+
+def prepare_fuzzy(arg):
+    """
+    Return a predicate for attribute~:query chunks, that checks if enough
+    of the query's trigrams are in the value.
+    """
+    querygrams = fuzzy_trigrams(arg)
+    if not querygrams:
+        raise SyntaxError('Nothing to search for')
+    needed = ceil(fuzzy_threshold * len(querygrams))
+    def match(data):
+        return len(querygrams & fuzzy_trigrams(data)) >= needed
+    return match
+
+
+class TextIndex(EntryIndex):
+    """
+    An inverted index over the words of one text attribute.
+
+    Building it takes a while with long texts, so it's only built the
+    first time it's used, and after that kept up to date like other
+    indexes.
+    """
+    def __init__(self, attribute):
+        self.attribute = attribute
+        self.entries = {}
+        self.built = False
+        # word -> {entry id: times the word is used}
+        self.postings = {}
+        # trigram -> set of words
+        self.trigrams = {}
+        # entry id -> number of words
+        self.lengths = {}
+        self.totallength = 0
+        self.empty = set()
+
+    def rebuild(self, entries):
+        self.entries = entries
+        self.built = False
+        self.postings = {}
+        self.trigrams = {}
+        self.lengths = {}
+        self.totallength = 0
+        self.empty = set()
+
+    def _build(self):
+        if self.built:
+            return
+        attribute = self.attribute
+        for entryid, entry in self.entries.items():
+            self._add(entryid, entry[attribute])
+        self.built = True
+
+    def _add(self, entryid, text):
+        if not text:
+            self.empty.add(entryid)
+        words = tokenize(text)
+        self.lengths[entryid] = len(words)
+        self.totallength += len(words)
+        allpostings = self.postings
+        for word in words:
+            postings = allpostings.get(word)
+            if postings is None:
+                postings = allpostings[word] = {}
+                for trigram in trigrams(word):
+                    self.trigrams.setdefault(trigram, set()).add(word)
+            postings[entryid] = postings.get(entryid, 0) + 1
+
+    def _remove(self, entryid, text):
+        self.empty.discard(entryid)
+        self.totallength -= self.lengths.pop(entryid)
+        for word in set(tokenize(text)):
+            postings = self.postings[word]
+            del postings[entryid]
+            if not postings:
+                del self.postings[word]
+                for trigram in trigrams(word):
+                    words = self.trigrams[trigram]
+                    words.discard(word)
+                    if not words:
+                        del self.trigrams[trigram]
+
+    def entry_added(self, entryid, entry):
+        if self.built:
+            self._add(entryid, entry[self.attribute])
+
+    def value_changed(self, entryid, attribute, oldvalue, newvalue):
+        if self.built and attribute == self.attribute:
+            self._remove(entryid, oldvalue)
+            self._add(entryid, newvalue)
+
+    def words_containing(self, part):
+        """
+        Return a list with all words that include part.
+        """
+        self._build()
+        grams = trigrams(part)
+        if not grams:
+            return [w for w in self.postings if part in w]
+        words = sorted((self.trigrams.get(g, set()) for g in grams), key=len)
+        return [w for w in words[0].intersection(*words[1:]) if part in w]
+
+    def frequencies(self, prefix):
+        """
+        Return a dict with how many times words starting with the prefix
+        are used in each entry that uses any of them.
+        """
+        result = Counter()
+        for word in self.words_containing(prefix):
+            if word.startswith(prefix):
+                result.update(self.postings[word])
+        return result
+
+    def find(self, arg):
+        """
+        Return a set with the ids of the entries where the argument is
+        part of the text (like entryfunctions.prepare_string), or None if
+        it has no letters or digits to look up.
+
+        Only entries that have all the words (or parts of words) in the
+        argument are checked against the whole text.
+        """
+        self._build()
+        if not arg:
+            return set(self.empty)
+        arg = arg.lower()
+        parts = tokenize(arg)
+        if not parts:
+            return None
+        candidates = None
+        # Longer parts have fewer matching words
+        for part in sorted(parts, key=len, reverse=True):
+            ids = set().union(*(self.postings[w] for w in self.words_containing(part)))
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return set()
+        attribute = self.attribute
+        entries = self.entries
+        return {k for k in candidates if arg in entries[k][attribute].lower()}
+
+    def count(self, arg):
+        ids = self.find(arg)
+        return None if ids is None else len(ids)
+
+
+class TextSearch():
+    """
+    Search all text attributes at once, for ~ chunks.
+
+    indexes maps the attributes in text_attributes to their TextIndex.
+    """
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def find(self, arg):
+        """
+        Return a set with the ids of the entries matching prepare_words(arg).
+        """
+        result = None
+        for word in tokenize(arg):
+            ids = set().union(*(index.frequencies(word) for index in self.indexes.values()))
+            result = ids if result is None else result & ids
+            if not result:
+                break
+        return result
+
+    def count(self, arg):
+        ids = self.find(arg)
+        return None if ids is None else len(ids)
+
+    def scores(self, arg, ids):
+        """
+        Return a dict with how well the entries with the ids match the
+        words in the argument, higher is better.
+
+        The score is BM25 (with words counting if they start with a word in
+        the argument), weighted by text_attributes.
+        """
+        scores = dict.fromkeys(ids, 0.0)
+        for word in tokenize(arg):
+            for attribute, index in self.indexes.items():
+                frequencies = index.frequencies(word)
+                if not frequencies:
+                    continue
+                total = len(index.lengths)
+                matching = len(frequencies)
+                idf = log(1 + (total - matching + 0.5) / (matching + 0.5))
+                averagelength = index.totallength / total or 1
+                weight = text_attributes[attribute] * idf
+                for entryid in frequencies.keys() & scores.keys():
+                    tf = frequencies[entryid]
+                    norm = 1 - _B + _B * index.lengths[entryid] / averagelength
+                    scores[entryid] += weight * tf * (_K1 + 1) / (tf + _K1 * norm)
+        return scores
+
+
+class FuzzyIndex(EntryIndex):
+    """
+    An index of the fuzzy_trigrams of one attribute, for finding values
+    similar to a query without comparing it to all of them.
+    """
+    def __init__(self, attribute):
+        self.attribute = attribute
+        self.entries = {}
+        # trigram -> set of entry ids
+        self.postings = {}
+        # entry id -> number of trigrams
+        self.sizes = {}
+
+    def rebuild(self, entries):
+        self.entries = entries
+        self.postings = {}
+        self.sizes = {}
+        attribute = self.attribute
+        for entryid, entry in entries.items():
+            self._add(entryid, entry[attribute])
+
+    def _add(self, entryid, text):
+        postings = self.postings
+        grams = fuzzy_trigrams(text)
+        self.sizes[entryid] = len(grams)
+        for trigram in grams:
+            ids = postings.get(trigram)
+            if ids is None:
+                postings[trigram] = {entryid}
+            else:
+                ids.add(entryid)
+
+    def _remove(self, entryid, text):
+        del self.sizes[entryid]
+        for trigram in fuzzy_trigrams(text):
+            ids = self.postings[trigram]
+            ids.discard(entryid)
+            if not ids:
+                del self.postings[trigram]
+
+    def entry_added(self, entryid, entry):
+        self._add(entryid, entry[self.attribute])
+
+    def value_changed(self, entryid, attribute, oldvalue, newvalue):
+        if attribute == self.attribute:
+            self._remove(entryid, oldvalue)
+            self._add(entryid, newvalue)
+
+    def find(self, arg):
+        """
+        Return a set with the ids of the entries matching prepare_fuzzy(arg),
+        or None if there is nothing to search for.
+        """
+        querygrams = fuzzy_trigrams(arg)
+        if not querygrams:
+            return None
+        postings = sorted((self.postings.get(g, set()) for g in querygrams), key=len)
+        needed = ceil(fuzzy_threshold * len(postings))
+        # Every match has at least one of the rarest trigrams, so only those
+        # are counted and the common ones are checked for the candidates
+        rare = len(postings) - needed + 1
+        counts = Counter()
+        for ids in postings[:rare]:
+            counts.update(ids)
+        common = postings[rare:]
+        return {entryid for entryid, n in counts.items()
+                if n + sum(entryid in ids for ids in common) >= needed}
+
+    def count(self, arg):
+        ids = self.find(arg)
+        return None if ids is None else len(ids)
+
+    def scores(self, arg, ids):
+        """
+        Return a dict with how similar the values of the entries with the
+        ids are to the argument, from 0 to 1.
+
+        This is the average of how much of the query is in the value and
+        how much of the two they have in common, so a shorter value with
+        the same match ranks higher.
+        """
+        querygrams = fuzzy_trigrams(arg)
+        postings = [self.postings.get(g, set()) for g in querygrams]
+        size = max(len(querygrams), 1)
+        scores = {}
+        for entryid in ids:
+            common = sum(entryid in p for p in postings)
+            union = len(querygrams) + self.sizes[entryid] - common
+            scores[entryid] = (common / size + common / max(union, 1)) / 2
+        return scores
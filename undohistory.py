@@ -0,0 +1,239 @@
+from collections import deque
+import json
+import os
+import os.path
+import sys
+
+
+def _step_size(step):
+    """
+    Return a rough estimate of how many bytes a step uses in memory.
+    """
+    size = sys.getsizeof(step)
+    for change in step:
+        size += sys.getsizeof(change)
+        if change[0] == 'tags':
+            # The set itself and the (usually shared) tag strings
+            size += sum(sys.getsizeof(x) + 8*len(x) for x in change[2:])
+        else:
+            size += sum(sys.getsizeof(x) for x in change[3:])
+    return size
+
+
+class _MemoryStack():
+    def __init__(self):
+        self.steps = deque()
+        self.sizes = deque()
+
+    def __len__(self):
+        return len(self.steps)
+
+    def push(self, step):
+        self.steps.append(step)
+        self.sizes.append(_step_size(step))
+
+    def pop(self):
+        self.sizes.pop()
+        return self.steps.pop()
+
+    def drop_oldest(self, count):
+        for _ in range(count):
+            self.steps.popleft()
+            self.sizes.popleft()
+
+    def clear(self):
+        self.steps.clear()
+        self.sizes.clear()
+
+
+class _DiskStack():
+    """
+    A stack of steps stored as lines of JSON in a file.
+
+    Only the offsets of the steps are kept in memory, and a step is read
+    back from the file when it's popped.
+    """
+    def __init__(self, path, default, parse_value):
+        self.path = path
+        self.default = default
+        self.parse_value = parse_value
+        self.offsets = []
+        self.sizes = []
+        if os.path.exists(path):
+            with open(path, 'r+b') as f:
+                pos = 0
+                for line in f:
+                    # Skip a broken last line
+                    if not line.endswith(b'\n'):
+                        f.truncate(pos)
+                        break
+                    self.offsets.append(pos)
+                    self.sizes.append(len(line))
+                    pos += len(line)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _encode(self, step):
+        changes = []
+        for change in step:
+            if change[0] == 'tags':
+                changes.append(['tags', change[1], sorted(change[2]), sorted(change[3])])
+            else:
+                changes.append(list(change))
+        return (json.dumps(changes, ensure_ascii=False, default=self.default)
+                + '\n').encode('utf-8')
+
+    def _decode(self, rawstep):
+        step = []
+        for change in json.loads(rawstep.decode('utf-8')):
+            if change[0] == 'tags':
+                step.append(('tags', change[1], frozenset(change[2]), frozenset(change[3])))
+            else:
+                _, entryid, attribute, oldvalue, newvalue = change
+                step.append(('value', entryid, attribute,
+                             self.parse_value(attribute, oldvalue),
+                             self.parse_value(attribute, newvalue)))
+        return step
+
+    def push(self, step):
+        line = self._encode(step)
+        with open(self.path, 'ab') as f:
+            self.offsets.append(f.tell())
+            f.write(line)
+        self.sizes.append(len(line))
+
+    def pop(self):
+        offset = self.offsets.pop()
+        self.sizes.pop()
+        with open(self.path, 'r+b') as f:
+            f.seek(offset)
+            rawstep = f.read()
+            f.truncate(offset)
+        return self._decode(rawstep)
+
+    def drop_oldest(self, count):
+        if not count:
+            return
+        if count >= len(self.offsets):
+            self.clear()
+            return
+        start = self.offsets[count]
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        self.offsets = [x - start for x in self.offsets[count:]]
+        self.sizes = self.sizes[count:]
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.offsets = []
+        self.sizes = []
+
+
+class UndoHistory():
+    """
+    Undo and redo history for changes to an entry list.
+
+    Every step is a list of changes. Tag changes are stored as the tags
+    that were added and removed instead of copies of the full tag sets, and
+    everything else as the old and the new value.
+
+    When the history grows past its budget (in bytes) the oldest steps are
+    thrown away. If a path is given, the undo steps are stored in that file
+    instead of in memory, which means they survive restarts. default and
+    parse_value are used to convert values to and from JSON in that case.
+    """
+    def __init__(self, budget, path=None, default=None, parse_value=None):
+        self.budget = budget
+        if path is None:
+            self.undostack = _MemoryStack()
+        else:
+            self.undostack = _DiskStack(path, default,
+                                        parse_value or (lambda attribute, value: value))
+        self.redostack = _MemoryStack()
+
+    def can_undo(self):
+        return len(self.undostack) > 0
+
+    def can_redo(self):
+        return len(self.redostack) > 0
+
+    def push(self, changes):
+        """
+        Add a new step to the history. changes should be a list of
+        (entryid, attribute, oldvalue, newvalue) tuples.
+
+        This clears the redo history.
+        """
+        step = []
+        for entryid, attribute, oldvalue, newvalue in changes:
+            if attribute == 'tags':
+                step.append(('tags', entryid, frozenset(newvalue - oldvalue),
+                             frozenset(oldvalue - newvalue)))
+            else:
+                step.append(('value', entryid, attribute, oldvalue, newvalue))
+        self.redostack.clear()
+        self.undostack.push(step)
+        self._enforce_budget()
+
+    def undo(self, entries):
+        """
+        Return a list of (entryid, attribute, value) actions that undo the
+        last step and move the step to the redo history.
+
+        Raise IndexError if there's nothing to undo.
+        """
+        step = self.undostack.pop()
+        actions = []
+        for change in reversed(step):
+            if change[0] == 'tags':
+                _, entryid, added, removed = change
+                actions.append((entryid, 'tags', (entries[entryid]['tags'] - added) | removed))
+            else:
+                _, entryid, attribute, oldvalue, _ = change
+                actions.append((entryid, attribute, oldvalue))
+        self.redostack.push(step)
+        self._enforce_budget()
+        return actions
+
+    def redo(self, entries):
+        """
+        Return a list of (entryid, attribute, value) actions that redo the
+        last undone step and move the step back to the undo history.
+
+        Raise IndexError if there's nothing to redo.
+        """
+        step = self.redostack.pop()
+        actions = []
+        for change in step:
+            if change[0] == 'tags':
+                _, entryid, added, removed = change
+                actions.append((entryid, 'tags', (entries[entryid]['tags'] - removed) | added))
+            else:
+                _, entryid, attribute, _, newvalue = change
+                actions.append((entryid, attribute, newvalue))
+        self.undostack.push(step)
+        self._enforce_budget()
+        return actions
+
+    def size(self):
+        return sum(self.undostack.sizes) + sum(self.redostack.sizes)
+
+    def _enforce_budget(self):
+        total = self.size()
+        if total <= self.budget:
+            return
+        # Free a bit more than needed, so this doesn't happen on every change
+        target = self.budget * 3 // 4
+        # The oldest undo steps go first, then the oldest redo steps,
+        # but the latest step is always kept
+        for stack in [self.undostack, self.redostack]:
+            count = 0
+            while count < len(stack) - 1 and total > target:
+                total -= stack.sizes[count]
+                count += 1
+            stack.drop_oldest(count)